@@ -38,6 +38,9 @@ from pitivi.settings import GlobalSettings
 from pitivi.settings import xdg_cache_home
 from pitivi.shortcuts import ShortcutsManager
 from pitivi.shortcuts import show_shortcuts
+from pitivi.timeline.previewers import PreviewsCachePruner
+from pitivi.timeline.previewers import ThumbnailCache
+from pitivi.timeline.previewers import VideoPreviewer
 from pitivi.undo.project import ProjectObserver
 from pitivi.undo.undo import UndoableActionLog
 from pitivi.utils import loggable
@@ -141,6 +144,8 @@ class Pitivi(Gtk.Application, Loggable):
     def _setup(self):
         self.settings = GlobalSettings()
         self.threads = ThreadMaster()
+        self.threads.addThread(PreviewsCachePruner,
+                               self.settings.previewsCacheMaxSize * 1024 * 1024)
         self.effects = EffectsManager()
         self.proxy_manager = ProxyManager(self)
         self.system = get_system()
@@ -150,6 +155,11 @@ class Pitivi(Gtk.Application, Loggable):
         self.project_manager.connect(
             "new-project-loaded", self._newProjectLoaded)
         self.project_manager.connect("project-closed", self._projectClosed)
+        # The idle pipelines have been created with the previous settings.
+        for name in ("thumbnailsScalingMethod", "thumbnailsDecoderThreads",
+                     "thumbnailsDecoderLowres"):
+            self.settings.connect(name + "Changed",
+                                  self._thumbnails_settings_changed_cb)
 
         self._createActions()
         self._syncDoUndo()
@@ -241,6 +251,8 @@ class Pitivi(Gtk.Application, Loggable):
         if self.gui:
             self.gui.destroy()
         self.threads.stopAllThreads()
+        VideoPreviewer.idle_pipelines.clear()
+        ThumbnailCache.flush()
         self.settings.storeSettings()
         self.quit()
         return True
@@ -282,6 +294,8 @@ class Pitivi(Gtk.Application, Loggable):
         self.project_observer = ProjectObserver(project, self.action_log)
 
     def _projectClosed(self, unused_project_manager, project):
+        VideoPreviewer.idle_pipelines.clear()
+        ThumbnailCache.flush()
         if project.loaded:
             self.action_log = None
             self._syncDoUndo()
@@ -291,6 +305,9 @@ class Pitivi(Gtk.Application, Loggable):
             self._scenario_file.close()
             self._scenario_file = None
 
+    def _thumbnails_settings_changed_cb(self, unused_settings):
+        VideoPreviewer.idle_pipelines.clear()
+
     def _checkVersion(self):
         """Checks online for new versions of the app."""
         self.info("Requesting version information async")
@@ -18,10 +18,12 @@
 # Boston, MA 02110-1301, USA.
 # TODO reimplement after GES port
 """Automatic alignment of `Clip`s."""
-import array
+import multiprocessing
 import os
 import time
 
+from gi.repository import GES
+from gi.repository import GLib
 from gi.repository import Gst
 from gi.repository import Gtk
 
@@ -31,14 +33,27 @@ try:
 except ImportError:
     numpy = None
 
+try:
+    # Faster than numpy.fft and it can use multiple threads.
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
 from gettext import gettext as _
 
 import pitivi.configure as configure
 
+from pitivi.timeline.previewers import get_wavefile_location_for_uri
+from pitivi.timeline.previewers import Previewer
+from pitivi.timeline.previewers import SAMPLE_DURATION
 from pitivi.utils.ui import beautify_ETA
 from pitivi.utils.misc import call_false
-from pitivi.utils.extract import Extractee
+from pitivi.utils.misc import get_proxy_target
+from pitivi.utils.misc import quote_uri
 from pitivi.utils.loggable import Loggable
+from pitivi.utils.waveform import decimate
+from pitivi.utils.waveform import load_waveform
+from pitivi.utils.waveform import RMS_ROW
 
 
 def nextpow2(x):
@@ -82,7 +97,25 @@ def submax(left, middle, right):
     # z = (R/L - 1)/(R/L + 1) = (R-L)/(R+L)
 
 
-def rigidalign(reference, targets):
+# The decimation factor of the envelopes aligned in the first pass of
+# coarse_to_fine_rigidalign.
+COARSE_DECIMATION = 16
+
+# The number of samples around the coarse shift searched in the second
+# pass of coarse_to_fine_rigidalign, on each side.
+FINE_SEARCH_WINDOW = 2 * COARSE_DECIMATION
+
+# The minimum and the maximum number of blocks of each target matched
+# separately with the reference by affinealign.
+AFFINE_MIN_BLOCK_SIZE = 256
+AFFINE_MAX_BLOCKS = 32
+
+# The maximum distance in samples between the positions where the blocks
+# of a target start according to their matches, for being consistent.
+AFFINE_TOLERANCE = 2
+
+
+def rigidalign(reference, targets, max_offset=None):
     """
     Estimate the relative shift between reference and targets.
 
@@ -94,6 +127,9 @@ def rigidalign(reference, targets):
     @type reference: Sequence(Number)
     @param targets: the waveforms that should be aligned to reference
     @type targets: Sequence(Sequence(Number))
+    @param max_offset: the maximum absolute shift considered, or None
+        to consider all the shifts
+    @type max_offset: L{int} or L{NoneType}
     @returns: The shift necessary to bring each target into alignment
         with the reference.  The returned shift may not be an integer,
         indicating that the best alignment would be achieved by a
@@ -107,208 +143,287 @@ def rigidalign(reference, targets):
     # We round up L to the next power of 2 for speed in the FFT.
     L = nextpow2(L)
     reference = reference - numpy.mean(reference)
-    fref = numpy.fft.rfft(reference, L).conj()
+    fref = _rfft(reference, L).conj()
+    # The targets are transformed together, one per row, padded with zeros.
+    lengths = numpy.array([len(t) for t in targets])
+    stacked = numpy.zeros((len(targets), lengths.max()))
+    for i, t in enumerate(targets):
+        stacked[i, :len(t)] = t - numpy.mean(t)
+    # Compute cross-correlation
+    xcorr = _irfft(fref * _rfft(stacked, L), L)
+    del stacked
+    # shift maximizes dotproduct(t[shift:],reference)
+    if max_offset is None or 2 * max_offset + 1 >= L:
+        shift = numpy.argmax(xcorr, axis=1)
+    else:
+        # The negative shifts are at the end.
+        allowed = numpy.concatenate((xcorr[:, :max_offset + 1],
+                                     xcorr[:, L - max_offset:]), axis=1)
+        shift = numpy.argmax(allowed, axis=1)
+        shift = numpy.where(shift > max_offset,
+                            shift + L - 2 * max_offset - 1, shift)
+    rows = numpy.arange(len(targets))
+    subsample_shift = submax(xcorr[rows, (shift - 1) % L],
+                             xcorr[rows, shift],
+                             xcorr[rows, (shift + 1) % L])
+    shift = shift + subsample_shift
+    # shift is now a float indicating the interpolated maximum
+    # Negative shifts appear large and positive, correct them to be negative
+    shift = numpy.where(shift >= lengths, shift - L, shift)
+    # Sign reversed to move the target instead of the reference
+    return [-float(target_shift) for target_shift in shift]
+
+
+def _rfft(a, n):
+    """Computes the FFT of the real signals along the last axis."""
+    if scipy_fft:
+        return scipy_fft.rfft(a, n, workers=-1)
+    return numpy.fft.rfft(a, n)
+
+
+def _irfft(a, n):
+    """Computes the inverse of `_rfft` along the last axis."""
+    if scipy_fft:
+        return scipy_fft.irfft(a, n, workers=-1)
+    return numpy.fft.irfft(a, n)
+
+
+def _xcorr_at(reference, target, lags):
+    """Computes the cross-correlation of the signals at the specified lags.
+
+    Args:
+        reference (numpy.ndarray): The first signal.
+        target (numpy.ndarray): The second signal.
+        lags (List[int]): The lags at which to compute the correlation.
+
+    Returns:
+        numpy.ndarray: The sum of `reference[n] * target[n + lag]` for
+        each lag.
+    """
+    xcorr = numpy.zeros(len(lags))
+    for i, lag in enumerate(lags):
+        start = max(0, -lag)
+        end = min(len(reference), len(target) - lag)
+        if start < end:
+            xcorr[i] = numpy.dot(reference[start:end],
+                                 target[start + lag:end + lag])
+    return xcorr
+
+
+def coarse_to_fine_rigidalign(reference, targets, max_offset=None,
+                              decimation=COARSE_DECIMATION,
+                              window=FINE_SEARCH_WINDOW):
+    """Estimates the relative shift between reference and targets.
+
+    It gives the same results as `rigidalign`, but the cross-correlation
+    is computed with FFTs only for the decimated signals. The shifts are
+    then refined by computing the cross-correlation of the signals
+    directly, only around the shifts found. The memory and the time
+    needed are much lower for long signals.
+
+    Args:
+        reference (numpy.ndarray): The waveform to regard as fixed.
+        targets (List[numpy.ndarray]): The waveforms that should be
+            aligned to reference.
+        max_offset (Optional[int]): The maximum absolute shift considered,
+            or None to consider all the shifts.
+        decimation (int): The decimation factor of the first pass.
+        window (int): The number of shifts searched in the second pass,
+            on each side of the shift found in the first pass.
+
+    Returns:
+        List[float]: The shift necessary to bring each target into
+        alignment with the reference, as returned by `rigidalign`.
+    """
+    reference = numpy.asarray(reference, dtype=numpy.float64)
+    reference = reference - numpy.mean(reference)
+    coarse_reference = decimate(reference, decimation)
+    coarse_max_offset = None
+    if max_offset is not None:
+        coarse_max_offset = -(-max_offset // decimation)
+    targets = [numpy.asarray(t, dtype=numpy.float64) for t in targets]
+    targets = [t - numpy.mean(t) for t in targets]
+    coarse_shifts = rigidalign(coarse_reference,
+                               [decimate(t, decimation) for t in targets],
+                               coarse_max_offset)
     shifts = []
-    for t in targets:
-        t = t - numpy.mean(t)
-        # Compute cross-correlation
-        xcorr = numpy.fft.irfft(fref * numpy.fft.rfft(t, L))
-        # shift maximizes dotproduct(t[shift:],reference)
-        # int() to convert numpy.int32 to python int
-        shift = int(numpy.argmax(xcorr))
-        subsample_shift = submax(xcorr[(shift - 1) % L],
-                                 xcorr[shift],
-                                 xcorr[(shift + 1) % L])
-        shift = shift + subsample_shift
-        # shift is now a float indicating the interpolated maximum
-        if shift >= len(t):  # Negative shifts appear large and positive
-            shift -= L       # This corrects them to be negative
-        shifts.append(-shift)
-        # Sign reversed to move the target instead of the reference
+    for t, coarse_shift in zip(targets, coarse_shifts):
+        # The lag maximizing the cross-correlation is the opposite of the shift.
+        center = -int(round(coarse_shift * decimation))
+        first = max(center - window, 1 - len(reference))
+        last = min(center + window, len(t) - 1)
+        if max_offset is not None:
+            first = max(first, -max_offset)
+            last = min(last, max_offset)
+        # Include the neighbours of the edges, needed for the interpolation.
+        lags = numpy.arange(first - 1, last + 2)
+        xcorr = _xcorr_at(reference, t, lags)
+        best = 1 + int(numpy.argmax(xcorr[1:-1]))
+        lag = lags[best] + submax(xcorr[best - 1], xcorr[best], xcorr[best + 1])
+        shifts.append(-float(lag))
     return shifts
 
 
-def _findslope(a):
-    # Helper function for affinealign
-    # The provided matrix a contains a bright line whose slope we want to know,
-    # against a noisy background.
-    # The line starts at 0,0.  If the slope is positive, it runs toward the
-    # center of the matrix (i.e. toward (-1,-1))
-    # If the slope is negative, it wraps from 0,0 to 0,-1 and continues toward
-    # the center, (i.e. toward (-1,0)).
-    # The line segment terminates at the midline along the X direction.
-    # We locate the line by simply checking the sum along each possible line
-    # up to the Y-max edge of a.  The caller sets the limit by choosing the
-    # size of a.
-    # The function returns a floating-point slope assuming that the matrix
-    # has "square pixels".
-    Y, X = a.shape
-    X /= 2
-    x_pos = numpy.arange(1, X)
-    x_neg = numpy.arange(2 * X - 1, X, -1)
-    best_end = 0
-    max_sum = 0
-    for end in range(Y):
-        y = (x_pos * end) // X
-        s = numpy.sum(a[y, x_pos])
-        if s > max_sum:
-            max_sum = s
-            best_end = end
-        s = numpy.sum(a[y, x_neg])
-        if s > max_sum:
-            max_sum = s
-            best_end = -end
-    return float(best_end) / X
-
-
 def affinealign(reference, targets, max_drift=0.02):
-    """ EXPERIMENTAL FUNCTION.
-
-    Perform an affine registration between a reference and a number of
-    targets.  Designed for aligning the amplitude envelopes of recordings of
-    the same event by different devices.
-
-    NOTE: This method is currently NOT USED by Pitivi, as it has proven both
-    unnecessary and unusable.  So far every test case has been registered
-    successfully by rigidalign, and until Pitivi supports time-stretching of
-    audio, the drift calculation cannot actually be used.
-
-    @param reference: the reference signal to which others will be registered
-    @type reference: array(number)
-    @param targets: the signals to register
-    @type targets: ordered iterable(array(number))
-    @param max_drift: the maximum absolute clock drift rate
-                  (i.e. stretch factor) that will be considered during search
-    @type max_drift: positive L{float}
-    @return: (offsets, drifts).  offsets[i] is the point in reference at which
-           targets[i] starts.  drifts[i] is the speed of targets[i] relative to
-           the reference (positive is faster, meaning the target should be
-           slowed down to be in sync with the reference)
+    """Estimates the shift and the clock drift between reference and targets.
+
+    Designed for aligning the amplitude envelopes of recordings of the same
+    event by devices with slightly different clocks. Each target is split
+    in blocks which are matched separately with the reference, all of them
+    with a single batched FFT. The line going through the most matches
+    gives the shift and the drift of the target.
+
+    Args:
+        reference (numpy.ndarray): The signal to which the others will be
+            registered.
+        targets (List[numpy.ndarray]): The signals to register.
+        max_drift (float): The maximum absolute clock drift rate (i.e.
+            stretch factor) that will be considered during search.
+
+    Returns:
+        tuple: The offsets and the drifts. offsets[i] is the point in
+        reference at which targets[i] starts. drifts[i] is the speed of
+        targets[i] relative to the reference (positive is faster, meaning
+        the target should be slowed down to be in sync with the reference).
     """
-    L = len(reference) + max(len(t) for t in targets) - 1
-    L2 = nextpow2(L)
-    bsize = int(20. / max_drift)  # NEEDS TUNING
-    num_blocks = nextpow2(1.0 * len(reference) // bsize)  # NEEDS TUNING
-    bspace = (len(reference) - bsize) // num_blocks
-    reference -= numpy.mean(reference)
-
-    # Construct FFT'd reference blocks
-    freference_blocks = numpy.zeros((L2 / 2 + 1, num_blocks),
-                                    dtype=numpy.complex)
-    for i in range(num_blocks):
-        s = i * bspace
-        tmp = numpy.zeros((L2,))
-        tmp[s:s + bsize] = reference[s:s + bsize]
-        freference_blocks[:, i] = numpy.fft.rfft(tmp, L2).conj()
-    freference_blocks[:10, :] = 0  # High-pass to ignore slow volume variations
-
+    reference = numpy.asarray(reference, dtype=numpy.float64)
+    reference = reference - numpy.mean(reference)
     offsets = []
     drifts = []
     for t in targets:
-        t -= numpy.mean(t)
-        ft = numpy.fft.rfft(t, L2)
-        # fxcorr is the FFT'd cross-correlation with the reference blocks
-        fxcorr_blocks = numpy.zeros((L2 / 2 + 1, num_blocks),
-                                    dtype=numpy.complex)
-        for i in range(num_blocks):
-            fxcorr_blocks[:, i] = ft * freference_blocks[:, i]
-            fxcorr_blocks[:, i] /= numpy.sqrt(
-                numpy.sum(fxcorr_blocks[:, i] ** 2))
-        del ft
-        # At this point xcorr_blocks would show a distinct bright line, nearly
-        # orthogonal to time, indicating where each of these blocks found their
-        # peak.  Each point on this line represents the time in t where block i
-        # found its match.  The time-intercept gives the time in b at which the
-        # reference starts, and the slope gives the amount by which the
-        # reference is faster relative to b.
-
-        # The challenge now is to find this line.  Our strategy is to reduce the
-        # search to one dimension by first finding the slope.
-        # The Fourier Transform of a smooth real line in 2D is an orthogonal
-        # line through the origin, with phase that gives its position.
-        # Unfortunately this line is not clearly visible in fxcorr_blocks, so
-        # we discard the phase (by taking the absolute value) and then inverse
-        # transform.  This places the line at the origin, so we can find its
-        # slope.
-
-        # Construct the half-autocorrelation matrix
-        # (A true autocorrelation matrix would be ifft(abs(fft(x))**2), but this
-        # is just ifft(abs(fft(x))).)
-        # Construction is stepwise partly in an attempt to save memory
-        # The width is 2*num_blocks in order to avoid overlapping positive and
-        # negative correlations
-        halfautocorr = numpy.fft.fft(fxcorr_blocks, 2 * num_blocks, 1)
-        halfautocorr = numpy.abs(halfautocorr)
-        halfautocorr = numpy.fft.ifft(halfautocorr, None, 1)
-        halfautocorr = numpy.fft.irfft(halfautocorr, None, 0)
-        # Now it's actually the half-autocorrelation.
-        # Chop out the bit we don't care about
-        halfautocorr = halfautocorr[:bspace * num_blocks * max_drift, :]
-        # Remove the local-correlation peak.
-        halfautocorr[-1:2, -1:2] = 0  # NEEDS TUNING
-        # Normalize each column (appears to be necessary)
-        for i in range(2 * num_blocks):
-            halfautocorr[:, i] /= numpy.sqrt(
-                numpy.sum(halfautocorr[:, i] ** 2))
-        # from matplotlib.pyplot import imshow,show
-        # imshow(halfautocorr,interpolation='nearest',aspect='auto');show()
-        drift = _findslope(halfautocorr) / bspace
-        del halfautocorr
-
-        # inverse transform and shift everything into alignment
-        xcorr_blocks = numpy.fft.irfft(fxcorr_blocks, None, 0)
-        del fxcorr_blocks
-        # TODO: see if phase ramps are worthwhile here
-        for i in range(num_blocks):
-            blockcenter = i * bspace + bsize / 2
-            shift = int(blockcenter * drift)
-            if shift > 0:
-                temp = xcorr_blocks[:shift, i].copy()
-                xcorr_blocks[:-shift, i] = xcorr_blocks[shift:, i].copy()
-                xcorr_blocks[-shift:, i] = temp
-            elif shift < 0:
-                temp = xcorr_blocks[shift:, i].copy()
-                xcorr_blocks[-shift:, i] = xcorr_blocks[:shift, i].copy()
-                xcorr_blocks[:-shift, i] = temp
-
-        # from matplotlib.pyplot import imshow,show
-        # imshow(xcorr_blocks,interpolation='nearest',aspect='auto');show()
-
-        # xcorr is the drift-compensated cross-correlation
-        xcorr = numpy.sum(xcorr_blocks, axis=1)
-        del xcorr_blocks
-
-        offset = numpy.argmax(xcorr)
-        # from matplotlib.pyplot import plot,show
-        # plot(xcorr);show()
-        del xcorr
-        if offset >= len(t):
-            offset -= L2
-
-        # now offset is the point in target at which reference starts and
-        # drift is the speed with which the reference drifts relative to the
-        # target.  We reverse these relationships for the caller.
-        slope = 1 + drift
-        offsets.append(-offset / slope)
-        drifts.append(1 / slope - 1)
+        t = numpy.asarray(t, dtype=numpy.float64)
+        if len(t) < 2 * AFFINE_MIN_BLOCK_SIZE:
+            # Too short for matching blocks reliably.
+            offsets.extend(rigidalign(reference, [t]))
+            drifts.append(0.0)
+            continue
+        num_blocks = min(len(t) // AFFINE_MIN_BLOCK_SIZE, AFFINE_MAX_BLOCKS)
+        bsize = len(t) // num_blocks
+
+        blocks = t[:num_blocks * bsize].reshape(num_blocks, bsize)
+        blocks = blocks - numpy.mean(blocks, axis=1)[:, None]
+        positions = _match_blocks(reference, blocks)
+        centers = numpy.arange(num_blocks) * bsize + bsize / 2
+        # The position in the reference of the center of each block.
+        positions += bsize / 2
+
+        # The drifts considered, the smallest first, spaced so that each
+        # one moves the end of the target by at most one sample.
+        step = 1 / len(t)
+        candidates = numpy.arange(-max_drift, max_drift + step / 2, step)
+        candidates = candidates[numpy.argsort(numpy.abs(candidates), kind="stable")]
+        # The position in the reference of the start of the target,
+        # according to each block, for each drift.
+        intercepts = positions - centers * (1 + candidates[:, None])
+        agree = numpy.abs(intercepts[:, :, None] - intercepts[:, None, :]) \
+            <= AFFINE_TOLERANCE
+        # The number of blocks agreeing with each block, for each drift.
+        votes = agree.sum(axis=2)
+        best_drift, best_block = numpy.unravel_index(numpy.argmax(votes),
+                                                     votes.shape)
+        inliers = agree[best_drift, best_block]
+        if inliers.sum() < 2:
+            # The blocks don't agree on any line, so a single block would
+            # give a spurious match.
+            offsets.extend(rigidalign(reference, [t]))
+            drifts.append(0.0)
+            continue
+        slope, offset = numpy.polyfit(centers[inliers], positions[inliers], 1)
+        offsets.append(float(offset))
+        drifts.append(float(slope - 1))
     return offsets, drifts
 
 
+def _match_blocks(reference, blocks):
+    """Finds where each block matches best the reference.
+
+    Args:
+        reference (numpy.ndarray): The reference signal, with zero mean.
+        blocks (numpy.ndarray): The blocks, one per row, with zero mean.
+
+    Returns:
+        numpy.ndarray: The position in the reference of the start of each
+        block, with subsample precision.
+    """
+    bsize = blocks.shape[1]
+    L = nextpow2(len(reference) + bsize - 1)
+    # xcorr[i, k] is the dot product of blocks[i] and reference[k:].
+    xcorr = _irfft(_rfft(reference, L) * _rfft(blocks, L).conj(), L)
+    shift = numpy.argmax(xcorr, axis=1)
+    rows = numpy.arange(len(blocks))
+    subsample_shift = submax(xcorr[rows, (shift - 1) % L],
+                             xcorr[rows, shift],
+                             xcorr[rows, (shift + 1) % L])
+    shift = shift + subsample_shift
+    # Negative shifts appear large and positive
+    return numpy.where(shift >= len(reference), shift - L, shift)
+
+
 def getAudioTrack(clip):
     """
     Helper function for getting an audio track from a Clip
 
     @param clip: The Clip from which to locate an audio track
-    @type clip: L{Clip}
+    @type clip: L{GES.Clip}
     @returns: An audio track from clip, or None if clip has no audio track
-    @rtype: audio L{TrackElement} or L{NoneType}
+    @rtype: audio L{GES.TrackElement} or L{NoneType}
     """
-    for track in clip.track_elements:
-        if track.stream_type == AudioStream:
-            return track
+    for track_element in clip.get_children(False):
+        if track_element.get_track_type() == GES.TrackType.AUDIO:
+            return track_element
     return None
 
 
+def resample_envelope(samples, start, duration, blockrate):
+    """Extracts the envelope of a clip from the waveform of its asset.
+
+    Args:
+        samples (numpy.ndarray): The waveform samples of the entire asset,
+            one every `SAMPLE_DURATION`.
+        start (int): The inpoint of the clip, in nanoseconds.
+        duration (int): The duration of the clip, in nanoseconds.
+        blockrate (int): The number of envelope blocks per second.
+
+    Returns:
+        numpy.ndarray: The envelope of the clip, one value per block.
+    """
+    first = int(start / SAMPLE_DURATION)
+    end = int((start + duration) / SAMPLE_DURATION)
+    clip_samples = numpy.asarray(samples[first:end], dtype=numpy.float32)
+    samples_per_second = Gst.SECOND / SAMPLE_DURATION
+    factor = samples_per_second / blockrate
+    if factor == int(factor):
+        return decimate(clip_samples, int(factor))
+
+    # Interpolate at the centers of the blocks.
+    n_blocks = int(len(clip_samples) * blockrate // samples_per_second)
+    positions = (numpy.arange(n_blocks) + 0.5) * factor - 0.5
+    return numpy.interp(positions, numpy.arange(len(clip_samples)),
+                        clip_samples).astype(numpy.float32)
+
+
+def get_cached_envelope(audiotrack, blockrate):
+    """Gets the envelope of a clip from the cached waveform, if any.
+
+    The waveforms are extracted by the audio previewers of the timeline,
+    so they are usually available for the clips being aligned.
+
+    Args:
+        audiotrack (GES.TrackElement): The audio track element of the clip.
+        blockrate (int): The number of envelope blocks per second.
+
+    Returns:
+        numpy.ndarray: The envelope of the clip, or None if the waveform
+        of its asset has not been extracted yet.
+    """
+    uri = quote_uri(get_proxy_target(audiotrack).props.id)
+    levels = load_waveform(get_wavefile_location_for_uri(uri))
+    if levels is None:
+        return None
+    return resample_envelope(levels[0][RMS_ROW], audiotrack.props.in_point,
+                             audiotrack.props.duration, blockrate)
+
+
 class ProgressMeter:
 
     """Abstract interface representing a progress meter."""
@@ -382,6 +497,8 @@ class ProgressAggregator(ProgressMeter):
         if total_target == 0:
             return False
         frac = min(1.0, float(total_completed) / total_target)
+        if frac == 0:
+            return False
         now = time.time()
         remaining = (now - self._start) * (1 - frac) / frac
         for function in self._watchers:
@@ -389,80 +506,103 @@ class ProgressAggregator(ProgressMeter):
         return False
 
 
-class EnvelopeExtractee(Extractee, Loggable):
+class WaveformExtractor(Loggable):
 
-    """Class that computes the envelope of a 1-D signal (audio).
+    """Extracts the waveform of an asset into the previews cache.
 
-    The envelope is defined as the sum of the absolute value of the signal
-    over each block.  This class computes the envelope incrementally,
-    so that the entire signal does not ever need to be stored.
+    The waveform is extracted as for the audio previewers, by a pipeline
+    which is not synchronized on the clock, so the asset is decoded as
+    fast as possible.
 
     """
 
-    def __init__(self, blocksize, callback, *cbargs):
+    PROGRESS_INTERVAL = 500
+    """
+    @ivar PROGRESS_INTERVAL: The interval in milliseconds between the
+        progress updates.
+    """
+
+    def __init__(self, uri, duration, callback):
         """
-        @param blocksize: the number of samples in a block
-        @type blocksize: L{int}
-        @param callback: a function to call when the extraction is complete.
-            The function's first argument will be a numpy array
-            representing the envelope, and any later argument to this
-            function will be passed as subsequent arguments to callback.
+        @param uri: the URI of the asset
+        @type uri: L{str}
+        @param duration: the duration of the asset, in nanoseconds
+        @type duration: L{int}
+        @param callback: a function to call on the main thread when the
+            extraction is complete, with this object as argument.
+        @type callback: function
 
         """
         Loggable.__init__(self)
-        self._blocksize = blocksize
-        self._cb = callback
-        self._cbargs = cbargs
-        self._blocks = numpy.zeros((0,), dtype=numpy.float32)
-        self._empty = array.array('f', [])
-        # self._samples buffers up to self._threshold samples, before
-        # their envelope is computed and store in self._blocks, in order
-        # to amortize some of the function call overheads.
-        self._samples = array.array('f', [])
-        self._threshold = 2000 * blocksize
+        self.uri = uri
+        self.duration = duration
+        self._callback = callback
         self._progress_watchers = []
-
-    def receive(self, a):
-        self._samples.extend(a)
-        if len(self._samples) < self._threshold:
-            return
-        else:
-            self._process_samples()
+        self._progress_id = 0
+        self.pipeline = None
+        self._wavebin = None
 
     def addWatcher(self, w):
         """
         Add a function to call with progress updates.
 
         @param w: callback function
-        @type w: function(# of samples received so far)
+        @type w: function(# of nanoseconds extracted so far)
 
         """
         self._progress_watchers.append(w)
 
-    def _process_samples(self):
-        excess = len(self._samples) % self._blocksize
-        if excess != 0:
-            samples_to_process = self._samples[:-excess]
-            self._samples = self._samples[-excess:]
-        else:
-            samples_to_process = self._samples
-            self._samples = array.array('f', [])
-        self.debug("Adding %s samples to %s blocks",
-                   len(samples_to_process), len(self._blocks))
-        newblocks = len(samples_to_process) // self._blocksize
-        samples_abs = numpy.abs(
-            samples_to_process).reshape((newblocks, self._blocksize))
-        self._blocks.resize((len(self._blocks) + newblocks,))
-        # This numpy.sum() call relies on samples_abs being a
-        # floating-point type. If samples_abs.dtype is int16
-        # then the sum may overflow.
-        self._blocks[-newblocks:] = numpy.sum(samples_abs, 1)
-        for w in self._progress_watchers:
-            w(self._blocksize * len(self._blocks) + excess)
-
-    def finalize(self):
-        self._process_samples()  # absorb any remaining buffered samples
-        self._cb(self._blocks, *self._cbargs)
+    def start(self):
+        """Starts the extraction."""
+        self.debug("Extracting the waveform of %s", self.uri)
+        self.pipeline = Gst.parse_launch(
+            "uridecodebin name=decode uri=%s ! pcmwaveformbin name=wave ! "
+            "fakesink sync=false qos=false" % self.uri)
+        self._wavebin = self.pipeline.get_by_name("wave")
+        self._wavebin.props.uri = self.uri
+        self._wavebin.props.duration = self.duration
+        decode = self.pipeline.get_by_name("decode")
+        decode.connect("autoplug-select", self._autoplugSelectCb)
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self._busMessageCb)
+        self.pipeline.set_state(Gst.State.PLAYING)
+        self._progress_id = GLib.timeout_add(self.PROGRESS_INTERVAL,
+                                             self._progressCb)
+
+    def _progressCb(self):
+        res, position = self.pipeline.query_position(Gst.Format.TIME)
+        if res:
+            for w in self._progress_watchers:
+                w(position)
+        return True
+
+    def _busMessageCb(self, unused_bus, message):
+        if message.type == Gst.MessageType.EOS:
+            self._wavebin.finalize()
+            for w in self._progress_watchers:
+                w(self.duration)
+            self._finish()
+        elif message.type == Gst.MessageType.ERROR:
+            self.warning("Failed extracting the waveform of %s: %s",
+                         self.uri, message.parse_error())
+            self._finish()
+
+    def _finish(self):
+        GLib.source_remove(self._progress_id)
+        self._progress_id = 0
+        self.pipeline.set_state(Gst.State.NULL)
+        self.pipeline.get_bus().remove_signal_watch()
+        self.pipeline = None
+        self._wavebin = None
+        self._callback(self)
+
+    # pylint: disable=no-self-use
+    def _autoplugSelectCb(self, unused_decode, unused_pad, unused_caps, factory):
+        # Don't plug video decoders / parsers.
+        if "Video" in factory.get_klass():
+            return True
+        return False
 
 
 class AutoAligner(Loggable):
@@ -493,7 +633,30 @@ class AutoAligner(Loggable):
 
     """
 
-    def __init__(self, clips, callback):
+    MAX_JOBS = multiprocessing.cpu_count()
+    """
+    @ivar MAX_JOBS: The maximum number of waveforms extracted concurrently.
+    """
+
+    MAX_OFFSET = None
+    """
+    @ivar MAX_OFFSET: The maximum shift in seconds considered when aligning
+        the clips, or None to consider all the shifts.
+    """
+
+    MAX_DRIFT = 0.02
+    """
+    @ivar MAX_DRIFT: The maximum clock drift rate considered when aligning
+        the clips with the drift compensation.
+    """
+
+    COARSE_MIN_LENGTH = 64 * COARSE_DECIMATION
+    """
+    @ivar COARSE_MIN_LENGTH: The number of blocks of the reference envelope
+        from which the clips are aligned with coarse_to_fine_rigidalign.
+    """
+
+    def __init__(self, clips, callback, compensate_drift=False):
         """
         @param clips: an iterable of L{Clip}s.
             In this implementation, only L{Clip}s with at least one
@@ -502,18 +665,28 @@ class AutoAligner(Loggable):
         @param callback: A function to call when alignment is complete.  No
             arguments will be provided.
         @type callback: function
+        @param compensate_drift: Whether to estimate the clock drift of the
+            recordings with affinealign.  The clips cannot be stretched, so
+            each one is placed to have the smallest error over its duration.
+        @type compensate_drift: L{bool}
 
         """
         Loggable.__init__(self)
+        self._compensate_drift = compensate_drift
         # self._clips maps each object to its envelope.  The values
         # are initially None prior to envelope extraction.
         self._clips = dict.fromkeys(clips)
         self._callback = callback
-        # stack of (Track, Extractee) pairs waiting to be processed
-        # When start() is called, the stack will be populated, and then
-        # processed sequentially.  Only one item from the stack will be
-        # actively in process at a time.
-        self._extraction_stack = []
+        # The WaveformExtractors waiting to be started.  When start() is
+        # called, the queue will be populated, and then processed by up
+        # to MAX_JOBS extractors at a time.
+        self._extraction_queue = []
+        self._running_extractors = []
+        # The WaveformExtractors made redundant by a running audio previewer.
+        self._waiting_extractors = []
+        # The (Clip, {audio}TrackElement) pairs waiting for the waveform
+        # of their asset, by URI.
+        self._pending_clips = {}
 
     @staticmethod
     def canAlign(clips):
@@ -534,22 +707,65 @@ class AutoAligner(Loggable):
         # use the AutoAligner, which will crash immediately.
         return all(getAudioTrack(t) is not None for t in clips)
 
-    def _extractNextEnvelope(self):
-        audiotrack, extractee = self._extraction_stack.pop()
-        r = RandomAccessAudioExtractor(audiotrack.factory,
-                                       audiotrack.stream)
-        r.extract(extractee, audiotrack.in_point,
-                  audiotrack.out_point - audiotrack.in_point)
+    def _startExtractions(self):
+        if not self._extraction_queue and not self._running_extractors and \
+                not self._waiting_extractors:
+            # This was the last envelope
+            return self._envelopesReadyCb()
+
+        queue = self._extraction_queue
+        self._extraction_queue = []
+        for extractor in queue:
+            previewer = Previewer.manager.get_running_previewer(
+                GES.TrackType.AUDIO, extractor.uri)
+            if previewer is None:
+                self._extraction_queue.append(extractor)
+                continue
+            # The audio previewer is already writing the waveform file
+            # we need, wait for it instead of decoding the asset twice.
+            self.debug("Waiting for the audio previewer of %s", extractor.uri)
+            previewer.connect("done", self._previewerDoneCb, extractor)
+            self._waiting_extractors.append(extractor)
+
+        while self._extraction_queue and \
+                len(self._running_extractors) < self.MAX_JOBS:
+            extractor = self._extraction_queue.pop(0)
+            self._running_extractors.append(extractor)
+            extractor.start()
         return False
 
-    def _envelopeCb(self, array, clip):
-        self.debug("Receiving envelope for %s", clip)
-        self._clips[clip] = array
-        if self._extraction_stack:
-            self._extractNextEnvelope()
-        else:  # This was the last envelope
+    def _previewerDoneCb(self, previewer, extractor):
+        previewer.disconnect_by_func(self._previewerDoneCb)
+        self._waiting_extractors.remove(extractor)
+        clips = self._pending_clips[extractor.uri]
+        if any(get_cached_envelope(audiotrack, self.BLOCKRATE) is None
+               for unused_clip, audiotrack in clips):
+            # The previewer failed or it has been stopped.
+            self._extraction_queue.append(extractor)
+            self._startExtractions()
+        else:
+            self._setEnvelopes(extractor.uri)
+
+    def _waveformExtractedCb(self, extractor):
+        self._running_extractors.remove(extractor)
+        self._setEnvelopes(extractor.uri)
+
+    def _setEnvelopes(self, uri):
+        for clip, audiotrack in self._pending_clips.pop(uri):
+            envelope = get_cached_envelope(audiotrack, self.BLOCKRATE)
+            if envelope is None:
+                self.warning("Could not get the envelope of %s", clip)
+                self._clips.pop(clip)
+            else:
+                self.debug("Receiving envelope for %s", clip)
+                self._clips[clip] = envelope
+        self._startExtractions()
+
+    def _envelopesReadyCb(self):
+        if len(self._clips) >= 2:
             self._performShifts()
-            self._callback()
+        self._callback()
+        return False
 
     def start(self):
         """
@@ -570,28 +786,36 @@ class AutoAligner(Loggable):
                 self._clips.pop(clip)
         if len(pairs) >= 2:
             for clip, audiotrack in pairs:
-                # blocksize is the number of samples per block
-                blocksize = audiotrack.stream.rate // self.BLOCKRATE
-                extractee = EnvelopeExtractee(
-                    blocksize, self._envelopeCb, clip)
-                # numsamples is the total number of samples in the track,
-                # which is used by progress_aggregator to determine
-                # the percent completion.
-                numsamples = ((audiotrack.duration / Gst.SECOND) *
-                              audiotrack.stream.rate)
-                extractee.addWatcher(
-                    progress_aggregator.getPortionCB(numsamples))
-                self._extraction_stack.append((audiotrack, extractee))
+                # Reuse the waveform extracted for the audio previewer,
+                # which is much faster than decoding the clip again.
+                envelope = get_cached_envelope(audiotrack, self.BLOCKRATE)
+                if envelope is not None:
+                    self.debug("Using the cached waveform of %s", clip)
+                    self._clips[clip] = envelope
+                    continue
+                # The clips of an asset share the extracted waveform.
+                uri = quote_uri(get_proxy_target(audiotrack).props.id)
+                if uri not in self._pending_clips:
+                    duration = get_proxy_target(audiotrack).get_duration()
+                    extractor = WaveformExtractor(
+                        uri, duration, self._waveformExtractedCb)
+                    # The progress_aggregator determines the percent
+                    # completion from the duration of each asset.
+                    extractor.addWatcher(
+                        progress_aggregator.getPortionCB(duration))
+                    self._extraction_queue.append(extractor)
+                    self._pending_clips[uri] = []
+                self._pending_clips[uri].append((clip, audiotrack))
             # After we return, start the extraction cycle.
             # This GLib.idle_add call should not be necessary;
-            # we should be able to invoke _extractNextEnvelope directly
+            # we should be able to invoke _startExtractions directly
             # here.  However, there is some as-yet-unexplained
             # race condition between the Python GIL, GTK UI updates,
             # GLib mainloop, and pygst multithreading, resulting in
             # occasional deadlocks during autoalignment.
             # This call to idle_add() reportedly eliminates the deadlock.
             # No one knows why.
-            GLib.idle_add(self._extractNextEnvelope)
+            GLib.idle_add(self._startExtractions)
         else:  # We can't do anything without at least two audio tracks
             # After we return, call the callback function (once)
             GLib.idle_add(call_false, self._callback)
@@ -611,7 +835,7 @@ class AutoAligner(Loggable):
 
         """
         def priority(clip):
-            return clip.priority
+            return clip.props.priority
         return min(iter(self._clips.keys()), key=priority)
 
     def _performShifts(self):
@@ -625,23 +849,40 @@ class AutoAligner(Loggable):
         # (In python 3, dict.items() returns an unordered dictview)
         pairs = list(self._clips.items())
         envelopes = [p[1] for p in pairs]
-        offsets = rigidalign(reference_envelope, envelopes)
+        max_offset = None
+        if self.MAX_OFFSET is not None:
+            max_offset = int(self.MAX_OFFSET * self.BLOCKRATE)
+        if self._compensate_drift:
+            offsets, drifts = affinealign(reference_envelope, envelopes,
+                                          self.MAX_DRIFT)
+            for i, (envelope, drift) in enumerate(zip(envelopes, drifts)):
+                # The offset is exact at the start of the clip and the
+                # error grows with the drift, so split it between the
+                # start and the end.
+                self.debug("Clip drift: %f", drift)
+                offsets[i] += drift * len(envelope) / 2
+        elif len(reference_envelope) >= self.COARSE_MIN_LENGTH:
+            offsets = coarse_to_fine_rigidalign(reference_envelope, envelopes,
+                                                max_offset)
+        else:
+            offsets = rigidalign(reference_envelope, envelopes, max_offset)
+        reference_start = reference.props.start
         for (movable, envelope), offset in zip(pairs, offsets):
             # tshift is the offset rescaled to units of nanoseconds
             tshift = int((offset * Gst.SECOND) / self.BLOCKRATE)
             self.debug("Shifting %s to %i ns from %i",
-                       movable, tshift, reference.start)
-            newstart = reference.start + tshift
+                       movable, tshift, reference_start)
+            newstart = reference_start + tshift
             if newstart >= 0:
-                movable.start = newstart
+                movable.set_start(newstart)
             else:
                 # Timeline objects always must have a positive start point, so
                 # if alignment would move an object to start at negative time,
                 # we instead make it start at zero and chop off the required
                 # amount at the beginning.
-                movable.start = 0
-                movable.in_point = movable.in_point - newstart
-                movable.duration += newstart
+                movable.set_start(0)
+                movable.set_inpoint(movable.props.in_point - newstart)
+                movable.set_duration(movable.props.duration + newstart)
 
 
 class AlignmentProgressDialog:
@@ -1,5 +1,6 @@
 #include <Python.h>
 #include <stdio.h>
+#include <string.h>
 #include <cairo.h>
 #include <py3cairo.h>
 #include <gst/gst.h>
@@ -7,6 +8,107 @@
 static Pycairo_CAPI_t *Pycairo_CAPI;
 static GObjectClass * gobject_class;
 
+/*
+ * The samples passed to the renderers. Objects exposing the buffer protocol
+ * with float or double items, for example numpy arrays or memoryviews of a
+ * mapped waveform file, are read in place. Other sequences are converted
+ * once to an array of doubles.
+ */
+typedef struct
+{
+  Py_buffer view;
+  gboolean has_view;
+  const float *floats;
+  const double *doubles;
+  double *converted;
+  Py_ssize_t length;
+} Samples;
+
+static gboolean
+samples_init (Samples * samples, PyObject * obj)
+{
+  const char *format;
+  PyObject *fast;
+  Py_ssize_t i;
+
+  memset (samples, 0, sizeof (Samples));
+
+  if (PyObject_CheckBuffer (obj)) {
+    if (PyObject_GetBuffer (obj, &samples->view,
+            PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0)
+      return FALSE;
+    samples->has_view = TRUE;
+
+    /* Skip the byte order and size markers, if they match the host. */
+    format = samples->view.format ? samples->view.format : "B";
+    if (*format == '@' || *format == '=')
+      format++;
+#if PY_LITTLE_ENDIAN
+    else if (*format == '<')
+      format++;
+#else
+    else if (*format == '>' || *format == '!')
+      format++;
+#endif
+
+    if (g_strcmp0 (format, "f") == 0) {
+      samples->floats = samples->view.buf;
+      samples->length = samples->view.len / sizeof (float);
+      return TRUE;
+    } else if (g_strcmp0 (format, "d") == 0) {
+      samples->doubles = samples->view.buf;
+      samples->length = samples->view.len / sizeof (double);
+      return TRUE;
+    }
+
+    PyErr_Format (PyExc_TypeError,
+        "Unsupported samples format \"%s\", expected float or double",
+        format);
+    PyBuffer_Release (&samples->view);
+    samples->has_view = FALSE;
+    return FALSE;
+  }
+
+  fast = PySequence_Fast (obj, "The samples must be a sequence of floats");
+  if (fast == NULL)
+    return FALSE;
+
+  samples->length = PySequence_Fast_GET_SIZE (fast);
+  samples->converted = g_new (double, MAX (samples->length, 1));
+  for (i = 0; i < samples->length; i++) {
+    samples->converted[i] =
+        PyFloat_AsDouble (PySequence_Fast_GET_ITEM (fast, i));
+    /* If the object was not a float or convertible to float */
+    if (PyErr_Occurred ()) {
+      Py_DECREF (fast);
+      g_free (samples->converted);
+      samples->converted = NULL;
+      return FALSE;
+    }
+  }
+  Py_DECREF (fast);
+  samples->doubles = samples->converted;
+
+  return TRUE;
+}
+
+static inline double
+samples_get (const Samples * samples, Py_ssize_t i)
+{
+  if (samples->floats)
+    return samples->floats[i];
+  return samples->doubles[i];
+}
+
+static void
+samples_clear (Samples * samples)
+{
+  if (samples->has_view)
+    PyBuffer_Release (&samples->view);
+  g_free (samples->converted);
+  memset (samples, 0, sizeof (Samples));
+}
+
 /*
  * This function must be called with a range of samples, and a desired
  * width and height.
@@ -15,10 +117,9 @@ static GObjectClass * gobject_class;
 static PyObject *
 py_fill_surface (PyObject * self, PyObject * args)
 {
-  PyObject *samples;
-  PyObject *sampleObj;
-  int length, i;
-  double sample;
+  PyObject *samples_obj;
+  Samples samples;
+  Py_ssize_t length, i;
   cairo_surface_t *surface;
   cairo_t *ctx;
   int width, height;
@@ -28,10 +129,13 @@ py_fill_surface (PyObject * self, PyObject * args)
   float x = 0.;
   double accum;
 
-  if (!PyArg_ParseTuple (args, "O!ii", &PyList_Type, &samples, &width, &height))
+  if (!PyArg_ParseTuple (args, "Oii", &samples_obj, &width, &height))
     return NULL;
 
-  length = PyList_Size (samples);
+  if (!samples_init (&samples, samples_obj))
+    return NULL;
+
+  length = samples.length;
 
   surface = cairo_image_surface_create (CAIRO_FORMAT_ARGB32, width, height);
 
@@ -46,21 +150,11 @@ py_fill_surface (PyObject * self, PyObject * args)
   samplesInAccum = 0;
   accum = 0.;
 
+  Py_BEGIN_ALLOW_THREADS;
   for (i = 0; i < length; i++) {
-    /* Guaranteed to return something */
-    sampleObj = PyList_GetItem (samples, i);
-    sample = PyFloat_AsDouble (sampleObj);
-
-    /* If the object was not a float or convertible to float */
-    if (PyErr_Occurred ()) {
-      cairo_surface_finish (surface);
-      Py_DECREF (samples);
-      return NULL;
-    }
-
     currentPixel += pixelsPerSample;
     samplesInAccum += 1;
-    accum += sample;
+    accum += samples_get (&samples, i);
     if (currentPixel > 1.0) {
       accum /= samplesInAccum;
       cairo_line_to (ctx, x, height - accum);
@@ -71,16 +165,135 @@ py_fill_surface (PyObject * self, PyObject * args)
     x += pixelsPerSample;
   }
 
-  Py_DECREF (samples);
   cairo_line_to (ctx, width, height);
   cairo_close_path (ctx);
   cairo_fill_preserve (ctx);
+  Py_END_ALLOW_THREADS;
+
+  samples_clear (&samples);
+  cairo_destroy (ctx);
+
+  return PycairoSurface_FromSurface (surface, NULL);
+}
+
+/*
+ * This function must be called with the peak samples and the RMS samples
+ * of a range, which have the same length, and a desired width and height.
+ * It will draw, for each pixel column, the maximum of the peak samples it
+ * covers, so the transients are not averaged out, and over it the average
+ * of the RMS samples it covers.
+ */
+static PyObject *
+py_fill_envelope_surface (PyObject * self, PyObject * args)
+{
+  PyObject *peaks_obj, *rms_obj;
+  Samples peaks, rms;
+  Py_ssize_t length, i;
+  cairo_surface_t *surface;
+  cairo_t *ctx;
+  int width, height;
+  int column;
+  double *maxs, *sums;
+  int *counts;
+  gboolean started;
+
+  if (!PyArg_ParseTuple (args, "OOii", &peaks_obj, &rms_obj, &width, &height))
+    return NULL;
+
+  if (width <= 0 || height <= 0) {
+    PyErr_SetString (PyExc_ValueError, "The surface size must be positive");
+    return NULL;
+  }
+
+  if (!samples_init (&peaks, peaks_obj))
+    return NULL;
+
+  if (!samples_init (&rms, rms_obj)) {
+    samples_clear (&peaks);
+    return NULL;
+  }
+
+  if (peaks.length != rms.length) {
+    PyErr_SetString (PyExc_ValueError,
+        "The peak and the RMS samples must have the same length");
+    samples_clear (&peaks);
+    samples_clear (&rms);
+    return NULL;
+  }
+
+  length = peaks.length;
+
+  surface = cairo_image_surface_create (CAIRO_FORMAT_ARGB32, width, height);
+
+  ctx = cairo_create (surface);
+
+  cairo_set_line_width (ctx, 0.5);
+
+  Py_BEGIN_ALLOW_THREADS;
+  maxs = g_new0 (double, width);
+  sums = g_new0 (double, width);
+  counts = g_new0 (int, width);
+
+  for (i = 0; i < length; i++) {
+    column = (int) ((double) i * width / length);
+    if (counts[column] == 0 || samples_get (&peaks, i) > maxs[column])
+      maxs[column] = samples_get (&peaks, i);
+    sums[column] += samples_get (&rms, i);
+    counts[column]++;
+  }
+
+  /* The peaks, lighter. */
+  cairo_set_source_rgba (ctx, 0.2, 0.6, 0.0, 0.5);
+  started = FALSE;
+  for (column = 0; column < width; column++) {
+    if (counts[column] == 0)
+      /* No sample in this column, when zoomed in. */
+      continue;
+    if (!started) {
+      cairo_move_to (ctx, column, height);
+      started = TRUE;
+    }
+    cairo_line_to (ctx, column, height - maxs[column]);
+  }
+  if (started) {
+    cairo_line_to (ctx, width, height);
+    cairo_close_path (ctx);
+    cairo_fill (ctx);
+  }
+
+  /* The RMS values. */
+  cairo_set_source_rgb (ctx, 0.2, 0.6, 0.0);
+  started = FALSE;
+  for (column = 0; column < width; column++) {
+    if (counts[column] == 0)
+      continue;
+    if (!started) {
+      cairo_move_to (ctx, column, height);
+      started = TRUE;
+    }
+    cairo_line_to (ctx, column, height - sums[column] / counts[column]);
+  }
+  if (started) {
+    cairo_line_to (ctx, width, height);
+    cairo_close_path (ctx);
+    cairo_fill_preserve (ctx);
+  }
+
+  g_free (maxs);
+  g_free (sums);
+  g_free (counts);
+  Py_END_ALLOW_THREADS;
+
+  samples_clear (&peaks);
+  samples_clear (&rms);
+  cairo_destroy (ctx);
 
   return PycairoSurface_FromSurface (surface, NULL);
 }
 
 static PyMethodDef renderer_methods[] = {
   {"fill_surface", py_fill_surface, METH_VARARGS},
+  {"fill_envelope_surface", py_fill_envelope_surface, METH_VARARGS},
   {NULL, NULL}
 };
 
@@ -30,6 +30,8 @@ from gi.repository import Gtk
 from gi.repository import Pango
 
 from pitivi.settings import GlobalSettings
+from pitivi.timeline.previewers import get_media_info
+from pitivi.timeline.previewers import save_media_info
 from pitivi.utils.loggable import Loggable
 from pitivi.utils.misc import uri_is_valid
 from pitivi.utils.pipeline import AssetPipeline
@@ -190,7 +192,11 @@ class PreviewWidget(Gtk.Grid, Loggable):
         self.clear_preview()
         self.current_selected_uri = uri
 
-        if not self._discover_sync:
+        info = get_media_info(uri)
+        if info:
+            self.log("Using the saved info of %s", uri)
+            self._handle_info(uri, info)
+        elif not self._discover_sync:
             GES.UriClipAsset.new(uri, None, self.__asset_loaded_cb)
         else:
             self._handle_new_asset(uri=uri)
@@ -208,7 +214,12 @@ class PreviewWidget(Gtk.Grid, Loggable):
             return
 
         self.log("Discovered %s", uri)
-        if not self._show_preview(uri, asset.get_info()):
+        if Gst.uri_has_protocol(uri, "file"):
+            save_media_info(asset)
+        self._handle_info(uri, asset.get_info())
+
+    def _handle_info(self, uri, info):
+        if not self._show_preview(uri, info):
             return
         if self.play_on_discover:
             self.play_on_discover = False
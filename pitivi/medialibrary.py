@@ -232,6 +232,16 @@ class AssetThumbnail(Loggable):
                 else:
                     # Build or reuse a ThumbnailCache.
                     thumb_cache = ThumbnailCache.get(self.__asset)
+                    large_thumb = thumb_cache.get_library_thumbnail()
+                    if large_thumb:
+                        # Extracted while creating the proxy.
+                        width = large_thumb.props.width
+                        height = large_thumb.props.height
+                        small_thumb = large_thumb.scale_simple(
+                            SMALL_THUMB_WIDTH,
+                            SMALL_THUMB_WIDTH * height / width,
+                            GdkPixbuf.InterpType.BILINEAR)
+                        return small_thumb, large_thumb
                     small_thumb = thumb_cache.getPreviewThumbnail()
                     if not small_thumb:
                         small_thumb, large_thumb = self.__get_icons("video-x-generic")
@@ -36,6 +36,7 @@ from pitivi.configure import get_ui_dir
 from pitivi.preset import AudioPresetManager
 from pitivi.preset import VideoPresetManager
 from pitivi.render import Encoders
+from pitivi.timeline.previewers import save_media_info
 from pitivi.undo.project import AssetAddedIntention
 from pitivi.undo.project import AssetProxiedIntention
 from pitivi.utils.loggable import Loggable
@@ -1115,6 +1116,9 @@ class Project(Loggable, GES.Project):
             self.debug("Ignoring asset: %s", asset.props.id)
             return
 
+        if Gst.uri_has_protocol(asset.get_id(), "file"):
+            save_media_info(asset)
+
         if asset not in self.loading_assets:
             self.debug("Asset %s is not in loading assets, "
                        " it must not be proxied", asset.get_id())
@@ -17,10 +17,14 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 """Previewers for the timeline."""
-import os
-import pickle
-import random
+import bisect
+import collections
+import concurrent.futures
+import math
+import multiprocessing
+import queue
 import sqlite3
+import threading
 
 import cairo
 import numpy
@@ -30,20 +34,30 @@ from gi.repository import GES
 from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gst
+from gi.repository import GstPbutils
 from gi.repository import Gtk
 
-from pitivi.settings import get_dir
+from pitivi.settings import GlobalSettings
 from pitivi.settings import xdg_cache_home
+from pitivi.utils.cache import PreviewsStore
 from pitivi.utils.loggable import Loggable
 from pitivi.utils.misc import binary_search
 from pitivi.utils.misc import get_proxy_target
-from pitivi.utils.misc import hash_file
 from pitivi.utils.misc import path_from_uri
 from pitivi.utils.misc import quantize
 from pitivi.utils.misc import quote_uri
 from pitivi.utils.system import CPUUsageTracker
+from pitivi.utils.threads import Thread
 from pitivi.utils.timeline import Zoomable
 from pitivi.utils.ui import EXPANDED_SIZE
+from pitivi.utils.ui import LARGE_THUMB_WIDTH
+from pitivi.utils.waveform import build_pyramid
+from pitivi.utils.waveform import choose_level
+from pitivi.utils.waveform import LevelsAccumulator
+from pitivi.utils.waveform import load_waveform
+from pitivi.utils.waveform import PcmAccumulator
+from pitivi.utils.waveform import RMS_ROW
+from pitivi.utils.waveform import save_waveform
 
 # Our C module optimizing waveforms rendering
 try:
@@ -60,6 +74,22 @@ SAMPLE_DURATION = Gst.SECOND / 100
 THUMBNAILS_CPU_USAGE = 20
 
 THUMB_MARGIN_PX = 3
+# The memory used by the decoded thumbnails kept by all the ThumbnailCaches.
+THUMBNAILS_MEMORY_BUDGET = 64 * 1024 * 1024
+# The number of threads encoding and decoding the thumbnails.
+THUMBNAILS_CODEC_THREADS = 2
+# The minimum number of consecutive missing thumbnails generated by playing
+# the video through, instead of seeking for each of them.
+STREAMING_MIN_THUMBS = 3
+# The maximum number of thumbnails generated by playing the video through
+# at once, so the thumbnails the user looks at are not delayed for long.
+STREAMING_MAX_THUMBS = 20
+# The seconds after which playing through the thumbnails without getting
+# any of them is given up.
+STREAMING_TIMEOUT = 5
+# The maximum number of idle prerolled thumbnailing pipelines kept for
+# being reused by the next previewer of the same asset.
+IDLE_PIPELINES_MAX = 4
 # For the waveforms, ensures we always have a little extra surface when
 # scrolling while playing.
 MARGIN = 500
@@ -70,6 +100,194 @@ PREVIEW_GENERATOR_SIGNALS = {
 }
 
 THUMB_HEIGHT = EXPANDED_SIZE - 2 * THUMB_MARGIN_PX
+# The interval between the thumbnails of the clips. When zoomed out, the
+# timeline shows thumbnails at multiples of this interval.
+THUMB_PERIOD = int(0.5 * Gst.SECOND)
+
+
+class WaveformsEngine:
+    """The ways of extracting the waveforms of the audio clips."""
+
+    # The RMS values posted by the `level` element, with the pipeline
+    # running in real time, its rate modulated by a PipelineCpuAdapter.
+    LEVEL = "level"
+    # The RMS values computed from the decoded samples, with the pipeline
+    # running as fast as the decoding allows. The CPU usage is limited by
+    # the number of jobs run concurrently by the PreviewGeneratorManager.
+    PCM = "pcm"
+
+
+class ThumbnailsScaling:
+    """The methods of scaling the video frames to thumbnails.
+
+    The values are the nicks of the methods of the `videoscale` element.
+    """
+
+    # The fastest, but the thumbnails are aliased.
+    NEAREST = "nearest-neighbour"
+    BILINEAR = "bilinear"
+    # The sharpest, but by far the slowest for such small thumbnails.
+    LANCZOS = "lanczos"
+
+
+GlobalSettings.addConfigSection("previewers")
+GlobalSettings.addConfigOption("waveformsEngine",
+                               section="previewers",
+                               key="waveforms-engine",
+                               default=WaveformsEngine.LEVEL)
+GlobalSettings.addConfigOption("previewersMaxJobs",
+                               section="previewers",
+                               key="max-jobs-per-track-type",
+                               default=max(1, multiprocessing.cpu_count() // 2))
+GlobalSettings.addConfigOption("thumbnailsScalingMethod",
+                               section="previewers",
+                               key="thumbnails-scaling-method",
+                               default=ThumbnailsScaling.BILINEAR,
+                               notify=True)
+# The number of threads of each video decoder, 0 for the decoder's default.
+GlobalSettings.addConfigOption("thumbnailsDecoderThreads",
+                               section="previewers",
+                               key="thumbnails-decoder-threads",
+                               default=0,
+                               notify=True)
+# Whether the decoders supporting it decode the videos at half resolution.
+GlobalSettings.addConfigOption("thumbnailsDecoderLowres",
+                               section="previewers",
+                               key="thumbnails-decoder-lowres",
+                               default=False,
+                               notify=True)
+# The size in MiB of the previews kept on disk.
+GlobalSettings.addConfigOption("previewsCacheMaxSize",
+                               section="previewers",
+                               key="cache-max-size",
+                               default=2048)
+
+# The PreviewsStore by cache directory, for the main thread.
+_previews_stores = {}
+
+
+def hash_uri(uri):
+    """Gets the key of the previews of the specified asset.
+
+    Args:
+        uri (str): The URI of the asset.
+
+    Returns:
+        str: The hash of the file, memoized by the previews store.
+    """
+    return get_previews_store().get_hash(Gst.uri_get_location(uri))
+
+
+def set_previews_alias(uri, target_uri):
+    """Makes an asset use the previews of another asset.
+
+    Args:
+        uri (str): The URI of the asset, usually a proxy.
+        target_uri (str): The URI of the asset owning the previews.
+    """
+    store = get_previews_store()
+    store.set_alias(hash_uri(uri), store.resolve(hash_uri(target_uri)))
+
+
+def save_media_info(asset):
+    """Saves the info of the specified discovered asset, if not saved yet.
+
+    Args:
+        asset (GES.UriClipAsset): The asset.
+    """
+    path = Gst.uri_get_location(asset.get_id())
+    store = get_previews_store()
+    if store.get_media_info(path) is not None:
+        return
+    info = asset.get_info()
+    variant = info.to_variant(GstPbutils.DiscovererSerializeFlags.ALL)
+    store.set_media_info(path, variant.print_(True))
+
+
+def get_media_info(uri):
+    """Gets the saved info of the specified file, if it did not change since.
+
+    Args:
+        uri (str): The URI of the file.
+
+    Returns:
+        GstPbutils.DiscovererInfo: The info, or None if it's not available.
+    """
+    if not Gst.uri_has_protocol(uri, "file"):
+        return None
+    try:
+        text = get_previews_store().get_media_info(Gst.uri_get_location(uri))
+    except (OSError, sqlite3.Error):
+        return None
+    if text is None:
+        return None
+    try:
+        variant = GLib.Variant.parse(None, text, None, None)
+    except GLib.Error:
+        return None
+    return GstPbutils.DiscovererInfo.from_variant(variant)
+
+
+def get_previews_store():
+    """Gets the store of the previews in the cache directory.
+
+    Returns:
+        PreviewsStore: The store, to be used only in the main thread.
+    """
+    cache_dir = xdg_cache_home()
+    if cache_dir not in _previews_stores:
+        _previews_stores[cache_dir] = PreviewsStore(cache_dir)
+    return _previews_stores[cache_dir]
+
+
+class PreviewsCachePruner(Thread):
+    """Thread evicting the least recently used previews from the disk."""
+
+    def __init__(self, max_size):
+        Thread.__init__(self)
+        self.max_size = max_size
+
+    def process(self):
+        try:
+            store = PreviewsStore(xdg_cache_home())
+            try:
+                evicted = store.prune(self.max_size)
+                self.debug("Evicted the previews of %d assets", len(evicted))
+            finally:
+                store.close()
+        except (sqlite3.Error, OSError) as e:
+            self.warning("Failed to prune the previews cache: %s", e)
+
+
+def _get_framerate(period):
+    """Gets the framerate producing a frame every `period` nanoseconds.
+
+    Returns:
+        str: The framerate, as "numerator/denominator".
+    """
+    divisor = math.gcd(Gst.SECOND, period)
+    return "%d/%d" % (Gst.SECOND // divisor, period // divisor)
+
+
+def get_thumbnail_scaler(size, method=ThumbnailsScaling.BILINEAR):
+    """Gets the description of the elements making thumbnails out of frames.
+
+    The frames are scaled in their own format, so only the thumbnails are
+    converted to RGBA.
+
+    Args:
+        size (str): The caps fields constraining the size of the thumbnails,
+            for example "height=(int)50".
+        method (str): One of the `ThumbnailsScaling` methods.
+
+    Returns:
+        str: The description of the elements, to be used with
+        `Gst.parse_launch`.
+    """
+    return ("videoscale method=%s ! "
+            "capsfilter caps=video/x-raw,%s,pixel-aspect-ratio=(fraction)1/1 ! "
+            "videoconvert ! capsfilter caps=video/x-raw,format=(string)RGBA" %
+            (method, size))
 
 
 class PreviewerBin(Gst.Bin, Loggable):
@@ -89,7 +307,12 @@ class PreviewerBin(Gst.Bin, Loggable):
 
 
 class ThumbnailBin(PreviewerBin):
-    """Bin to generate and save thumbnails to an SQLite database."""
+    """Bin to generate and save thumbnails to an SQLite database.
+
+    Besides the thumbnails shown in the timeline, it can also extract the
+    thumbnail shown in the media library, from the frame in the middle of
+    the video, if the bin description contains a `librarysink`.
+    """
 
     __gproperties__ = {
         "uri": (str,
@@ -97,19 +320,37 @@ class ThumbnailBin(PreviewerBin):
                 "A URI",
                 "",
                 GObject.PARAM_READWRITE),
+        "duration": (GObject.TYPE_UINT64,
+                     "Duration",
+                     "Duration",
+                     0, GLib.MAXUINT64 - 1, 0, GObject.PARAM_READWRITE)
     }
 
-    def __init__(self, bin_desc="videoconvert ! videorate ! "
-                 "videoscale method=lanczos ! "
-                 "capsfilter caps=video/x-raw,format=(string)RGBA,"
-                 "height=(int)%d,pixel-aspect-ratio=(fraction)1/1,"
-                 "framerate=2/1 ! gdkpixbufsink name=gdkpixbufsink " %
-                 THUMB_HEIGHT):
+    def __init__(self, bin_desc="videorate ! "
+                 "capsfilter caps=video/x-raw,framerate=(fraction)%s ! %s ! "
+                 "gdkpixbufsink name=gdkpixbufsink sync=false " %
+                 (_get_framerate(THUMB_PERIOD),
+                  get_thumbnail_scaler("height=(int)%d" % THUMB_HEIGHT))):
         PreviewerBin.__init__(self, bin_desc)
 
         self.uri = None
+        self.duration = 0
         self.thumb_cache = None
         self.gdkpixbufsink = self.internal_bin.get_by_name("gdkpixbufsink")
+        self.librarysink = self.internal_bin.get_by_name("librarysink")
+        self.__library_thumb_taken = False
+        if self.librarysink:
+            pad = self.internal_bin.get_by_name("libraryqueue").get_static_pad("src")
+            pad.add_probe(Gst.PadProbeType.BUFFER, self.__library_probe_cb)
+
+    def __library_probe_cb(self, unused_pad, info):
+        # Let through only the first frame from the middle of the video.
+        if self.__library_thumb_taken:
+            return Gst.PadProbeReturn.DROP
+        if info.get_buffer().pts < self.duration / 2:
+            return Gst.PadProbeReturn.DROP
+        self.__library_thumb_taken = True
+        return Gst.PadProbeReturn.OK
 
     def __addThumbnail(self, message):
         struct = message.get_structure()
@@ -122,11 +363,21 @@ class ThumbnailBin(PreviewerBin):
 
         return False
 
+    def __add_library_thumbnail(self, message):
+        struct = message.get_structure()
+        if struct.get_name() in ("pixbuf", "preroll-pixbuf"):
+            self.log("%s new media library thumbnail", self.uri)
+            self.thumb_cache.set_library_thumbnail(struct.get_value("pixbuf"))
+
+        return False
+
     # pylint: disable=arguments-differ
     def do_post_message(self, message):
-        if message.type == Gst.MessageType.ELEMENT and \
-                message.src == self.gdkpixbufsink:
-            GLib.idle_add(self.__addThumbnail, message)
+        if message.type == Gst.MessageType.ELEMENT:
+            if message.src == self.gdkpixbufsink:
+                GLib.idle_add(self.__addThumbnail, message)
+            elif self.librarysink and message.src == self.librarysink:
+                GLib.idle_add(self.__add_library_thumbnail, message)
 
         return Gst.Bin.do_post_message(self, message)
 
@@ -139,6 +390,8 @@ class ThumbnailBin(PreviewerBin):
     def do_get_property(self, prop):
         if prop.name == 'uri':
             return self.uri
+        elif prop.name == 'duration':
+            return self.duration
         else:
             raise AttributeError('unknown property %s' % prop.name)
 
@@ -146,27 +399,42 @@ class ThumbnailBin(PreviewerBin):
         if prop.name == 'uri':
             self.uri = value
             self.thumb_cache = ThumbnailCache.get(self.uri)
+        elif prop.name == 'duration':
+            self.duration = value
         else:
             raise AttributeError('unknown property %s' % prop.name)
 
 
 class TeedThumbnailBin(ThumbnailBin):
-    """Bin to generate and save thumbnails to an SQLite database."""
+    """Bin to generate and save thumbnails to an SQLite database.
+
+    It lets the video through, so it can be used as the video filter of the
+    proxy transcoding pipeline. The frames are extracted at `THUMB_PERIOD`,
+    which covers all the thumbnails the timeline can request, and at the
+    height of the timeline thumbnails. The frame in the middle of the video
+    is also extracted at the size of the media library thumbnails, so the
+    previews of a freshly proxied asset don't need decoding it again.
+    """
 
     def __init__(self):
         ThumbnailBin.__init__(
             self, bin_desc="tee name=t ! queue  "
             "max-size-buffers=0 max-size-bytes=0 max-size-time=0  ! "
-            "videoconvert ! videorate ! videoscale method=lanczos ! "
-            "capsfilter caps=video/x-raw,format=(string)RGBA,height=(int)%d,"
-            "pixel-aspect-ratio=(fraction)1/1,"
-            "framerate=2/1 ! gdkpixbufsink name=gdkpixbufsink "
-            "t. ! queue " % THUMB_HEIGHT)
+            "videorate ! capsfilter caps=video/x-raw,framerate=(fraction)%s ! "
+            "tee name=thumbs ! queue ! %s ! "
+            "gdkpixbufsink name=gdkpixbufsink sync=false "
+            "thumbs. ! queue name=libraryqueue ! %s ! "
+            # Not waiting for a frame to preroll, as it gets a single frame.
+            "gdkpixbufsink name=librarysink sync=false async=false "
+            "t. ! queue " % (
+                _get_framerate(THUMB_PERIOD),
+                get_thumbnail_scaler("height=(int)%d" % THUMB_HEIGHT),
+                get_thumbnail_scaler("width=(int)%d" % LARGE_THUMB_WIDTH)))
 
 
 # pylint: disable=too-many-instance-attributes
 class WaveformPreviewer(PreviewerBin):
-    """Bin to generate and save waveforms as a pickle file."""
+    """Bin to generate and save waveforms as a memory-mappable file."""
 
     __gproperties__ = {
         "uri": (str,
@@ -180,21 +448,20 @@ class WaveformPreviewer(PreviewerBin):
                      0, GLib.MAXUINT64 - 1, 0, GObject.PARAM_READWRITE)
     }
 
-    def __init__(self):
-        PreviewerBin.__init__(self,
-                              "audioconvert ! audioresample ! level name=level"
-                              " ! audioconvert ! audioresample")
+    def __init__(self, bin_desc="audioconvert ! audioresample ! level name=level"
+                 " ! audioconvert ! audioresample"):
+        PreviewerBin.__init__(self, bin_desc)
         self.level = self.internal_bin.get_by_name("level")
         self.debug("Creating waveforms!!")
-        self.peaks = None
+        self.accumulator = None
 
         self.uri = None
         self.wavefile = None
         self.passthrough = False
         self.samples = []
+        self.levels = []
         self.n_samples = 0
         self.duration = 0
-        self.prev_pos = 0
 
     def do_get_property(self, prop):
         if prop.name == 'uri':
@@ -208,7 +475,7 @@ class WaveformPreviewer(PreviewerBin):
         if prop.name == 'uri':
             self.uri = value
             self.wavefile = get_wavefile_location_for_uri(self.uri)
-            self.passthrough = os.path.exists(self.wavefile)
+            self.passthrough = load_waveform(self.wavefile) is not None
         elif prop.name == 'duration':
             self.duration = value
             self.n_samples = self.duration / SAMPLE_DURATION
@@ -221,86 +488,170 @@ class WaveformPreviewer(PreviewerBin):
                 message.type == Gst.MessageType.ELEMENT and \
                 message.src == self.level:
             struct = message.get_structure()
-            peaks = None
+            rms_values = None
             if struct:
-                peaks = struct.get_value("rms")
+                rms_values = struct.get_value("rms")
 
-            if peaks:
+            if rms_values:
                 stream_time = struct.get_value("stream-time")
 
-                if self.peaks is None:
-                    self.peaks = []
-                    for unused_channel in peaks:
-                        self.peaks.append([0] * int(self.n_samples))
+                if self.accumulator is None:
+                    self.accumulator = LevelsAccumulator(self.n_samples,
+                                                         len(rms_values))
 
                 pos = int(stream_time / SAMPLE_DURATION)
-                if pos >= len(self.peaks[0]):
-                    return
-
-                for i, val in enumerate(peaks):
-                    if val < 0:
-                        val = 10 ** (val / 20) * 100
-                    else:
-                        val = self.peaks[i][pos - 1]
-
-                    # Linearly joins values between to known samples
-                    # values
-                    unknowns = range(self.prev_pos + 1, pos)
-                    if len(unknowns):
-                        prev_val = self.peaks[i][self.prev_pos]
-                        linear_const = (val - prev_val) / len(unknowns)
-                        for temppos in unknowns:
-                            self.peaks[i][temppos] = self.peaks[i][temppos - 1] + linear_const
-
-                    self.peaks[i][pos] = val
-
-                self.prev_pos = pos
+                self.accumulator.add(pos, rms_values, struct.get_value("peak"))
 
         return Gst.Bin.do_post_message(self, message)
 
     def finalize(self, proxy=None):
         """Finalizes the previewer, saving data to file if needed."""
-        if not self.passthrough and self.peaks:
+        if not self.passthrough and self.accumulator is not None:
             # Let's go mono.
-            if len(self.peaks) > 1:
-                samples = (numpy.array(self.peaks[0]) + numpy.array(self.peaks[1])) / 2
-            else:
-                samples = numpy.array(self.peaks[0])
-
-            self.samples = list(samples)
-            with open(self.wavefile, 'wb') as wavefile:
-                pickle.dump(list(samples), wavefile)
+            self.levels = build_pyramid(self.accumulator.get_samples(),
+                                        self.accumulator.get_peaks())
+            self.samples = self.levels[0][RMS_ROW]
+            save_waveform(self.wavefile, self.levels)
 
         if proxy:
-            proxy_wavefile = get_wavefile_location_for_uri(proxy.get_id())
-            self.debug("symlinking %s and %s", self.wavefile, proxy_wavefile)
-            try:
-                os.remove(proxy_wavefile)
-            except FileNotFoundError:
-                pass
-            os.symlink(self.wavefile, proxy_wavefile)
+            set_previews_alias(proxy.get_id(), self.uri)
+
+
+class PcmWaveformPreviewer(WaveformPreviewer):
+    """Bin to generate waveforms from the RMS values of the decoded samples.
+
+    It does not depend on the timing of the `level` element messages,
+    so the pipeline does not need to run in real time.
+    """
+
+    def __init__(self):
+        WaveformPreviewer.__init__(
+            self, "audioconvert ! capsfilter caps=audio/x-raw,"
+            "format=(string)F32LE,layout=(string)interleaved ! "
+            "identity name=tap")
+        tap = self.internal_bin.get_by_name("tap")
+        tap.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER,
+                                             self.__buffer_probe_cb)
+
+    def __buffer_probe_cb(self, pad, info):
+        if self.passthrough:
+            return Gst.PadProbeReturn.OK
+
+        caps = pad.get_current_caps()
+        if not caps:
+            return Gst.PadProbeReturn.OK
+        struct = caps.get_structure(0)
+        n_channels = struct.get_value("channels")
+        if self.accumulator is None:
+            self.accumulator = PcmAccumulator(self.n_samples, n_channels,
+                                              struct.get_value("rate"))
+
+        buf = info.get_buffer()
+        offset = None
+        if buf.pts != Gst.CLOCK_TIME_NONE:
+            offset = Gst.util_uint64_scale(buf.pts, self.accumulator.rate,
+                                           Gst.SECOND)
+
+        success, map_info = buf.map(Gst.MapFlags.READ)
+        if not success:
+            self.warning("Could not map buffer %s", buf)
+            return Gst.PadProbeReturn.OK
+        try:
+            frames = numpy.frombuffer(map_info.data, dtype="<f4")
+            self.accumulator.add(frames.reshape(-1, n_channels), offset)
+        finally:
+            buf.unmap(map_info)
+
+        return Gst.PadProbeReturn.OK
 
 
 Gst.Element.register(None, "waveformbin", Gst.Rank.NONE,
                      WaveformPreviewer)
+Gst.Element.register(None, "pcmwaveformbin", Gst.Rank.NONE,
+                     PcmWaveformPreviewer)
 Gst.Element.register(None, "thumbnailbin", Gst.Rank.NONE,
                      ThumbnailBin)
 Gst.Element.register(None, "teedthumbnailbin", Gst.Rank.NONE,
                      TeedThumbnailBin)
 
 
-# pylint: disable=too-few-public-methods
-class PreviewGeneratorManager():
-    """Manager for running the previewers."""
+class PreviewGeneratorManager(Loggable):
+    """Manager for running the previewers.
+
+    Runs concurrently up to `previewersMaxJobs` previewers of each
+    GES.TrackType, or a single one while the project is playing. The pending
+    previewers are started in the order of the distance of their clips from
+    the timeline viewport, then from the playhead.
+
+    A single previewer runs at a time for each asset. The previews are
+    shared by all the clips of the asset, so when the previewers of the
+    other clips start, most of what they need is already available.
+    """
 
     def __init__(self):
-        # The current Previewer per GES.TrackType.
-        self._current_previewers = {}
-        # The queue of Previewers.
+        Loggable.__init__(self)
+        # The running Previewers per GES.TrackType.
+        self._running_previewers = {
+            GES.TrackType.AUDIO: [],
+            GES.TrackType.VIDEO: []
+        }
+        # The queue of Previewers per GES.TrackType.
         self._previewers = {
             GES.TrackType.AUDIO: [],
             GES.TrackType.VIDEO: []
         }
+        self._settings = None
+        # Whether the user is busy, for example playing the project.
+        self._busy = False
+        # The time range visible in the timeline.
+        self._viewport = (0, 0)
+        self._playhead_position = 0
+
+    def _get_max_jobs(self):
+        if self._busy:
+            return 1
+        if self._settings:
+            return max(1, self._settings.previewersMaxJobs)
+        return GlobalSettings.previewersMaxJobs
+
+    def set_busy(self, busy):
+        """Sets whether the previews generation should back off.
+
+        Args:
+            busy (bool): Whether the user is interacting with the app, in which
+                case a single previewer per track type is run at a time.
+        """
+        if self._busy == busy:
+            return
+        self._busy = busy
+        self.debug("User busy: %s", busy)
+        if not busy:
+            for track_type in self._previewers:
+                self._start_pending_previewers(track_type)
+
+    def set_viewport(self, start, end, playhead_position):
+        """Sets the area of interest of the user in the timeline.
+
+        The pending previewers are prioritized when they are started, so the
+        new viewport applies to the previewers already in the queue.
+
+        Args:
+            start (int): The time at the left edge of the timeline viewport.
+            end (int): The time at the right edge of the timeline viewport.
+            playhead_position (int): The position of the playhead.
+        """
+        self._viewport = (start, end)
+        self._playhead_position = playhead_position
+
+    def _get_priority(self, previewer):
+        """Gets the sorting key of the specified pending previewer."""
+        start = previewer.ges_elem.props.start
+        end = start + previewer.ges_elem.props.duration
+        view_start, view_end = self._viewport
+        viewport_distance = max(0, view_start - end, start - view_end)
+        playhead_distance = max(0, self._playhead_position - end,
+                                start - self._playhead_position)
+        return viewport_distance, playhead_distance
 
     def add_previewer(self, previewer):
         """Adds the specified previewer to the queue.
@@ -309,41 +660,84 @@ class PreviewGeneratorManager():
             previewer (Previewer): The previewer to control.
         """
         track_type = previewer.track_type
-
-        current = self._current_previewers.get(track_type)
-        if previewer in self._previewers[track_type] or previewer is current:
+        if previewer in self._previewers[track_type] or \
+                previewer in self._running_previewers[track_type]:
             # Already in the queue or already processing.
             return
 
-        if not self._previewers[track_type] and current is None:
+        if self._settings is None:
+            self._settings = previewer.timeline.app.settings
+        self._previewers[track_type].append(previewer)
+        self._start_pending_previewers(track_type)
+
+    def remove_previewer(self, previewer):
+        """Removes the specified previewer from the queue, if pending.
+
+        Args:
+            previewer (Previewer): The previewer which is not needed anymore.
+        """
+        pending = self._previewers[previewer.track_type]
+        if previewer in pending:
+            self.log("Cancelling pending previewer %s", previewer)
+            pending.remove(previewer)
+
+    def get_running_previewer(self, track_type, uri):
+        """Gets a running previewer of the specified asset, if any.
+
+        Args:
+            track_type (GES.TrackType): The type of the previews.
+            uri (str): The URI of the asset.
+
+        Returns:
+            Previewer: A previewer processing the asset, or None.
+        """
+        for previewer in self._running_previewers[track_type]:
+            if previewer.uri == uri:
+                return previewer
+        return None
+
+    def _start_pending_previewers(self, track_type):
+        pending = self._previewers[track_type]
+        running = self._running_previewers[track_type]
+        while pending and len(running) < self._get_max_jobs():
+            running_uris = {previewer.uri for previewer in running}
+            startable = [previewer for previewer in pending
+                         if previewer.uri not in running_uris]
+            if not startable:
+                break
+            # The closest to the viewport first, in the order they were added.
+            previewer = min(startable, key=self._get_priority)
+            pending.remove(previewer)
             self._start_previewer(previewer)
-        else:
-            self._previewers[track_type].insert(0, previewer)
 
     def _start_previewer(self, previewer):
-        self._current_previewers[previewer.track_type] = previewer
+        self._running_previewers[previewer.track_type].append(previewer)
         previewer.connect("done", self.__previewer_done_cb)
         previewer.startGeneration()
 
     def __previewer_done_cb(self, previewer):
         track_type = previewer.track_type
-        next_previewer = self._current_previewers.pop(track_type, None)
-        if next_previewer:
-            next_previewer.disconnect_by_func(self.__previewer_done_cb)
+        running = self._running_previewers[track_type]
+        if previewer in running:
+            running.remove(previewer)
+            previewer.disconnect_by_func(self.__previewer_done_cb)
 
-        if self._previewers[track_type]:
-            self._start_previewer(self._previewers[track_type].pop())
+        self._start_pending_previewers(track_type)
 
 
 class Previewer(Gtk.Layout):
     """Base class for previewers.
 
+    The subclasses must have the `ges_elem`, `timeline` and `uri` attributes.
+
     Attributes:
         track_type (GES.TrackType): The type of content.
+        manager (PreviewGeneratorManager): The manager shared by all
+            the previewers.
     """
 
     # We only need one PreviewGeneratorManager to manage all previewers.
-    __manager = PreviewGeneratorManager()
+    manager = PreviewGeneratorManager()
 
     def __init__(self, track_type):
         Gtk.Layout.__init__(self)
@@ -360,25 +754,87 @@ class Previewer(Gtk.Layout):
 
     def becomeControlled(self):
         """Lets the PreviewGeneratorManager control our execution."""
-        Previewer.__manager.add_previewer(self)
+        Previewer.manager.add_previewer(self)
 
     def setSelected(self, selected):
         """Marks this instance as being selected."""
         pass
 
 
+class IdlePipelines(object):
+    """Keeps the most recently used idle pipelines, for reusing them.
+
+    Attributes:
+        max_pipelines (int): The number of pipelines kept.
+    """
+
+    def __init__(self, max_pipelines):
+        self.max_pipelines = max_pipelines
+        # The (uri, pipeline, data) tuples, the least recently used first.
+        self._entries = []
+
+    def park(self, uri, pipeline, data):
+        """Keeps the specified pipeline, stopping the oldest ones if needed.
+
+        Args:
+            uri (str): The URI of the asset processed by the pipeline.
+            pipeline (Gst.Pipeline): The idle pipeline.
+            data (object): The data to be retrieved with the pipeline.
+        """
+        self._entries.append((uri, pipeline, data))
+        while len(self._entries) > self.max_pipelines:
+            unused_uri, old_pipeline, unused_data = self._entries.pop(0)
+            old_pipeline.set_state(Gst.State.NULL)
+
+    def take(self, uri):
+        """Removes a pipeline processing the specified asset.
+
+        Args:
+            uri (str): The URI of the asset.
+
+        Returns:
+            tuple: The pipeline and its data, or None if there is none.
+        """
+        for index in range(len(self._entries) - 1, -1, -1):
+            if self._entries[index][0] == uri:
+                unused_uri, pipeline, data = self._entries.pop(index)
+                return pipeline, data
+        return None
+
+    def clear(self):
+        """Stops all the pipelines."""
+        for unused_uri, pipeline, unused_data in self._entries:
+            pipeline.set_state(Gst.State.NULL)
+        self._entries = []
+
+
 class VideoPreviewer(Previewer, Zoomable, Loggable):
     """A video previewer widget, drawing thumbnails.
 
+    The consecutive missing thumbnails are generated by playing the video
+    through the range once, the other ones by seeking accurately to each
+    of them. When the thumbnails are further apart than the keyframes, they
+    are snapped to the nearest keyframe, which is much faster, and they are
+    replaced with accurate thumbnails when the user zooms in.
+
+    The thumbnails stored in the cache of the asset by the previewers of
+    the other clips are shown as well. When done, the prerolled pipeline
+    is kept in `idle_pipelines` for the next previewer of the same asset.
+
     Attributes:
         ges_elem (GES.TrackElement): The previewed element.
-        thumbs (dict): Maps (quantized) times to Thumbnail objects.
+        thumbs (dict): Maps the (quantized) times of the visible portion of
+            the clip to the pixbufs to be drawn, or None if not available.
         thumb_cache (ThumbnailCache): The pixmaps persistent cache.
+        decoded_frames (int): The number of frames decoded by the pipeline.
+        generated_thumbs (int): The number of thumbnails generated.
     """
 
     # We could define them in Previewer, but for some reason they are ignored.
     __gsignals__ = PREVIEW_GENERATOR_SIGNALS
 
+    idle_pipelines = IdlePipelines(IDLE_PIPELINES_MAX)
+
     def __init__(self, ges_elem):
         Previewer.__init__(self, GES.TrackType.VIDEO)
         Zoomable.__init__(self)
@@ -396,10 +852,22 @@ class VideoPreviewer(Previewer, Zoomable, Loggable):
         self.queue = []
         self._thumb_cb_id = None
         self._running = False
+        # Whether the pipeline is seeking to a single thumbnail.
+        self._seeking = False
+        # The time of the fast thumbnail the pipeline is seeking to.
+        self._fast_seek_time = None
+        # The longest observed interval between consecutive keyframes.
+        self._gop_duration = None
+        self._last_keyframe_time = None
+        # The times of the thumbnails the pipeline is playing through.
+        self._streamed_times = []
+        self._streaming = False
+        self._streaming_timeout_id = None
+        self.decoded_frames = 0
+        self.generated_thumbs = 0
 
         # We should have one thumbnail per thumb_period.
-        # TODO: get this from the user settings
-        self.thumb_period = int(0.5 * Gst.SECOND)
+        self.thumb_period = THUMB_PERIOD
         self.thumb_height = THUMB_HEIGHT
 
         self.__image_pixbuf = None
@@ -408,7 +876,11 @@ class VideoPreviewer(Previewer, Zoomable, Loggable):
                 Gst.uri_get_location(self.uri), -1, self.thumb_height, True)
 
         self.thumbs = {}
+        # The keys of `thumbs`, sorted.
+        self._positions = []
+        self._opacity = 1.0
         self.thumb_cache = ThumbnailCache.get(self.uri)
+        self.thumb_cache.add_listener(self._thumb_stored_cb)
         self._ensure_proxy_thumbnails_cache()
         self.thumb_width, unused_height = self.thumb_cache.getImagesSize()
 
@@ -416,34 +888,71 @@ class VideoPreviewer(Previewer, Zoomable, Loggable):
         self.interval = 500  # Every 0.5 second, reevaluate the situation
 
         # Connect signals and fire things up
-        self.ges_elem.connect("notify::in-point", self._inpoint_changed_cb)
+        self._inpoint_changed_cb_id = self.ges_elem.connect(
+            "notify::in-point", self._inpoint_changed_cb)
 
+        self._settings = self.timeline.app.settings
         self.pipeline = None
         self.gdkpixbufsink = None
+        # The (object, handler ID) of the signals connected on the pipeline.
+        self._pipeline_handlers = []
+        # The (pad, probe ID) of the probes on the pipeline.
+        self._decoder_probes = []
         self.becomeControlled()
 
         self.connect("notify::height-request", self._heightChangedCb)
 
     # Internal API
     def _setupPipeline(self):
-        """Creates the pipeline.
+        """Creates the pipeline, or reuses an idle one of the same asset."""
+        parked = self.idle_pipelines.take(self.uri)
+        if parked:
+            self.debug("Reusing a prerolled pipeline for: %s", path_from_uri(self.uri))
+            self.pipeline, (self.thumb_width, gop_duration) = parked
+            if gop_duration:
+                self._update_gop_duration(gop_duration)
+            for element in self.pipeline.iterate_recurse():
+                factory = element.get_factory()
+                if factory and "Decoder/Video" in factory.get_klass():
+                    self._add_decoder_probe(element)
+        else:
+            self._create_pipeline()
+
+        self.gdkpixbufsink = self.pipeline.get_by_name("gdkpixbufsink")
+        decode = self.pipeline.get_by_name("decode")
+        bus = self.pipeline.get_bus()
+        # pop all messages from the bus so we won't be flooded with messages
+        # from the prerolling phase or from the previous owner
+        while bus.pop():
+            continue
+        # add a message handler that listens for the created pixbufs
+        self._pipeline_handlers.extend([
+            (self.pipeline, self.pipeline.connect("deep-element-added",
+                                                  self._deep_element_added_cb)),
+            (decode, decode.connect("autoplug-select", self._autoplugSelectCb)),
+            (bus, bus.connect("message", self.__bus_message_handler))])
+
+    def _create_pipeline(self):
+        """Creates and prerolls the pipeline.
 
-        It has the form "playbin ! thumbnailsink" where thumbnailsink
-        is a Bin made out of "videorate ! capsfilter ! gdkpixbufsink"
+        It has the form "uridecodebin ! videorate ! scaler ! gdkpixbufsink".
         """
-        # TODO: don't hardcode framerate
+        # One frame per thumb_period, so when playing through a range of
+        # the video, each frame ends up being a thumbnail.
         self.pipeline = Gst.parse_launch(
             "uridecodebin uri={uri} name=decode ! "
-            "videoconvert ! "
             "videorate ! "
-            "videoscale method=lanczos ! "
-            "capsfilter caps=video/x-raw,format=(string)RGBA,height=(int){height},"
-            "pixel-aspect-ratio=(fraction)1/1,framerate=2/1 ! "
-            "gdkpixbufsink name=gdkpixbufsink".format(uri=self.uri, height=self.thumb_height))
+            "capsfilter caps=video/x-raw,framerate=(fraction){framerate} ! "
+            "{scaler} ! "
+            "gdkpixbufsink name=gdkpixbufsink sync=false".format(
+                uri=self.uri, framerate=_get_framerate(self.thumb_period),
+                scaler=get_thumbnail_scaler("height=(int)%d" % self.thumb_height,
+                                            self._settings.thumbnailsScalingMethod)))
+        handler_id = self.pipeline.connect("deep-element-added",
+                                           self._deep_element_added_cb)
 
         # get the gdkpixbufsink and the sinkpad
-        self.gdkpixbufsink = self.pipeline.get_by_name("gdkpixbufsink")
-        sinkpad = self.gdkpixbufsink.get_static_pad("sink")
+        sinkpad = self.pipeline.get_by_name("gdkpixbufsink").get_static_pad("sink")
 
         self.pipeline.set_state(Gst.State.PAUSED)
 
@@ -460,17 +969,27 @@ class VideoPreviewer(Previewer, Zoomable, Loggable):
             self.warning("Couldn't preroll the pipeline")
             # assume 16:9 aspect ratio
             self.thumb_width = 16 * self.thumb_height / 9
-
-        decode = self.pipeline.get_by_name("decode")
-        decode.connect("autoplug-select", self._autoplugSelectCb)
-
-        # pop all messages from the bus so we won't be flooded with messages
-        # from the prerolling phase
-        while self.pipeline.get_bus().pop():
-            continue
-        # add a message handler that listens for the created pixbufs
+        # Connected again with the other handlers.
+        self.pipeline.disconnect(handler_id)
         self.pipeline.get_bus().add_signal_watch()
-        self.pipeline.get_bus().connect("message", self.__bus_message_handler)
+
+    def _park_pipeline(self):
+        """Keeps the prerolled pipeline in `idle_pipelines`, or stops it."""
+        for obj, handler_id in self._pipeline_handlers:
+            obj.disconnect(handler_id)
+        self._pipeline_handlers = []
+        for pad, probe_id in self._decoder_probes:
+            pad.remove_probe(probe_id)
+        self._decoder_probes = []
+
+        change_return = self.pipeline.set_state(Gst.State.PAUSED)
+        if change_return == Gst.StateChangeReturn.FAILURE:
+            self.pipeline.set_state(Gst.State.NULL)
+        else:
+            self.idle_pipelines.park(self.uri, self.pipeline,
+                                     (self.thumb_width, self._gop_duration))
+        self.pipeline = None
+        self.gdkpixbufsink = None
 
     def _checkCPU(self):
         """Adjusts when the next thumbnail is generated.
@@ -518,35 +1037,56 @@ class VideoPreviewer(Previewer, Zoomable, Loggable):
 
         self._checkCPU()
 
-        # Save periodically to avoid the common situation where the user exits
-        # the app before a long clip has been fully thumbnailed.
-        # Spread timeouts between 30-80 secs to avoid concurrent disk writes.
-        random_time = random.randrange(30, 80)
-        GLib.timeout_add_seconds(random_time, self._autosave)
-
         # Remove the GSource
         return False
 
     def _create_next_thumb(self):
-        if not self.wishlist or not self.queue:
-            # nothing left to do
+        time = self._get_wish()
+        if time is None:
+            # nothing left to do, the thumbnails not wished for are
+            # generated when they become visible.
             self.debug("Thumbnails generation complete")
+            if self.generated_thumbs:
+                self.debug("Decoded %.1f frames per thumbnail",
+                           self.decoded_frames / self.generated_thumbs)
             self.stopGeneration()
             self.thumb_cache.commit()
             return
         else:
-            self.debug("Missing %d thumbs", len(self.wishlist))
+            self.debug("Missing %d thumbs", len(self.wishlist) + 1)
+
+        if self._use_fast_thumbs():
+            self.log('Creating fast thumb for "%s"', path_from_uri(self.uri))
+            # The time stays in the queue, for an accurate thumbnail.
+            self._fast_seek_time = time
+            self._seeking = True
+            self.pipeline.seek(1.0,
+                               Gst.Format.TIME,
+                               Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT |
+                               Gst.SeekFlags.SNAP_NEAREST,
+                               Gst.SeekType.SET, time,
+                               Gst.SeekType.NONE, -1)
+            return False
 
-        wish = self._get_wish()
-        if wish:
-            time = wish
-            self.queue.remove(wish)
-        else:
-            time = self.queue.pop(0)
+        times = self._get_consecutive_times(time)
+        if len(times) >= STREAMING_MIN_THUMBS:
+            self.log('Creating %d thumbs for "%s"', len(times), path_from_uri(self.uri))
+            self._streamed_times = times
+            self._streaming = True
+            self.pipeline.seek(1.0,
+                               Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
+                               Gst.SeekType.SET, times[0],
+                               Gst.SeekType.SET, times[-1] + 1)
+            self.pipeline.set_state(Gst.State.PLAYING)
+            self._reset_streaming_timeout()
+            return False
+
+        self.queue.remove(time)
         self.log('Creating thumb for "%s"', path_from_uri(self.uri))
         # append the time to the end of the queue so that if this seek fails
         # another try will be started later
         self.queue.append(time)
+        self._seeking = True
         self.pipeline.seek(1.0,
                            Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
                            Gst.SeekType.SET, time,
@@ -555,13 +1095,38 @@ class VideoPreviewer(Previewer, Zoomable, Loggable):
         # Remove the GSource
         return False
 
-    def _autosave(self):
-        if self.wishlist:
-            self.log("Periodic thumbnail autosave")
-            self.thumb_cache.commit()
-            return True
-        else:
-            return False  # Stop the timer
+    def _use_fast_thumbs(self):
+        """Checks whether the thumbnails can be snapped to keyframes.
+
+        Returns:
+            bool: Whether the displayed thumbnails are further apart than
+            the keyframes, so each thumbnail is snapped to a different one.
+        """
+        if self._gop_duration is None:
+            return False
+        return self._get_thumb_duration() > self._gop_duration
+
+    def _update_gop_duration(self, interval):
+        if self._gop_duration is None or interval > self._gop_duration:
+            self.debug("Keyframes are at least %s apart", Gst.TIME_ARGS(interval))
+            self._gop_duration = interval
+
+    def _get_consecutive_times(self, time):
+        """Gets the consecutive queued times starting with the specified one.
+
+        Args:
+            time (int): The position of the first thumbnail.
+
+        Returns:
+            List[int]: At most STREAMING_MAX_THUMBS times one thumb_period
+            apart from each other.
+        """
+        queued = set(self.queue)
+        times = [time]
+        while len(times) < STREAMING_MAX_THUMBS and \
+                times[-1] + self.thumb_period in queued:
+            times.append(times[-1] + self.thumb_period)
+        return times
 
     def _get_thumb_duration(self):
         thumb_duration_tmp = Zoomable.pixelToNs(self.thumb_width + THUMB_MARGIN_PX)
@@ -582,35 +1147,94 @@ class VideoPreviewer(Previewer, Zoomable, Loggable):
         thumbs = {}
         self.wishlist = []
         thumb_duration = self._get_thumb_duration()
+        fast = self._use_fast_thumbs()
         element_left = quantize(self.ges_elem.props.in_point, thumb_duration)
         element_right = self.ges_elem.props.in_point + self.ges_elem.props.duration
+        if self.__image_pixbuf:
+            cached = {}
+        else:
+            # Get all the existing thumbnails at once.
+            cached = self.thumb_cache.get_range(element_left, element_right,
+                                                thumb_duration,
+                                                self.__thumb_decoded_cb)
         for position in range(element_left, element_right, thumb_duration):
-            x = Zoomable.nsToPixel(position) - self.nsToPixel(self.ges_elem.props.in_point)
-            y = (self.props.height_request - self.thumb_height) / 2
-            try:
-                thumb = self.thumbs.pop(position)
-                self.move(thumb, x, y)
-            except KeyError:
-                thumb = Thumbnail(self.thumb_width, self.thumb_height)
-                self.put(thumb, x, y)
-
-            thumbs[position] = thumb
             if self.__image_pixbuf:
                 # The thumbnail is fixed, probably it's an image clip.
-                thumb.set_from_pixbuf(self.__image_pixbuf)
-                thumb.set_visible(True)
-            elif position in self.thumb_cache:
-                pixbuf = self.thumb_cache[position]
-                thumb.set_from_pixbuf(pixbuf)
-                thumb.set_visible(True)
+                thumbs[position] = self.__image_pixbuf
+            elif position in cached:
+                # Until it's decoded, keep showing what was shown before.
+                thumbs[position] = cached[position] or self.thumbs.get(position)
+                if not fast and not self.thumb_cache.is_accurate(position):
+                    # Replace the thumbnail snapped to a keyframe.
+                    self.wishlist.append(position)
             else:
+                thumbs[position] = self.thumbs.get(position)
                 self.wishlist.append(position)
-        for thumb in self.thumbs.values():
-            self.remove(thumb)
         self.thumbs = thumbs
+        self._positions = list(thumbs)
+        self.queue_draw()
+
+        if self.wishlist and not self.pipeline:
+            # The generation finished before, for example at a lower zoom.
+            self.becomeControlled()
 
         return True
 
+    def __thumb_decoded_cb(self, position, pixbuf):
+        if position in self.thumbs:
+            self.thumbs[position] = pixbuf
+            self.queue_draw()
+
+    def _thumb_stored_cb(self, position, pixbuf, actual_time):
+        """Shows the thumbnail stored by any of the previewers of the asset."""
+        if position not in self.thumbs:
+            return
+        self.thumbs[position] = pixbuf
+        if actual_time is None and position in self.wishlist:
+            self.wishlist.remove(position)
+        self.queue_draw()
+
+    def _get_visible_positions(self, x, width):
+        """Gets the times of the thumbnails overlapping a horizontal range.
+
+        Args:
+            x (int): The start of the range, relative to the previewer.
+            width (int): The width of the range.
+
+        Returns:
+            List[int]: The sorted times of the thumbnails.
+        """
+        inpoint_x = self.nsToPixel(self.ges_elem.props.in_point)
+        start = bisect.bisect_right(
+            self._positions, self.pixelToNs(x + inpoint_x - self.thumb_width))
+        positions = []
+        for position in self._positions[start:]:
+            if self.nsToPixel(position) - inpoint_x >= x + width:
+                break
+            positions.append(position)
+        return positions
+
+    # pylint: disable=arguments-differ
+    def do_draw(self, context):
+        if self.thumb_width is None:
+            return
+
+        clipped_rect = Gdk.cairo_get_clip_rectangle(context)[1]
+        inpoint_x = self.nsToPixel(self.ges_elem.props.in_point)
+        y = (self.props.height_request - self.thumb_height) / 2
+        for position in self._get_visible_positions(clipped_rect.x,
+                                                    clipped_rect.width):
+            pixbuf = self.thumbs[position]
+            if not pixbuf:
+                continue
+            # Center the pixbuf in the space of the thumbnail.
+            x = self.nsToPixel(position) - inpoint_x
+            Gdk.cairo_set_source_pixbuf(
+                context, pixbuf,
+                x + (self.thumb_width - pixbuf.props.width) // 2,
+                y + (self.thumb_height - pixbuf.props.height) // 2)
+            context.paint_with_alpha(self._opacity)
+
     def _get_wish(self):
         """Returns a wish that is also in the queue, if any."""
         while True:
@@ -620,24 +1244,61 @@ class VideoPreviewer(Previewer, Zoomable, Loggable):
             if wish in self.queue:
                 return wish
 
+    def _reset_streaming_timeout(self):
+        """Restarts the countdown for giving up the playing through."""
+        if self._streaming_timeout_id:
+            GLib.source_remove(self._streaming_timeout_id)
+        self._streaming_timeout_id = GLib.timeout_add_seconds(
+            STREAMING_TIMEOUT, self._streaming_timeout_cb)
+
+    def _stop_streaming(self):
+        """Stops playing through the range of thumbnails.
+
+        The thumbnails not obtained are moved to the end of the queue
+        so another try will be started later.
+        """
+        if self._streaming_timeout_id:
+            GLib.source_remove(self._streaming_timeout_id)
+            self._streaming_timeout_id = None
+        self._streaming = False
+        for time in self._streamed_times:
+            if time in self.queue:
+                self.queue.remove(time)
+                self.queue.append(time)
+        self._streamed_times = []
+
     def _set_pixbuf(self, position, pixbuf):
         """Sets the pixbuf for the thumbnail at the specified position."""
-        if position in self.thumbs:
-            thumb = self.thumbs[position]
-        else:
+        if self._fast_seek_time is not None:
+            self._set_fast_pixbuf(position, pixbuf)
+            return
+
+        if self._streaming:
+            # The frames are timestamped by videorate at thumb_period intervals.
+            position = quantize(position + self.thumb_period // 2, self.thumb_period)
+        elif position not in self.thumbs and self._positions:
             # The pixbufs we get from gdkpixbufsink are not always
             # exactly the ones requested, the reported position can differ.
             # Try to find the closest thumbnail for the specified position.
-            sorted_times = sorted(self.thumbs.keys())
-            index = binary_search(sorted_times, position)
-            position = sorted_times[index]
-            thumb = self.thumbs[position]
+            index = binary_search(self._positions, position)
+            position = self._positions[index]
 
-        thumb.set_from_pixbuf(pixbuf)
         if position in self.queue:
             self.queue.remove(position)
+            self.generated_thumbs += 1
+        # Shown by _thumb_stored_cb.
         self.thumb_cache[position] = pixbuf
-        self.queue_draw()
+
+    def _set_fast_pixbuf(self, actual_time, pixbuf):
+        """Sets the pixbuf for the thumbnail being sought fast."""
+        position = self._fast_seek_time
+        self._fast_seek_time = None
+        # The nearest keyframe is at most half a GOP away.
+        self._update_gop_duration(2 * abs(actual_time - position))
+
+        self.generated_thumbs += 1
+        # Shown by _thumb_stored_cb.
+        self.thumb_cache.set_fast(position, pixbuf, actual_time)
 
     # Interface (Zoomable)
 
@@ -651,15 +1312,79 @@ class VideoPreviewer(Previewer, Zoomable, Loggable):
                 message.src == self.gdkpixbufsink:
             struct = message.get_structure()
             struct_name = struct.get_name()
-            if struct_name == "preroll-pixbuf":
+            # While playing through, the preroll-pixbuf duplicates
+            # the first pixbuf.
+            if (struct_name == "preroll-pixbuf" and not self._streaming) or \
+                    (struct_name == "pixbuf" and self._streaming):
                 stream_time = struct.get_value("stream-time")
                 pixbuf = struct.get_value("pixbuf")
                 self._set_pixbuf(stream_time, pixbuf)
+                if self._streaming:
+                    self._reset_streaming_timeout()
         elif message.type == Gst.MessageType.ASYNC_DONE and \
                 message.src == self.pipeline:
+            if self._seeking:
+                self._seeking = False
+                self._checkCPU()
+        elif message.type == Gst.MessageType.EOS and self._streaming:
+            # Played through the range of thumbnails.
+            self._stop_streaming()
+            self.pipeline.set_state(Gst.State.PAUSED)
+            self._checkCPU()
+        elif message.type == Gst.MessageType.ERROR and self._streaming:
+            error, debug = message.parse_error()
+            self.warning("Failed playing through the thumbnails of %s: %s, %s",
+                         path_from_uri(self.uri), error, debug)
+            self._stop_streaming()
+            self.pipeline.set_state(Gst.State.PAUSED)
             self._checkCPU()
         return Gst.BusSyncReply.PASS
 
+    def _streaming_timeout_cb(self):
+        self._streaming_timeout_id = None
+        self.warning("Playing through the thumbnails of %s stalled",
+                     path_from_uri(self.uri))
+        self._stop_streaming()
+        self.pipeline.set_state(Gst.State.PAUSED)
+        self._checkCPU()
+        return False
+
+    def _deep_element_added_cb(self, unused_pipeline, unused_bin, element):
+        factory = element.get_factory()
+        if factory and "Decoder/Video" in factory.get_klass():
+            self._add_decoder_probe(element)
+            self._configure_decoder(element)
+
+    def _add_decoder_probe(self, decoder):
+        pad = decoder.get_static_pad("sink")
+        probe_id = pad.add_probe(Gst.PadProbeType.BUFFER,
+                                 self.__decoder_buffer_probe_cb)
+        self._decoder_probes.append((pad, probe_id))
+
+    def _configure_decoder(self, decoder):
+        """Makes the decoder cheaper, if it supports it."""
+        threads = self._settings.thumbnailsDecoderThreads
+        if threads and decoder.find_property("max-threads"):
+            decoder.props.max_threads = threads
+        if self._settings.thumbnailsDecoderLowres and decoder.find_property("lowres"):
+            # The thumbnails are much smaller than half the video anyway.
+            Gst.util_set_object_arg(decoder, "lowres", "1")
+
+    def __decoder_buffer_probe_cb(self, unused_pad, info):
+        self.decoded_frames += 1
+
+        buf = info.get_buffer()
+        if buf.has_flags(Gst.BufferFlags.DISCONT):
+            # The previous keyframe is not the one preceding this buffer.
+            self._last_keyframe_time = None
+        if not buf.has_flags(Gst.BufferFlags.DELTA_UNIT) and \
+                buf.pts != Gst.CLOCK_TIME_NONE:
+            if self._last_keyframe_time is not None and \
+                    buf.pts > self._last_keyframe_time:
+                self._update_gop_duration(buf.pts - self._last_keyframe_time)
+            self._last_keyframe_time = buf.pts
+        return Gst.PadProbeReturn.OK
+
     # pylint: disable=no-self-use
     def _autoplugSelectCb(self, unused_decode, unused_pad, unused_caps, factory):
         # Don't plug audio decoders / parsers.
@@ -675,12 +1400,10 @@ class VideoPreviewer(Previewer, Zoomable, Loggable):
 
     def setSelected(self, selected):
         if selected:
-            opacity = 0.5
+            self._opacity = 0.5
         else:
-            opacity = 1.0
-
-        for thumb in self.get_children():
-            thumb.props.opacity = opacity
+            self._opacity = 1.0
+        self.queue_draw()
 
     def startGeneration(self):
         self._setupPipeline()
@@ -697,48 +1420,258 @@ class VideoPreviewer(Previewer, Zoomable, Loggable):
             GLib.source_remove(self._thumb_cb_id)
             self._thumb_cb_id = None
 
+        if self._streaming:
+            self._stop_streaming()
+
         if self.pipeline:
-            self.pipeline.set_state(Gst.State.NULL)
-            self.pipeline.get_state(Gst.CLOCK_TIME_NONE)
-            self.pipeline = None
+            self._park_pipeline()
 
         self._ensure_proxy_thumbnails_cache()
         self.emit("done")
 
     def release(self):
         """Stops preview generation and cleans the object."""
+        Previewer.manager.remove_previewer(self)
+        self.thumb_cache.remove_listener(self._thumb_stored_cb)
+        self.ges_elem.disconnect(self._inpoint_changed_cb_id)
         self.stopGeneration()
         Zoomable.__del__(self)
 
 
-class Thumbnail(Gtk.Image):
-    """Simple widget representing a Thumbnail."""
+class PixbufLRUCache(object):
+    """Keeps the most recently used pixbufs in memory, up to a size in bytes.
+
+    Attributes:
+        max_bytes (int): The budget for the pixbufs data.
+        size (int): The size in bytes of the pixbufs data.
+        hits (int): The number of lookups which found the pixbuf.
+        misses (int): The number of lookups which did not find the pixbuf.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Maps the keys to (pixbuf, data) tuples, the least recently used first.
+        self._entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Gets the pixbuf and its data, marking it as recently used.
+
+        Args:
+            key (object): The key of the pixbuf.
+
+        Returns:
+            tuple: The pixbuf and the data stored with it, or None if missing.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def peek(self, key):
+        """Gets the pixbuf and its data, without counting it as used.
+
+        Args:
+            key (object): The key of the pixbuf.
+
+        Returns:
+            tuple: The pixbuf and the data stored with it, or None if missing.
+        """
+        return self._entries.get(key)
+
+    def put(self, key, pixbuf, data=None):
+        """Adds a pixbuf, evicting the least recently used ones if needed.
+
+        Args:
+            key (object): The key of the pixbuf.
+            pixbuf (GdkPixbuf.Pixbuf): The pixbuf.
+            data (object): Data stored with the pixbuf.
+        """
+        self.remove(key)
+        self._entries[key] = (pixbuf, data)
+        self.size += pixbuf.get_byte_length()
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            unused_key, (old_pixbuf, unused_data) = self._entries.popitem(last=False)
+            self.size -= old_pixbuf.get_byte_length()
 
-    def __init__(self, width, height):
-        Gtk.Image.__init__(self)
-        self.props.width_request = width
-        self.props.height_request = height
+    def remove(self, key):
+        """Removes the pixbuf with the specified key, if any.
+
+        Args:
+            key (object): The key of the pixbuf.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[0].get_byte_length()
+
+
+class ThumbnailCacheWriter(Loggable):
+    """Writes the thumbnails of all the ThumbnailCaches in a single thread.
+
+    The thumbnails queued while the previous ones are being written are
+    written in batches, in a single transaction.
+    """
+
+    def __init__(self):
+        Loggable.__init__(self)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # The connections used by the thread, by database file.
+        self._connections = {}
+
+    def add(self, cache, key, entry, jpeg):
+        """Queues the specified thumbnail for writing.
+
+        Can be called from any thread.
+
+        Args:
+            cache (ThumbnailCache): The cache of the thumbnail.
+            key (Optional[int]): The time for which the thumbnail has been
+                requested, or None for the media library thumbnail.
+            entry (tuple): The pixbuf and the actual time of the frame.
+            jpeg (Optional[bytes]): The encoded pixbuf, or None if the
+                encoding failed, in which case it's only reported as done.
+        """
+        self._queue.put((cache, key, entry, jpeg))
+        with self._lock:
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run,
+                                                name="thumbnails-writer",
+                                                daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        """Writes the queued thumbnails and stops the thread.
+
+        The thread is a daemon, so this must be called before exiting
+        for not losing the queued thumbnails. A new thread is started
+        by the next `add`.
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if not thread:
+            return
+        self._queue.put(None)
+        thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None is queued by `flush`.
+            stopping = None in items
+            items = [item for item in items if item is not None]
+            if items:
+                self._write(items)
+                GLib.idle_add(self.__written_cb, items)
+
+        for db in self._connections.values():
+            db.close()
+        self._connections = {}
+
+    def _write(self, items):
+        rows_by_dbfile = collections.OrderedDict()
+        for cache, key, entry, jpeg in items:
+            # The fast and the accurate thumbnails of a time are encoded
+            # concurrently, so they can be queued in any order.
+            if jpeg is None or not cache.is_pending(key, entry):
+                continue
+            thumbs, library_thumbs = rows_by_dbfile.setdefault(cache.dbfile, ([], []))
+            if key is None:
+                library_thumbs.append((cache.filehash, sqlite3.Binary(jpeg)))
+            else:
+                actual_time = entry[1]
+                thumbs.append((cache.filehash, key, sqlite3.Binary(jpeg), actual_time))
+
+        for dbfile, (thumbs, library_thumbs) in rows_by_dbfile.items():
+            try:
+                db = self._connections.get(dbfile)
+                if not db:
+                    db = sqlite3.connect(dbfile)
+                    db.execute("PRAGMA synchronous=NORMAL")
+                    self._connections[dbfile] = db
+                db.executemany("INSERT OR REPLACE INTO Thumbs VALUES (?,?,?,?)", thumbs)
+                db.executemany("INSERT OR REPLACE INTO LibraryThumbs VALUES (?,?)",
+                               library_thumbs)
+                db.commit()
+            except sqlite3.Error as e:
+                self.warning("Failed writing %d thumbnails to %s: %s",
+                             len(thumbs) + len(library_thumbs), dbfile, e)
+        self.log("Wrote %d thumbnails", len(items))
+
+    # pylint: disable=no-self-use
+    def __written_cb(self, items):
+        for cache, key, entry, unused_jpeg in items:
+            cache.written(key, entry)
+        return False
 
 
 class ThumbnailCache(Loggable):
     """Caches an asset's thumbnails by key, using LRU policy.
 
     Uses a two stage caching mechanism. A limited number of elements are
-    held in memory, the rest is being cached on disk in an SQLite db.
+    held in memory, the rest is being cached on disk in the PreviewsStore.
+    The decoded thumbnails of all the caches share the memory budget
+    of the `pixbufs` LRU cache.
+
+    The thumbnails are stored by the time for which they have been requested.
+    The fast thumbnails, snapped to a keyframe, also have the actual time of
+    the frame, and are replaced when an accurate thumbnail is generated.
+
+    The thumbnails are encoded and decoded by the `codecs` threads.
+    The new thumbnails are written by the `writer` thread. Until then,
+    they are kept in memory.
+
+    Attributes:
+        dbfile (str): The path of the PreviewsStore database.
+        filehash (str): The hash under which the thumbnails are stored.
     """
 
     caches_by_uri = {}
 
+    # The decoded thumbnails by (uri, time).
+    pixbufs = PixbufLRUCache(THUMBNAILS_MEMORY_BUDGET)
+
+    writer = ThumbnailCacheWriter()
+
+    codecs = concurrent.futures.ThreadPoolExecutor(
+        max_workers=THUMBNAILS_CODEC_THREADS)
+
     def __init__(self, uri):
         Loggable.__init__(self)
-        self._filehash = hash_file(Gst.uri_get_location(uri))
-        thumbs_cache_dir = get_dir(os.path.join(xdg_cache_home(), "thumbs"))
-        self._dbfile = os.path.join(thumbs_cache_dir, self._filehash)
-        self._db = sqlite3.connect(self._dbfile)
-        self._cur = self._db.cursor()  # Use this for normal db operations
-        self._cur.execute("CREATE TABLE IF NOT EXISTS Thumbs\
-                          (Time INTEGER NOT NULL PRIMARY KEY,\
-                          Jpeg BLOB NOT NULL)")
+        self._uri = uri
+        store = get_previews_store()
+        # The proxies share the thumbnails of their asset.
+        self.filehash = store.resolve(hash_uri(uri))
+        store.touch(self.filehash)
+        self.dbfile = store.path
+        self._cur = store.db.cursor()  # Use this for normal db operations
+        # The (pixbuf, actual time) of the thumbnails not yet written, by time.
+        self._pending = {}
+        # The (pixbuf, None) of the media library thumbnail not yet written.
+        self._pending_library_thumb = None
+        # Protects the changes of _pending and _pending_library_thumb,
+        # checked by the writer thread.
+        self._pending_lock = threading.Lock()
+        # The (actual time, callbacks) of the thumbnails being decoded, by time.
+        self._decoding = {}
+        # The functions called when a thumbnail is stored.
+        self._listeners = []
 
     @classmethod
     def get(cls, obj):
@@ -763,20 +1696,12 @@ class ThumbnailCache(Loggable):
         return cls.caches_by_uri[uri]
 
     def copy(self, uri):
-        """Copies `self` to the specified `uri`.
+        """Makes the specified `uri` share the thumbnails of `self`.
 
         Args:
-            uri (str): The place where to copy/save the ThumbnailCache
+            uri (str): The URI of the asset, usually a proxy.
         """
-        filehash = hash_file(Gst.uri_get_location(uri))
-        thumbs_cache_dir = get_dir(os.path.join(xdg_cache_home(), "thumbs"))
-        dbfile = os.path.join(thumbs_cache_dir, filehash)
-
-        try:
-            os.remove(dbfile)
-        except FileNotFoundError:
-            pass
-        os.symlink(self._dbfile, dbfile)
+        set_previews_alias(uri, self._uri)
 
     def getImagesSize(self):
         """Gets the image size.
@@ -784,7 +1709,12 @@ class ThumbnailCache(Loggable):
         Returns:
             List[int]: The width and height of the images in the cache.
         """
-        self._cur.execute("SELECT * FROM Thumbs LIMIT 1")
+        if self._pending:
+            pixbuf = next(iter(self._pending.values()))[0]
+            return pixbuf.get_width(), pixbuf.get_height()
+
+        self._cur.execute("SELECT Time, Jpeg FROM Thumbs WHERE Hash = ? LIMIT 1",
+                          (self.filehash,))
         row = self._cur.fetchone()
         if not row:
             return None, None
@@ -794,12 +1724,43 @@ class ThumbnailCache(Loggable):
 
     def getPreviewThumbnail(self):
         """Gets a thumbnail contained 'at the middle' of the cache."""
-        self._cur.execute("SELECT Time FROM Thumbs")
-        timestamps = self._cur.fetchall()
+        self._cur.execute("SELECT Time FROM Thumbs WHERE Hash = ?", (self.filehash,))
+        timestamps = {row[0] for row in self._cur.fetchall()}
+        timestamps.update(self._pending)
         if not timestamps:
             return None
 
-        return self[timestamps[int(len(timestamps) / 2)][0]]
+        return self[sorted(timestamps)[int(len(timestamps) / 2)]]
+
+    def get_library_thumbnail(self):
+        """Gets the thumbnail extracted for the media library, if any.
+
+        Returns:
+            GdkPixbuf.Pixbuf: The thumbnail, `LARGE_THUMB_WIDTH` wide.
+        """
+        entry = self._pending_library_thumb
+        if entry:
+            return entry[0]
+        self._cur.execute("SELECT Hash, Jpeg FROM LibraryThumbs WHERE Hash = ?",
+                          (self.filehash,))
+        row = self._cur.fetchone()
+        if not row:
+            return None
+        return self.__getPixbufFromRow(row)
+
+    def set_library_thumbnail(self, pixbuf):
+        """Saves the thumbnail to be shown in the media library.
+
+        The thumbnail is encoded and written like the timeline thumbnails,
+        under the None key.
+
+        Args:
+            pixbuf (GdkPixbuf.Pixbuf): The thumbnail.
+        """
+        entry = (pixbuf, None)
+        with self._pending_lock:
+            self._pending_library_thumb = entry
+        self.codecs.submit(self._encode, None, entry)
 
     # pylint: disable=no-self-use
     def __getPixbufFromRow(self, row):
@@ -811,35 +1772,223 @@ class ThumbnailCache(Loggable):
         pixbuf = loader.get_pixbuf()
         return pixbuf
 
+    def _get_entry(self, key, peek=False):
+        """Gets the (pixbuf, actual time) of the thumbnail, if in memory."""
+        if peek:
+            entry = self.pixbufs.peek((self._uri, key))
+        else:
+            entry = self.pixbufs.get((self._uri, key))
+        return entry or self._pending.get(key)
+
     def __contains__(self, key):
+        if self._get_entry(key, peek=True) or key in self._decoding:
+            return True
         # check if item is present in on disk cache
-        self._cur.execute("SELECT Time FROM Thumbs WHERE Time = ?", (key,))
+        self._cur.execute("SELECT Time FROM Thumbs WHERE Hash = ? AND Time = ?",
+                          (self.filehash, key))
         if self._cur.fetchone():
             return True
         return False
 
     def __getitem__(self, key):
-        self._cur.execute("SELECT * FROM Thumbs WHERE Time = ?", (key,))
+        entry = self._get_entry(key)
+        if entry:
+            return entry[0]
+
+        self._cur.execute("SELECT Time, Jpeg, ActualTime FROM Thumbs"
+                          " WHERE Hash = ? AND Time = ?", (self.filehash, key))
         row = self._cur.fetchone()
         if not row:
             raise KeyError(key)
-        return self.__getPixbufFromRow(row)
+        pixbuf = self.__getPixbufFromRow(row)
+        self.pixbufs.put((self._uri, key), pixbuf, row[2])
+        return pixbuf
 
     def __setitem__(self, key, value):
-        success, jpeg = value.save_to_bufferv(
+        self.set_fast(key, value, None)
+
+    def get_range(self, start, end, step, callback=None):
+        """Gets the existing thumbnails at regular intervals.
+
+        Args:
+            start (int): The time of the first thumbnail.
+            end (int): The time before which to stop.
+            step (int): The interval between the thumbnails.
+            callback (Optional[function]): The function called on the main
+                loop with the time and the pixbuf of each thumbnail which
+                has to be read from disk. If specified, these thumbnails are
+                decoded in the `codecs` threads.
+
+        Returns:
+            dict: Maps the times to the pixbufs of the existing thumbnails.
+            The pixbufs being decoded for the callback are None.
+        """
+        pixbufs = {}
+        missing = False
+        for time in range(start, end, step):
+            entry = self._get_entry(time)
+            if entry:
+                pixbufs[time] = entry[0]
+            elif time in self._decoding:
+                pixbufs[time] = None
+                if callback:
+                    self._decoding[time][1].append(callback)
+            else:
+                missing = True
+        if not missing:
+            return pixbufs
+
+        self._cur.execute("SELECT Time, Jpeg, ActualTime FROM Thumbs"
+                          " WHERE Hash = ? AND Time >= ? AND Time < ?"
+                          " AND (Time - ?) % ? = 0",
+                          (self.filehash, start, end, start, step))
+        for row in self._cur.fetchall():
+            time = row[0]
+            if time in pixbufs:
+                continue
+            if callback:
+                pixbufs[time] = None
+                self._decoding[time] = (row[2], [callback])
+                self.codecs.submit(self._decode, row)
+            else:
+                pixbuf = self.__getPixbufFromRow(row)
+                self.pixbufs.put((self._uri, time), pixbuf, row[2])
+                pixbufs[time] = pixbuf
+        return pixbufs
+
+    def _decode(self, row):
+        """Decodes the thumbnail in a `codecs` thread."""
+        try:
+            pixbuf = self.__getPixbufFromRow(row)
+        except GLib.Error as e:
+            self.warning("Failed decoding thumbnail %s: %s", row[0], e)
+            pixbuf = None
+        GLib.idle_add(self.__decoded_cb, row[0], pixbuf)
+
+    def __decoded_cb(self, key, pixbuf):
+        actual_time, callbacks = self._decoding.pop(key)
+        if pixbuf and not self._get_entry(key, peek=True):
+            self.pixbufs.put((self._uri, key), pixbuf, actual_time)
+            for callback in callbacks:
+                callback(key, pixbuf)
+        return False
+
+    @classmethod
+    def flush(cls):
+        """Waits for the thumbnails being encoded and writes them.
+
+        Called when closing the project and when exiting.
+        """
+        codecs = cls.codecs
+        cls.codecs = concurrent.futures.ThreadPoolExecutor(
+            max_workers=THUMBNAILS_CODEC_THREADS)
+        codecs.shutdown(wait=True)
+        cls.writer.flush()
+
+    def add_listener(self, callback):
+        """Registers a function to be called when a thumbnail is stored.
+
+        Args:
+            callback (function): The function called with the time, the
+                pixbuf and the actual time of each thumbnail, as passed to
+                `set_fast`.
+        """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        """Unregisters a function registered with `add_listener`."""
+        self._listeners.remove(callback)
+
+    def set_fast(self, key, value, actual_time):
+        """Stores a thumbnail which might not be at the specified time.
+
+        Args:
+            key (int): The time for which the thumbnail has been requested.
+            value (GdkPixbuf.Pixbuf): The thumbnail.
+            actual_time (Optional[int]): The time of the frame, or None if
+                the thumbnail is accurate.
+        """
+        if actual_time == key:
+            actual_time = None
+        entry = (value, actual_time)
+        with self._pending_lock:
+            self._pending[key] = entry
+        self.pixbufs.put((self._uri, key), value, actual_time)
+        self.codecs.submit(self._encode, key, entry)
+        for callback in list(self._listeners):
+            callback(key, value, actual_time)
+
+    def _encode(self, key, entry):
+        """Encodes the thumbnail in a `codecs` thread and queues it for writing."""
+        success, jpeg = entry[0].save_to_bufferv(
             "jpeg", ["quality", None], ["90"])
         if not success:
             self.warning("JPEG compression failed")
-            return
-        blob = sqlite3.Binary(jpeg)
-        # Replace if a row with the same time already exists.
-        self._cur.execute("DELETE FROM Thumbs WHERE  time=?", (key,))
-        self._cur.execute("INSERT INTO Thumbs VALUES (?,?)", (key, blob,))
+            jpeg = None
+        self.writer.add(self, key, entry, jpeg)
+
+    def written(self, key, entry):
+        """Forgets the specified thumbnail, written to the database.
+
+        Args:
+            key (Optional[int]): The time for which the thumbnail has been
+                requested, or None for the media library thumbnail.
+            entry (tuple): The pixbuf and the actual time of the frame.
+        """
+        with self._pending_lock:
+            if key is None:
+                if self._pending_library_thumb is entry:
+                    self._pending_library_thumb = None
+            elif self._pending.get(key) is entry:
+                del self._pending[key]
+
+    def is_pending(self, key, entry):
+        """Checks whether the thumbnail is the latest one for its time.
+
+        Can be called from any thread.
+
+        Args:
+            key (Optional[int]): The time for which the thumbnail has been
+                requested, or None for the media library thumbnail.
+            entry (tuple): The pixbuf and the actual time of the frame.
+
+        Returns:
+            bool: False if the thumbnail has been written or replaced.
+        """
+        with self._pending_lock:
+            if key is None:
+                return self._pending_library_thumb is entry
+            return self._pending.get(key) is entry
+
+    def is_accurate(self, key):
+        """Checks whether the thumbnail is exactly at the specified time.
+
+        Args:
+            key (int): The time for which the thumbnail has been requested.
+
+        Returns:
+            bool: False if the thumbnail is missing or snapped to a keyframe.
+        """
+        entry = self._get_entry(key, peek=True)
+        if entry:
+            return entry[1] is None
+        if key in self._decoding:
+            actual_time, unused_callbacks = self._decoding[key]
+            return actual_time is None
+        self._cur.execute("SELECT ActualTime FROM Thumbs WHERE Hash = ? AND Time = ?",
+                          (self.filehash, key))
+        row = self._cur.fetchone()
+        return row is not None and row[0] is None
 
     def commit(self):
-        """Saves the cache on disk (in the database)."""
-        self._db.commit()
-        self.log("Saved thumbnail cache file: %s" % self._filehash)
+        """Logs the state of the cache.
+
+        The thumbnails are saved on disk by the writer thread.
+        """
+        self.log("Thumbnails of %s waiting to be saved: %d",
+                 self.filehash, len(self._pending))
+        self.debug("Decoded thumbnails in memory: %d bytes, %d hits, %d misses",
+                   self.pixbufs.size, self.pixbufs.hits, self.pixbufs.misses)
 
         return False
 
@@ -948,11 +2097,8 @@ class PipelineCpuAdapter(Loggable):
 
 
 def get_wavefile_location_for_uri(uri):
-    """Computes the URI where the pickled wave file should be stored."""
-    filename = hash_file(Gst.uri_get_location(uri)) + ".wave"
-    cache_dir = get_dir(os.path.join(xdg_cache_home(), "waves"))
-
-    return os.path.join(cache_dir, filename)
+    """Computes the URI where the waveform file should be stored."""
+    return get_previews_store().get_wavefile(hash_uri(uri))
 
 
 class AudioPreviewer(Previewer, Zoomable, Loggable):
@@ -975,6 +2121,8 @@ class AudioPreviewer(Previewer, Zoomable, Loggable):
         asset = self.ges_elem.get_parent().get_asset()
         self.n_samples = asset.get_duration() / SAMPLE_DURATION
         self.samples = None
+        # The peak pyramid, see `pitivi.utils.waveform.build_pyramid`.
+        self.levels = None
         self.peaks = None
         self._start = 0
         self._end = 0
@@ -982,11 +2130,14 @@ class AudioPreviewer(Previewer, Zoomable, Loggable):
 
         # Guard against malformed URIs
         self.wavefile = None
-        self._uri = quote_uri(get_proxy_target(ges_elem).props.id)
+        self.uri = quote_uri(get_proxy_target(ges_elem).props.id)
 
         self._num_failures = 0
+        # Whether the waveform could not be extracted.
+        self.failed = False
         self.adapter = None
         self.surface = None
+        self._engine = WaveformsEngine.LEVEL
 
         self._force_redraw = True
 
@@ -1002,28 +2153,43 @@ class AudioPreviewer(Previewer, Zoomable, Loggable):
     def startLevelsDiscoveryWhenIdle(self):
         """Starts processing waveform (whenever possible)."""
         self.debug('Waiting for UI to become idle for: %s',
-                   path_from_uri(self._uri))
+                   path_from_uri(self.uri))
         GLib.idle_add(self._startLevelsDiscovery, priority=GLib.PRIORITY_LOW)
 
     def _startLevelsDiscovery(self):
-        filename = get_wavefile_location_for_uri(self._uri)
+        filename = get_wavefile_location_for_uri(self.uri)
 
-        if os.path.exists(filename):
-            with open(filename, "rb") as samples:
-                self.samples = pickle.load(samples)
-            self._startRendering()
-        else:
+        if not self._load_levels(filename):
             self.wavefile = filename
-            self._launchPipeline()
+            self.becomeControlled()
+
+    def _load_levels(self, filename):
+        """Loads the waveform if it has been extracted previously.
+
+        Returns:
+            bool: Whether the waveform has been loaded.
+        """
+        levels = load_waveform(filename)
+        if levels is None:
+            return False
+        self.levels = levels
+        self.samples = levels[0][RMS_ROW]
+        self._startRendering()
+        return True
 
     def _launchPipeline(self):
         self.debug(
-            'Now generating waveforms for: %s', path_from_uri(self._uri))
+            'Now generating waveforms for: %s', path_from_uri(self.uri))
+        self._engine = self.timeline.app.settings.waveformsEngine
+        if self._engine == WaveformsEngine.PCM:
+            wavebin = "pcmwaveformbin"
+        else:
+            wavebin = "waveformbin"
         self.pipeline = Gst.parse_launch("uridecodebin name=decode uri=" +
-                                         self._uri + " ! waveformbin name=wave"
+                                         self.uri + " ! " + wavebin + " name=wave"
                                          " ! fakesink qos=false name=faked")
         faked = self.pipeline.get_by_name("faked")
-        faked.props.sync = True
+        faked.props.sync = self._engine != WaveformsEngine.PCM
         self._wavebin = self.pipeline.get_by_name("wave")
         asset = self.ges_elem.get_parent().get_asset()
         self._wavebin.props.uri = asset.get_id()
@@ -1036,26 +2202,44 @@ class AudioPreviewer(Previewer, Zoomable, Loggable):
         asset = self.ges_elem.get_parent().get_asset()
         self.n_samples = asset.get_duration() / SAMPLE_DURATION
         bus.connect("message", self._busMessageCb)
-        self.becomeControlled()
 
     def zoomChanged(self):
         self._force_redraw = True
 
     def _prepareSamples(self):
+        """Gets the extracted waveform.
+
+        Returns:
+            bool: Whether the waveform is available. It's not when the
+            asset produced no audio data.
+        """
         proxy = self.ges_elem.get_parent().get_asset().get_proxy_target()
         self._wavebin.finalize(proxy=proxy)
-        self.samples = self._wavebin.samples
+        levels = self._wavebin.levels
+        if not levels:
+            # The waveform has been extracted previously.
+            levels = load_waveform(self._wavebin.wavefile)
+        if levels is None:
+            return False
+        self.levels = levels
+        self.samples = levels[0][RMS_ROW]
+        return True
 
     def _startRendering(self):
         self.n_samples = len(self.samples)
         self.discovered = True
         if self.adapter:
             self.adapter.stop()
+        self.queue_draw()
 
     def _busMessageCb(self, bus, message):
         if message.type == Gst.MessageType.EOS:
-            self._prepareSamples()
-            self._startRendering()
+            if self._prepareSamples():
+                self._startRendering()
+            else:
+                self.warning("No waveform has been extracted for: %s",
+                             path_from_uri(self.uri))
+                self.failed = True
             self.stopGeneration()
 
         elif message.type == Gst.MessageType.ERROR:
@@ -1071,7 +2255,6 @@ class AudioPreviewer(Previewer, Zoomable, Loggable):
                              " modulation", message.parse_error(),
                              self._num_failures)
                 bus.disconnect_by_func(self._busMessageCb)
-                self._launchPipeline()
                 self.becomeControlled()
             else:
                 Gst.debug_bin_to_dot_file_with_ts(self.pipeline,
@@ -1094,7 +2277,8 @@ class AudioPreviewer(Previewer, Zoomable, Loggable):
 
                 # In case we failed previously, we won't modulate next time
                 elif not self.adapter and prev == Gst.State.PAUSED and \
-                        new == Gst.State.PLAYING and self._num_failures == 0:
+                        new == Gst.State.PLAYING and self._num_failures == 0 and \
+                        self._engine == WaveformsEngine.LEVEL:
                     self.adapter = PipelineCpuAdapter(self.pipeline)
                     self.adapter.start()
 
@@ -1112,6 +2296,23 @@ class AudioPreviewer(Previewer, Zoomable, Loggable):
 
         return 0
 
+    def _get_level_samples(self, start, end):
+        """Gets the samples of the pyramid level matching the zoom level.
+
+        Args:
+            start (int): The index of the first sample in the full resolution.
+            end (int): The index after the last sample in the full resolution.
+
+        Returns:
+            tuple: The peak samples and the RMS samples to be drawn, so that
+            there is at least one sample per pixel. They are views, the
+            renderer reads them in place.
+        """
+        samples_per_pixel = self.pixelToNs(1) / SAMPLE_DURATION
+        factor, rms, peaks = choose_level(self.levels, samples_per_pixel)
+        first, last = start // factor, -(-end // factor)
+        return peaks[first:last], rms[first:last]
+
     # pylint: disable=arguments-differ
     def do_draw(self, context):
         if not self.discovered:
@@ -1134,9 +2335,10 @@ class AudioPreviewer(Previewer, Zoomable, Loggable):
             surface_width = min(self.props.width_request - clipped_rect.x,
                                 clipped_rect.width + MARGIN)
             surface_height = int(self.get_parent().get_allocation().height)
-            self.surface = renderer.fill_surface(self.samples[start:end],
-                                                 surface_width,
-                                                 surface_height)
+            peaks, rms = self._get_level_samples(start, end)
+            self.surface = renderer.fill_envelope_surface(peaks, rms,
+                                                          surface_width,
+                                                          surface_height)
 
             self._force_redraw = False
 
@@ -1145,6 +2347,13 @@ class AudioPreviewer(Previewer, Zoomable, Loggable):
         context.paint()
 
     def startGeneration(self):
+        # The waveform might have been extracted meanwhile by the previewer
+        # of another clip of the asset.
+        if self._load_levels(self.wavefile):
+            self.emit("done")
+            return
+
+        self._launchPipeline()
         self.pipeline.set_state(Gst.State.PLAYING)
         if self.adapter is not None:
             self.adapter.start()
@@ -1162,5 +2371,6 @@ class AudioPreviewer(Previewer, Zoomable, Loggable):
 
     def release(self):
         """Stops preview generation and cleans the object."""
+        Previewer.manager.remove_previewer(self)
         self.stopGeneration()
         Zoomable.__del__(self)
@@ -38,6 +38,7 @@ from pitivi.timeline.elements import TrimHandle
 from pitivi.timeline.layer import Layer
 from pitivi.timeline.layer import LayerControls
 from pitivi.timeline.layer import SpacedSeparator
+from pitivi.timeline.previewers import Previewer
 from pitivi.timeline.ruler import ScaleRuler
 from pitivi.undo.timeline import CommitTimelineFinalizingAction
 from pitivi.utils.loggable import Loggable
@@ -105,6 +106,19 @@ GlobalSettings.addConfigOption("timelineAutoRipple",
                                key="timeline-autoripple",
                                default=False)
 
+GlobalSettings.addConfigOption('alignCompensateDrift',
+                               section="user-interface",
+                               key="align-compensate-drift",
+                               default=False,
+                               notify=True)
+
+PreferencesDialog.addTogglePreference('alignCompensateDrift',
+                                      section="timeline",
+                                      label=_("Compensate clock drift when aligning"),
+                                      description=_(
+                                          "Whether aligning the clips takes into account that the recording "
+                                          "devices ran slightly faster or slower than each other."))
+
 
 class Marquee(Gtk.Box, Loggable):
     """Widget representing a selection area inside the timeline.
@@ -375,6 +389,10 @@ class Timeline(Gtk.EventBox, Zoomable, Loggable):
         self._scrubbing = False
         self._scrolling = False
 
+        # Prioritize the previews of the clips in view.
+        self.hadj.connect("value-changed", self._hadj_changed_cb)
+        self.hadj.connect("changed", self._hadj_changed_cb)
+
         # Clip selection.
         self.selection = Selection()
         self.current_group = None
@@ -455,6 +473,7 @@ class Timeline(Gtk.EventBox, Zoomable, Loggable):
         self._project = project
         if self._project:
             self._project.pipeline.connect('position', self._positionCb)
+            self._project.pipeline.connect('state-change', self._state_change_cb)
             self.ges_timeline = self._project.ges_timeline
 
         if self.ges_timeline is None:
@@ -512,6 +531,7 @@ class Timeline(Gtk.EventBox, Zoomable, Loggable):
 
         self.__last_position = position
         self.layout.playhead_position = position
+        self.__update_previewers_viewport()
         self.layout.queue_draw()
         layout_width = self.layout.get_allocation().width
         x = self.nsToPixel(self.__last_position) - self.hadj.get_value()
@@ -520,6 +540,19 @@ class Timeline(Gtk.EventBox, Zoomable, Loggable):
         if not pipeline.playing():
             self.update_visible_overlays()
 
+    def _hadj_changed_cb(self, unused_hadj):
+        self.__update_previewers_viewport()
+
+    def __update_previewers_viewport(self):
+        """Lets the previewers of the visible clips be generated first."""
+        start = self.pixelToNs(self.hadj.get_value())
+        end = self.pixelToNs(self.hadj.get_value() + self.hadj.get_page_size())
+        Previewer.manager.set_viewport(start, end, self.__last_position)
+
+    def _state_change_cb(self, unused_pipeline, state, unused_prev_state):
+        # Leave the CPU to the playback.
+        Previewer.manager.set_busy(state == Gst.State.PLAYING)
+
     def _snapCb(self, unused_timeline, unused_obj1, unused_obj2, position):
         """Handles a clip snap update operation."""
         self.layout.snap_position = position
@@ -1052,6 +1085,7 @@ class Timeline(Gtk.EventBox, Zoomable, Loggable):
         self.zoomed_fitted = False
 
         self.updatePosition()
+        self.__update_previewers_viewport()
 
     def set_best_zoom_ratio(self, allow_zoom_in=False):
         """Sets the zoom level so that the entire timeline is in view."""
@@ -1693,7 +1727,8 @@ class TimelineContainer(Gtk.Grid, Zoomable, Loggable):
             self._project.pipeline.commit_timeline()
             progress_dialog.window.destroy()
 
-        auto_aligner = AutoAligner(self.timeline.selection, alignedCb)
+        auto_aligner = AutoAligner(self.timeline.selection, alignedCb,
+                                   self.app.settings.alignCompensateDrift)
         try:
             progress_meter = auto_aligner.start()
             progress_meter.addWatcher(progress_dialog.updatePosition)
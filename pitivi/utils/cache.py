@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+"""Storage of the previews of the assets.
+
+Can be run to report or prune the previews stored on disk:
+
+    python3 -m pitivi.utils.cache report
+    python3 -m pitivi.utils.cache prune --max-size 1024
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import time
+
+from pitivi.settings import xdg_cache_home
+from pitivi.utils.misc import hash_file
+
+STORE_FILENAME = "previews.db"
+# The version of the layout of the cache, stored as the user_version of
+# the database.
+SCHEMA_VERSION = 2
+WAVES_DIRNAME = "waves"
+# The directory where each asset had its own thumbnails database.
+LEGACY_THUMBS_DIRNAME = "thumbs"
+# The seconds after which the unused files without previews are unindexed.
+FILES_MAX_AGE = 90 * 24 * 3600
+# The seconds between the updates of the access time of an indexed file.
+FILES_TOUCH_INTERVAL = 24 * 3600
+# The seconds after which a waveform file still being written is considered
+# left behind by a crashed process.
+PARTIAL_WAVES_MAX_AGE = 24 * 3600
+
+
+class PreviewsStore(object):
+    """Stores the thumbnails and the waveforms of the assets.
+
+    The previews are keyed by the hash of the content of the assets. The
+    thumbnails of all the assets are stored in a single database. The
+    waveforms are stored in files next to it, so they can be memory-mapped.
+
+    The database also records when the previews of each asset have been
+    used last, for evicting the least recently used ones, and the aliases
+    of the proxies, which share the previews of their assets. It also
+    indexes the hash and the media info of the files, so they are not
+    computed again for the unchanged files.
+
+    Attributes:
+        cache_dir (str): The directory containing the previews.
+        path (str): The path of the database.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, STORE_FILENAME)
+        self.db = sqlite3.connect(self.path)
+        # Allow shrinking the file after evicting previews.
+        self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # Let the writer thread write while the thumbnails are being read.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            self._migrate(version)
+        self.db.execute("CREATE TABLE IF NOT EXISTS Thumbs\
+                        (Hash TEXT NOT NULL,\
+                        Time INTEGER NOT NULL,\
+                        Jpeg BLOB NOT NULL,\
+                        ActualTime INTEGER,\
+                        PRIMARY KEY (Hash, Time))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS Assets\
+                        (Hash TEXT NOT NULL PRIMARY KEY,\
+                        AccessTime REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS Aliases\
+                        (Hash TEXT NOT NULL PRIMARY KEY,\
+                        Target TEXT NOT NULL)")
+        # The thumbnail shown in the media library for each asset.
+        self.db.execute("CREATE TABLE IF NOT EXISTS LibraryThumbs\
+                        (Hash TEXT NOT NULL PRIMARY KEY,\
+                        Jpeg BLOB NOT NULL)")
+        # The index of the files, which is valid as long as they are not
+        # modified, even if they are renamed.
+        self.db.execute("CREATE TABLE IF NOT EXISTS Files\
+                        (Dev INTEGER NOT NULL,\
+                        Inode INTEGER NOT NULL,\
+                        Size INTEGER NOT NULL,\
+                        MTime INTEGER NOT NULL,\
+                        Hash TEXT NOT NULL,\
+                        Info TEXT,\
+                        AccessTime REAL NOT NULL,\
+                        PRIMARY KEY (Dev, Inode, Size, MTime))")
+        self.db.commit()
+        # The assets for which the access time has been updated.
+        self._touched = set()
+        # The hashes by (path, dev, inode, size, mtime) of the files.
+        self._hashes = {}
+
+    def _migrate(self, version):
+        """Upgrades the cache created by an older version of Pitivi."""
+        if version < 1:
+            # Each asset used to have its own thumbnails database.
+            shutil.rmtree(os.path.join(self.cache_dir, LEGACY_THUMBS_DIRNAME),
+                          ignore_errors=True)
+            waves_dir = os.path.join(self.cache_dir, WAVES_DIRNAME)
+            if os.path.isdir(waves_dir):
+                for entry in os.scandir(waves_dir):
+                    if entry.is_symlink():
+                        # The waveforms of the proxies are now aliases.
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+        if version < 2:
+            # The files were indexed regardless of their device.
+            self.db.execute("DROP TABLE IF EXISTS Files")
+        self.db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        self.db.commit()
+        if version < 2:
+            # The auto_vacuum mode of an existing database changes only
+            # when it's rebuilt.
+            self.db.execute("VACUUM")
+
+    @staticmethod
+    def _get_file_key(path):
+        stat = os.stat(path)
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def close(self):
+        """Closes the database."""
+        self.db.close()
+
+    def get_hash(self, path):
+        """Gets the hash of the specified file, which is the key of its previews.
+
+        The hashes are memoized in memory and in the database, so a file is
+        hashed again only when it changes.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            str: The hash computed by `hash_file`.
+        """
+        file_key = self._get_file_key(path)
+        key = (path,) + file_key
+        filehash = self._hashes.get(key)
+        if filehash:
+            return filehash
+
+        now = time.time()
+        row = self.db.execute("SELECT Hash, AccessTime FROM Files WHERE Dev = ? AND\
+                              Inode = ? AND Size = ? AND MTime = ?",
+                              file_key).fetchone()
+        if row:
+            filehash, access_time = row
+            if now - access_time > FILES_TOUCH_INTERVAL:
+                self.db.execute("UPDATE Files SET AccessTime = ? WHERE Dev = ? AND\
+                                Inode = ? AND Size = ? AND MTime = ?",
+                                (now,) + file_key)
+                self.db.commit()
+        else:
+            filehash = hash_file(path)
+            self.db.execute("INSERT OR REPLACE INTO Files VALUES (?, ?, ?, ?, ?, NULL, ?)",
+                            file_key + (filehash, now))
+            self.db.commit()
+        self._hashes[key] = filehash
+        return filehash
+
+    def get_media_info(self, path):
+        """Gets the media info saved for the specified file.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            str: The serialized info, or None if it's missing or the file
+            changed since it has been saved.
+        """
+        row = self.db.execute("SELECT Info FROM Files WHERE Dev = ? AND\
+                              Inode = ? AND Size = ? AND MTime = ?",
+                              self._get_file_key(path)).fetchone()
+        return row[0] if row else None
+
+    def set_media_info(self, path, info):
+        """Saves the media info of the specified file.
+
+        Args:
+            path (str): The path of the file.
+            info (str): The serialized info.
+        """
+        self.get_hash(path)
+        self.db.execute("UPDATE Files SET Info = ? WHERE Dev = ? AND\
+                        Inode = ? AND Size = ? AND MTime = ?",
+                        (info,) + self._get_file_key(path))
+        self.db.commit()
+
+    def resolve(self, filehash):
+        """Gets the hash under which the previews of an asset are stored.
+
+        Args:
+            filehash (str): The hash of the asset, possibly a proxy.
+
+        Returns:
+            str: The hash of the asset whose previews are shared, if any,
+            otherwise `filehash`.
+        """
+        row = self.db.execute("SELECT Target FROM Aliases WHERE Hash = ?",
+                              (filehash,)).fetchone()
+        return row[0] if row else filehash
+
+    def set_alias(self, filehash, target):
+        """Makes an asset share the previews of another asset.
+
+        Args:
+            filehash (str): The hash of the asset, usually a proxy.
+            target (str): The hash of the asset owning the previews.
+        """
+        if filehash == target:
+            return
+        self.db.execute("INSERT OR REPLACE INTO Aliases VALUES (?, ?)",
+                        (filehash, target))
+        self.db.commit()
+
+    def touch(self, filehash):
+        """Marks the previews of the specified asset as used now.
+
+        The access time is updated once per session.
+
+        Args:
+            filehash (str): The hash under which the previews are stored.
+        """
+        if filehash in self._touched:
+            return
+        self._touched.add(filehash)
+        self.db.execute("INSERT OR REPLACE INTO Assets VALUES (?, ?)",
+                        (filehash, time.time()))
+        self.db.commit()
+
+    def get_wavefile(self, filehash):
+        """Gets the path of the waveform file of the specified asset.
+
+        Args:
+            filehash (str): The hash of the asset, possibly a proxy.
+
+        Returns:
+            str: The path of the file, which might not exist yet.
+        """
+        filehash = self.resolve(filehash)
+        self.touch(filehash)
+        waves_dir = os.path.join(self.cache_dir, WAVES_DIRNAME)
+        os.makedirs(waves_dir, exist_ok=True)
+        return os.path.join(waves_dir, filehash + ".wave")
+
+    def get_usage(self):
+        """Gets the disk usage of the previews of each asset.
+
+        Returns:
+            List[tuple]: The hash, the last access time and the size in bytes
+            of the previews of each asset, the least recently used first.
+        """
+        access_times = dict(self.db.execute("SELECT Hash, AccessTime FROM Assets"))
+        sizes = dict(self.db.execute(
+            "SELECT Hash, SUM(LENGTH(Jpeg)) FROM Thumbs GROUP BY Hash"))
+        for filehash, size in self.db.execute(
+                "SELECT Hash, LENGTH(Jpeg) FROM LibraryThumbs"):
+            sizes[filehash] = sizes.get(filehash, 0) + size
+
+        waves_dir = os.path.join(self.cache_dir, WAVES_DIRNAME)
+        try:
+            entries = list(os.scandir(waves_dir))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            filehash, ext = os.path.splitext(entry.name)
+            if ext != ".wave" or not entry.is_file(follow_symlinks=False):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            sizes[filehash] = sizes.get(filehash, 0) + stat.st_size
+            # The waveforms saved by older versions are not in Assets.
+            access_times.setdefault(filehash, stat.st_mtime)
+
+        usage = [(filehash, access_times.get(filehash, 0), sizes.get(filehash, 0))
+                 for filehash in set(access_times) | set(sizes)]
+        return sorted(usage, key=lambda item: item[1])
+
+    def evict(self, filehash):
+        """Removes the previews of the specified asset.
+
+        Args:
+            filehash (str): The hash under which the previews are stored.
+        """
+        self._delete_rows(filehash)
+        self.db.commit()
+        self._remove_wavefile(filehash)
+
+    def _delete_rows(self, filehash):
+        self.db.execute("DELETE FROM Thumbs WHERE Hash = ?", (filehash,))
+        self.db.execute("DELETE FROM LibraryThumbs WHERE Hash = ?", (filehash,))
+        self.db.execute("DELETE FROM Assets WHERE Hash = ?", (filehash,))
+        self.db.execute("DELETE FROM Aliases WHERE Hash = ? OR Target = ?",
+                        (filehash, filehash))
+        self.db.execute("DELETE FROM Files WHERE Hash = ?", (filehash,))
+        self._touched.discard(filehash)
+
+    def _remove_wavefile(self, filehash):
+        try:
+            os.remove(os.path.join(self.cache_dir, WAVES_DIRNAME, filehash + ".wave"))
+        except FileNotFoundError:
+            pass
+
+    def prune(self, max_size):
+        """Evicts the least recently used previews until they fit.
+
+        Args:
+            max_size (int): The maximum size in bytes of the previews.
+
+        Returns:
+            List[str]: The hashes of the evicted assets.
+        """
+        self.db.commit()
+        # Take the write lock before reading the access times, so the
+        # previews used meanwhile by another instance are not evicted.
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            usage = self.get_usage()
+            total = sum(size for unused_hash, unused_time, size in usage)
+            evicted = []
+            for filehash, unused_access_time, size in usage:
+                if total <= max_size:
+                    break
+                self._delete_rows(filehash)
+                evicted.append(filehash)
+                total -= size
+
+            # Forget the files which have not been used for a long time,
+            # unless they have previews.
+            self.db.execute("DELETE FROM Files WHERE AccessTime < ? AND\
+                            Hash NOT IN (SELECT Hash FROM Assets) AND\
+                            Hash NOT IN (SELECT Hash FROM Aliases) AND\
+                            Hash NOT IN (SELECT Hash FROM Thumbs) AND\
+                            Hash NOT IN (SELECT Hash FROM LibraryThumbs)",
+                            (time.time() - FILES_MAX_AGE,))
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+        for filehash in evicted:
+            self._remove_wavefile(filehash)
+        if evicted:
+            self.db.execute("PRAGMA incremental_vacuum")
+            self.db.commit()
+        self._remove_partial_waves()
+        return evicted
+
+    def _remove_partial_waves(self):
+        """Removes the waveform files left partially written."""
+        waves_dir = os.path.join(self.cache_dir, WAVES_DIRNAME)
+        try:
+            entries = list(os.scandir(waves_dir))
+        except FileNotFoundError:
+            return
+        max_mtime = time.time() - PARTIAL_WAVES_MAX_AGE
+        for entry in entries:
+            if not entry.name.endswith(".part"):
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime < max_mtime:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def main(argv=None):
+    """Reports or prunes the previews stored on disk."""
+    parser = argparse.ArgumentParser(description="Manage the Pitivi previews cache.")
+    parser.add_argument("--cache-dir", default=xdg_cache_home(autocreate=False),
+                        help="the Pitivi cache directory")
+    subparsers = parser.add_subparsers(dest="command")
+    report_parser = subparsers.add_parser("report", help="show the disk usage")
+    report_parser.add_argument("-v", "--verbose", action="store_true",
+                               help="show the usage of each asset")
+    prune_parser = subparsers.add_parser(
+        "prune", help="evict the least recently used previews")
+    prune_parser.add_argument("--max-size", type=int, required=True,
+                              help="the size to fit in, in MiB")
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 1
+
+    if not os.path.isdir(args.cache_dir):
+        print("No cache in %s" % args.cache_dir)
+        return 0
+    store = PreviewsStore(args.cache_dir)
+    try:
+        if args.command == "report":
+            usage = store.get_usage()
+            if args.verbose:
+                for filehash, access_time, size in usage:
+                    print("%s  %s  %10.1f MiB" % (
+                        filehash, time.strftime("%Y-%m-%d %H:%M", time.localtime(access_time)),
+                        size / 2 ** 20))
+            total = sum(size for unused_hash, unused_time, size in usage)
+            print("%d assets, %.1f MiB of previews" % (len(usage), total / 2 ** 20))
+        else:
+            evicted = store.prune(args.max_size * 2 ** 20)
+            print("Evicted the previews of %d assets" % len(evicted))
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
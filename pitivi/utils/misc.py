@@ -39,6 +39,9 @@ from pitivi.configure import APPMANUALURL_ONLINE
 from pitivi.configure import APPNAME
 from pitivi.utils.threads import Thread
 
+# The size of the samples of the beginning and of the end of the files hashed.
+HASH_SAMPLE_SIZE = 256 * 1024
+
 
 # Work around https://bugzilla.gnome.org/show_bug.cgi?id=759249
 def disconnectAllByFunc(obj, func):
@@ -211,15 +214,27 @@ class PathWalker(Thread):
         self.stopme.set()
 
 
-def hash_file(uri):
-    """Hashes the first 256KB of the specified file."""
+def hash_file(path):
+    """Hashes the specified file.
+
+    Only the first and the last 256KB of the file are read. The size and
+    the modification time are hashed too, so files with identical headers,
+    such as the recordings of a camera, get different hashes.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        str: The hex digest.
+    """
+    stat = os.stat(path)
     sha256 = hashlib.sha256()
-    with open(uri, "rb") as file:
-        for _ in range(1024):
-            chunk = file.read(256)
-            if not chunk:
-                break
-            sha256.update(chunk)
+    sha256.update(b"%d %d\n" % (stat.st_size, stat.st_mtime_ns))
+    with open(path, "rb") as file:
+        sha256.update(file.read(HASH_SAMPLE_SIZE))
+        if stat.st_size > HASH_SAMPLE_SIZE:
+            file.seek(max(HASH_SAMPLE_SIZE, stat.st_size - HASH_SAMPLE_SIZE))
+            sha256.update(file.read(HASH_SAMPLE_SIZE))
     return sha256.hexdigest()
 
 
@@ -382,6 +382,7 @@ class ProxyManager(GObject.Object, Loggable):
 
         thumbnailbin = Gst.ElementFactory.make("teedthumbnailbin")
         thumbnailbin.props.uri = asset.get_id()
+        thumbnailbin.props.duration = asset.get_duration()
 
         waveformbin = Gst.ElementFactory.make("waveformbin")
         waveformbin.props.uri = asset.get_id()
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+"""Helpers for handling the waveform data of the audio previewers."""
+import os
+import struct
+import tempfile
+
+import numpy
+
+# The decimation factors of the pyramid levels, relative to the samples
+# extracted by the waveform previewer. The first level holds the samples.
+PYRAMID_DECIMATIONS = (1, 4, 16, 64)
+# The rows of each level of the pyramid.
+RMS_ROW = 0
+PEAK_ROW = 1
+
+# The layout of a waveform file is:
+# - the header: magic, format version, number of levels,
+# - for each level: the decimation factor and the number of samples,
+# - the float32 RMS samples followed by the float32 peak samples of each
+#   level, for all the levels, contiguously.
+WAVEFORM_FILE_MAGIC = b"PTVWAVE\0"
+WAVEFORM_FILE_VERSION = 2
+_HEADER = struct.Struct("<8sII")
+_LEVEL_HEADER = struct.Struct("<IQ")
+
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# The permissions of the waveform files, as if created with open().
+_FILE_MODE = 0o666 & ~_get_umask()
+
+
+def decimate(samples, factor, reduce=numpy.mean):
+    """Reduces each `factor` consecutive samples to a value.
+
+    The last value reduces the remaining samples, if any.
+
+    Args:
+        samples (numpy.ndarray): The samples to decimate.
+        factor (int): The number of samples reduced to a value.
+        reduce (function): The numpy function reducing the samples, by
+            default they are averaged.
+
+    Returns:
+        numpy.ndarray: The decimated samples.
+    """
+    samples = numpy.asarray(samples, dtype=numpy.float32)
+    if factor == 1:
+        return samples
+
+    length = len(samples) // factor * factor
+    level = reduce(samples[:length].reshape(-1, factor), axis=1)
+    if length < len(samples):
+        level = numpy.append(level, reduce(samples[length:]))
+    return level.astype(numpy.float32)
+
+
+def build_pyramid(samples, peaks=None, decimations=PYRAMID_DECIMATIONS):
+    """Builds the mip-map style levels of the specified samples.
+
+    Each level has two rows. The `RMS_ROW` averages the RMS values of the
+    samples, which is what the renderer does anyway when it has more than
+    one sample per pixel. The `PEAK_ROW` keeps the maximum of the peak
+    values, so the transients are not flattened when zoomed out.
+
+    Args:
+        samples (numpy.ndarray): The RMS samples of the waveform.
+        peaks (Optional[numpy.ndarray]): The peak samples of the waveform.
+            By default the RMS samples are used.
+        decimations (List[int]): The decimation factor of each level.
+
+    Returns:
+        List[numpy.ndarray]: The levels, from the finest to the coarsest.
+    """
+    if peaks is None:
+        peaks = samples
+    return [numpy.vstack((decimate(samples, factor),
+                          decimate(peaks, factor, numpy.max)))
+            for factor in decimations]
+
+
+def choose_level(levels, samples_per_pixel, decimations=PYRAMID_DECIMATIONS):
+    """Gets the coarsest level not coarser than a pixel.
+
+    Args:
+        levels (List[numpy.ndarray]): The levels of the pyramid.
+        samples_per_pixel (float): The number of samples represented by
+            a pixel at the current zoom level.
+        decimations (List[int]): The decimation factor of each level.
+
+    Returns:
+        tuple: The decimation factor of the level to be drawn, its RMS
+        samples and its peak samples.
+    """
+    index = 0
+    for i, factor in enumerate(decimations):
+        if factor <= samples_per_pixel:
+            index = i
+    level = levels[index]
+    return decimations[index], level[RMS_ROW], level[PEAK_ROW]
+
+
+def save_waveform(path, levels, decimations=PYRAMID_DECIMATIONS):
+    """Saves the waveform pyramid to the specified file.
+
+    The file is written next to the destination and then moved in place,
+    so a reader never sees a partially written file.
+
+    Args:
+        path (str): The path of the file.
+        levels (List[numpy.ndarray]): The levels of the pyramid.
+        decimations (List[int]): The decimation factor of each level.
+    """
+    # A unique file, in case the same waveform is saved concurrently.
+    fd, tmp_path = tempfile.mkstemp(suffix=".part",
+                                    dir=os.path.dirname(path) or None)
+    try:
+        # mkstemp creates the file readable only by the user.
+        os.fchmod(fd, _FILE_MODE)
+        with os.fdopen(fd, "wb") as wavefile:
+            wavefile.write(_HEADER.pack(WAVEFORM_FILE_MAGIC,
+                                        WAVEFORM_FILE_VERSION, len(levels)))
+            for factor, level in zip(decimations, levels):
+                wavefile.write(_LEVEL_HEADER.pack(factor, level.shape[1]))
+            for level in levels:
+                numpy.ascontiguousarray(level, dtype="<f4").tofile(wavefile)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_waveform(path, decimations=PYRAMID_DECIMATIONS):
+    """Maps the waveform pyramid stored in the specified file.
+
+    The samples are not read, they are paged in by the OS when accessed.
+
+    Args:
+        path (str): The path of the file.
+        decimations (List[int]): The expected decimation factor of each level.
+
+    Returns:
+        List[numpy.ndarray]: The levels of the pyramid, each with an RMS row
+        and a peak row, or None if the file is missing or it has not been
+        written in the current format.
+    """
+    try:
+        with open(path, "rb") as wavefile:
+            header = wavefile.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return None
+            magic, version, n_levels = _HEADER.unpack(header)
+            if magic != WAVEFORM_FILE_MAGIC or version != WAVEFORM_FILE_VERSION \
+                    or n_levels != len(decimations):
+                return None
+            level_headers = wavefile.read(_LEVEL_HEADER.size * n_levels)
+    except FileNotFoundError:
+        return None
+
+    lengths = []
+    for i, expected_factor in enumerate(decimations):
+        factor, length = _LEVEL_HEADER.unpack_from(level_headers,
+                                                   i * _LEVEL_HEADER.size)
+        if factor != expected_factor:
+            return None
+        lengths.append(length)
+    offset = _HEADER.size + _LEVEL_HEADER.size * n_levels
+    if os.path.getsize(path) != offset + 2 * 4 * sum(lengths):
+        return None
+    if not sum(lengths):
+        return [numpy.zeros((2, 0), dtype=numpy.float32) for unused_length in lengths]
+
+    data = numpy.memmap(path, dtype="<f4", mode="r", offset=offset,
+                        shape=(2 * sum(lengths),))
+    levels = []
+    start = 0
+    for length in lengths:
+        levels.append(data[start:start + 2 * length].reshape(2, length))
+        start += 2 * length
+    return levels
+
+
+class LevelsAccumulator(object):
+    """Collects the RMS and peak values posted by a `level` element.
+
+    The values are stored in an array preallocated for the expected number
+    of samples. The messages are buffered and the samples between the
+    positions of consecutive messages are filled in batches, by linearly
+    joining the known values.
+
+    Attributes:
+        n_channels (int): The number of channels.
+        values (numpy.ndarray): The RMS samples of each channel, followed
+            by the peak samples of each channel.
+    """
+
+    # The number of messages buffered before they are processed.
+    BATCH_SIZE = 256
+
+    def __init__(self, n_samples, n_channels):
+        self.n_channels = n_channels
+        self.values = numpy.zeros((2 * n_channels, int(n_samples)),
+                                  dtype=numpy.float32)
+        self._positions = []
+        self._values = []
+        # The position of the last sample processed.
+        self._last_pos = 0
+
+    def add(self, pos, rms_values, peak_values=None):
+        """Adds the values of the channels at the specified position.
+
+        Args:
+            pos (int): The index of the sample.
+            rms_values (List[float]): The RMS value in dB of each channel.
+                Non-negative values are replaced with the previous value.
+            peak_values (Optional[List[float]]): The peak value in dB of
+                each channel. By default the RMS values are used.
+        """
+        if pos >= self.values.shape[1]:
+            return
+        if peak_values is None:
+            peak_values = rms_values
+        values = list(rms_values) + list(peak_values)
+
+        last_pos = self._positions[-1] if self._positions else self._last_pos
+        if pos <= last_pos:
+            # Went back, for example because the pipeline has been seeked.
+            self.flush()
+            # At the start, there is no previous value.
+            previous = self.values[:, pos - 1] if pos else numpy.zeros(len(values))
+            values = self._to_linear(numpy.array([values], dtype=numpy.float64),
+                                     previous)
+            self.values[:, pos] = values[0]
+            self._last_pos = pos
+            return
+
+        self._positions.append(pos)
+        self._values.append(values)
+        if len(self._positions) >= self.BATCH_SIZE:
+            self.flush()
+
+    @staticmethod
+    def _to_linear(values, previous):
+        """Converts the dB values to the [0, 100] linear range.
+
+        Args:
+            values (numpy.ndarray): The dB values, one row per position.
+            previous (numpy.ndarray): The values replacing the non-negative
+                values in the first row.
+
+        Returns:
+            numpy.ndarray: The linear values.
+        """
+        with numpy.errstate(invalid="ignore"):
+            linear = numpy.where(values < 0, 10 ** (values / 20) * 100, numpy.nan)
+        linear = numpy.vstack((previous, linear))
+        # Propagate the previous valid value over the NaNs, for each channel.
+        valid = ~numpy.isnan(linear)
+        indexes = numpy.where(valid, numpy.arange(len(linear))[:, None], 0)
+        numpy.maximum.accumulate(indexes, axis=0, out=indexes)
+        return numpy.take_along_axis(linear, indexes, axis=0)[1:]
+
+    def flush(self):
+        """Processes the buffered values."""
+        if not self._positions:
+            return
+
+        anchor = self._last_pos
+        positions = numpy.array([anchor] + self._positions)
+        values = self._to_linear(numpy.array(self._values, dtype=numpy.float64),
+                                 self.values[:, anchor])
+        values = numpy.vstack((self.values[:, anchor], values))
+        self._positions = []
+        self._values = []
+
+        # Each unknown sample is joined linearly between the previous known
+        # sample and the sample before the next known sample, which has the
+        # value of the next known sample.
+        gaps = positions[1:] - positions[:-1] > 1
+        knots = numpy.concatenate((positions, positions[1:][gaps] - 1))
+        knot_values = numpy.vstack((values, values[1:][gaps]))
+        order = numpy.argsort(knots)
+        knots = knots[order]
+        knot_values = knot_values[order]
+
+        last = positions[-1]
+        xs = numpy.arange(anchor, last + 1)
+        for row in range(self.values.shape[0]):
+            self.values[row, anchor:last + 1] = numpy.interp(
+                xs, knots, knot_values[:, row])
+        self._last_pos = int(last)
+
+    def get_samples(self):
+        """Gets the mono RMS samples.
+
+        Returns:
+            numpy.ndarray: The average of the first two channels.
+        """
+        self.flush()
+        if self.n_channels > 1:
+            return (self.values[0] + self.values[1]) / 2
+        return self.values[0].copy()
+
+    def get_peaks(self):
+        """Gets the mono peak samples.
+
+        Returns:
+            numpy.ndarray: The maximum of the first two channels.
+        """
+        self.flush()
+        peaks = self.values[self.n_channels:self.n_channels + 2]
+        return peaks.max(axis=0)
+
+
+class PcmAccumulator(object):
+    """Computes the RMS and peak values of decoded audio, per sample duration.
+
+    It provides the samples like `LevelsAccumulator`, but it receives the
+    raw samples instead of the messages of a `level` element.
+
+    Attributes:
+        rate (int): The sample rate of the audio.
+    """
+
+    def __init__(self, n_samples, n_channels, rate, samples_per_second=100):
+        self.rate = rate
+        self._samples_per_second = samples_per_second
+        # Only the first two channels are used for the mono samples.
+        n_channels = min(n_channels, 2)
+        self._squares = numpy.zeros((n_channels, int(n_samples)))
+        self._peaks = numpy.zeros((n_channels, int(n_samples)), dtype=numpy.float32)
+        self._counts = numpy.zeros(int(n_samples))
+        # The index of the next audio frame, when the timestamps are missing.
+        self._next_frame = 0
+
+    def add(self, frames, offset=None):
+        """Adds decoded audio frames.
+
+        Args:
+            frames (numpy.ndarray): The interleaved float samples, one row
+                per frame and one column per channel.
+            offset (Optional[int]): The index of the first frame in the
+                stream, or None if it follows the previous frames.
+        """
+        if offset is None:
+            offset = self._next_frame
+        self._next_frame = offset + len(frames)
+        if not len(frames):
+            return
+
+        # The index of the sample to which each frame contributes.
+        indexes = (numpy.arange(offset, offset + len(frames), dtype=numpy.int64) *
+                   self._samples_per_second) // self.rate
+        first = int(indexes[0])
+        if first >= len(self._counts):
+            return
+        indexes -= first
+        end = min(first + int(indexes[-1]) + 1, len(self._counts))
+
+        counts = numpy.bincount(indexes)[:end - first]
+        self._counts[first:end] += counts
+        # The frames before the end, and the first frame of each sample,
+        # the indexes being sorted.
+        n_frames = numpy.searchsorted(indexes, end - first)
+        starts = numpy.flatnonzero(numpy.diff(indexes[:n_frames], prepend=-1))
+        sample_indexes = first + indexes[starts]
+        for channel in range(self._squares.shape[0]):
+            column = frames[:, channel].astype(numpy.float64)
+            squares = numpy.bincount(indexes, weights=column * column)
+            self._squares[channel, first:end] += squares[:end - first]
+            peaks = numpy.maximum.reduceat(numpy.abs(column[:n_frames]), starts)
+            self._peaks[channel, sample_indexes] = numpy.maximum(
+                self._peaks[channel, sample_indexes], peaks)
+
+    def get_samples(self):
+        """Gets the mono samples.
+
+        Returns:
+            numpy.ndarray: The average of the RMS values of the first two
+            channels, scaled like the linear values of `LevelsAccumulator`.
+        """
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            rms = numpy.sqrt(self._squares / self._counts) * 100
+        rms[:, self._counts == 0] = 0
+        return rms.mean(axis=0).astype(numpy.float32)
+
+    def get_peaks(self):
+        """Gets the mono peak samples.
+
+        Returns:
+            numpy.ndarray: The maximum of the absolute values of the first
+            two channels, scaled like the linear values of `LevelsAccumulator`.
+        """
+        return self._peaks.max(axis=0) * 100
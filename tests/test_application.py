@@ -22,6 +22,8 @@ from unittest import mock
 
 from pitivi import application
 from pitivi import configure
+from pitivi.timeline.previewers import ThumbnailsScaling
+from pitivi.timeline.previewers import VideoPreviewer
 from tests import common
 
 
@@ -108,3 +110,22 @@ class TestPitivi(common.TestCase):
         with mock.patch.object(app, "inhibit") as inhibit_mock:
             app.simple_inhibit("reason1", "flags1")
             self.assertTrue(inhibit_mock.called)
+
+    def test_thumbnails_settings_changed(self):
+        app = application.Pitivi()
+        with mock.patch.multiple(application, ThreadMaster=mock.DEFAULT,
+                                 EffectsManager=mock.DEFAULT,
+                                 ProxyManager=mock.DEFAULT),\
+                mock.patch.object(app, "_createActions"),\
+                mock.patch.object(app, "_syncDoUndo"):
+            app._setup()
+
+        with mock.patch.object(VideoPreviewer.idle_pipelines, "clear") as clear:
+            app.settings.previewersMaxJobs = 1
+            self.assertFalse(clear.called)
+
+            # The parked pipelines have been created with other settings.
+            app.settings.thumbnailsScalingMethod = ThumbnailsScaling.NEAREST
+            app.settings.thumbnailsDecoderThreads = 2
+            app.settings.thumbnailsDecoderLowres = True
+            self.assertEqual(clear.call_count, 3)
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+"""Tests for the autoaligner module."""
+# pylint: disable=missing-docstring,protected-access,no-self-use
+import time
+from unittest import mock
+from unittest import TestCase
+
+import numpy
+from gi.repository import Gst
+
+from pitivi.autoaligner import affinealign
+from pitivi.autoaligner import AutoAligner
+from pitivi.autoaligner import coarse_to_fine_rigidalign
+from pitivi.autoaligner import resample_envelope
+from pitivi.autoaligner import rigidalign
+from tests import common
+
+
+class TestEnvelopes(TestCase):
+
+    def test_resample_envelope(self):
+        # One sample every 10 ms.
+        samples = numpy.arange(1000, dtype=numpy.float32)
+        envelope = resample_envelope(samples, Gst.SECOND, Gst.SECOND, 25)
+        self.assertEqual(len(envelope), 25)
+        self.assertEqual(envelope[:2].tolist(), [101.5, 105.5])
+
+        # The samples are interpolated when the rates are not multiples.
+        envelope = resample_envelope(samples, 0, Gst.SECOND, 30)
+        self.assertEqual(len(envelope), 30)
+        self.assertAlmostEqual(envelope[0], 1.16666, places=4)
+
+    def test_align_cached_envelopes(self):
+        samples = numpy.random.rand(3000).astype(numpy.float32)
+        reference = resample_envelope(samples, 0, 20 * Gst.SECOND, 25)
+        target = resample_envelope(samples, 4 * Gst.SECOND, 10 * Gst.SECOND, 25)
+        shift, = rigidalign(reference, [target])
+        self.assertAlmostEqual(shift, 4 * 25, delta=0.5)
+
+
+def create_envelope(random, length):
+    """Creates a smooth random signal, like the envelope of a recording."""
+    noise = random.rand(length + 16)
+    return numpy.convolve(noise, numpy.ones(16) / 16, mode="valid")[:length]
+
+
+class TestRigidAlign(TestCase):
+
+    def _create_targets(self, random, reference, offsets, length):
+        targets = []
+        for offset in offsets:
+            start = max(offset, 0)
+            target = reference[start:start + length].copy()
+            if offset < 0:
+                # The target starts before the reference.
+                target = numpy.concatenate((random.rand(-offset), target))
+            targets.append(target + random.rand(len(target)) * 0.1)
+        return targets
+
+    def test_same_shifts(self):
+        random = numpy.random.RandomState(0)
+        reference = create_envelope(random, 20000)
+        offsets = [0, 5, 1234, 9999, -17, -3000]
+        targets = self._create_targets(random, reference, offsets, 5000)
+
+        expected = rigidalign(reference, targets)
+        for shift, offset in zip(expected, offsets):
+            self.assertAlmostEqual(shift, offset, delta=1)
+        shifts = coarse_to_fine_rigidalign(reference, targets)
+        for shift, expected_shift in zip(shifts, expected):
+            self.assertIs(type(shift), float)
+            self.assertAlmostEqual(shift, expected_shift, places=5)
+
+    def test_batched_targets(self):
+        random = numpy.random.RandomState(2)
+        reference = create_envelope(random, 5000)
+        targets = self._create_targets(random, reference, [10, -200, 3000], 1000)
+        targets.append(create_envelope(random, 4000))
+
+        shifts = rigidalign(reference, targets)
+        for target, shift in zip(targets, shifts):
+            expected_shift, = rigidalign(reference, [target])
+            self.assertAlmostEqual(shift, expected_shift, places=5)
+
+        with mock.patch("pitivi.autoaligner.scipy_fft", None):
+            numpy_shifts = rigidalign(reference, targets)
+        for shift, numpy_shift in zip(shifts, numpy_shifts):
+            self.assertAlmostEqual(shift, numpy_shift, places=5)
+
+    def test_max_offset(self):
+        random = numpy.random.RandomState(1)
+        reference = create_envelope(random, 10000)
+        targets = self._create_targets(random, reference, [100, 2000, -300], 3000)
+
+        for align in (rigidalign, coarse_to_fine_rigidalign):
+            shifts = align(reference, targets, max_offset=500)
+            self.assertAlmostEqual(shifts[0], 100, delta=1)
+            self.assertLessEqual(abs(shifts[1]), 501)
+            self.assertAlmostEqual(shifts[2], -300, delta=1)
+
+
+def create_clip(**props):
+    """Creates a mock GES.Clip with the specified properties."""
+    clip = mock.Mock()
+    clip.props = mock.Mock(**props)
+    return clip
+
+
+def create_drifting_target(random, reference, offset, drift, length):
+    """Resamples the reference as recorded by a device with another clock."""
+    positions = offset + numpy.arange(length) * (1 + drift)
+    target = numpy.interp(positions, numpy.arange(len(reference)), reference)
+    return target + random.rand(length) * 0.05
+
+
+class TestAffineAlign(TestCase):
+
+    def test_drifts(self):
+        random = numpy.random.RandomState(4)
+        reference = create_envelope(random, 40000)
+        params = [(1000, 0), (5000, 0.001), (300, -0.003), (-200, 0.0002)]
+        targets = [create_drifting_target(random, reference, offset, drift, 20000)
+                   for offset, drift in params]
+
+        offsets, drifts = affinealign(reference, targets)
+        for (offset, drift), found_offset, found_drift in zip(params, offsets, drifts):
+            self.assertAlmostEqual(found_offset, offset, delta=1)
+            self.assertAlmostEqual(found_drift, drift, delta=0.0001)
+
+    def test_short_target(self):
+        random = numpy.random.RandomState(5)
+        reference = create_envelope(random, 40000)
+        targets = [reference[0:300], reference[12345:12745]]
+        offsets, drifts = affinealign(reference, targets)
+        for offset, target in zip(offsets, targets):
+            self.assertAlmostEqual(offset, rigidalign(reference, [target])[0])
+        self.assertAlmostEqual(offsets[0], 0, delta=1)
+        self.assertAlmostEqual(offsets[1], 12345, delta=1)
+        self.assertEqual(drifts, [0, 0])
+
+    def test_no_agreement(self):
+        random = numpy.random.RandomState(6)
+        reference = create_envelope(random, 40000)
+        # The blocks of an unrelated signal match at random places.
+        target = create_envelope(random, 1000)
+        offsets, drifts = affinealign(reference, [target])
+        self.assertAlmostEqual(offsets[0], rigidalign(reference, [target])[0])
+        self.assertEqual(drifts, [0])
+
+
+class TestRigidAlignBenchmark(common.TestCase):
+    """Benchmarks the alignment of many targets."""
+
+    def test_batched_targets(self):
+        random = numpy.random.RandomState(3)
+        # An hour at the block rate of the AutoAligner.
+        reference = create_envelope(random, 3600 * 25)
+        targets = [reference[offset:offset + 600 * 25]
+                   for offset in random.randint(0, 3000 * 25, 24)]
+
+        start = time.time()
+        shifts = rigidalign(reference, targets)
+        batched_elapsed = time.time() - start
+
+        start = time.time()
+        expected = [rigidalign(reference, [target])[0] for target in targets]
+        elapsed = time.time() - start
+
+        self.info("Aligned %d targets in %.3f s batched, %.3f s one by one",
+                  len(targets), batched_elapsed, elapsed)
+        for shift, expected_shift in zip(shifts, expected):
+            self.assertAlmostEqual(shift, expected_shift, places=5)
+
+
+class TestAutoAligner(TestCase):
+
+    def test_parallel_extraction(self):
+        clips = [mock.Mock(name="clip%d" % i) for i in range(5)]
+        uris = ["cached", "a", "b", "b", "c"]
+        envelopes = {}
+
+        def get_cached_envelope(audiotrack, unused_blockrate):
+            return envelopes.get(audiotrack.props.id)
+
+        def get_audio_track(clip):
+            audiotrack = mock.Mock()
+            audiotrack.props.id = uris[clips.index(clip)]
+            return audiotrack
+
+        envelopes["cached"] = numpy.zeros(10)
+        callback = mock.Mock()
+        aligner = AutoAligner(clips, callback)
+        aligner.MAX_JOBS = 2
+        with mock.patch("pitivi.autoaligner.getAudioTrack", get_audio_track),\
+                mock.patch("pitivi.autoaligner.get_cached_envelope", get_cached_envelope),\
+                mock.patch("pitivi.autoaligner.get_proxy_target", lambda track: track),\
+                mock.patch("pitivi.autoaligner.quote_uri", lambda uri: uri),\
+                mock.patch("pitivi.autoaligner.WaveformExtractor") as extractor_class,\
+                mock.patch("pitivi.autoaligner.GLib"),\
+                mock.patch("pitivi.autoaligner.Previewer") as previewer_class,\
+                mock.patch.object(aligner, "_performShifts") as perform_shifts:
+            previewer_class.manager.get_running_previewer.return_value = None
+            extractors = []
+
+            def create_extractor(uri, unused_duration, unused_callback):
+                extractor = mock.Mock(uri=uri)
+                extractors.append(extractor)
+                return extractor
+            extractor_class.side_effect = create_extractor
+
+            aligner.start()
+            # The clips of an asset share the extractor.
+            self.assertEqual([extractor.uri for extractor in extractors], ["a", "b", "c"])
+            aligner._startExtractions()
+            self.assertEqual([extractor.start.called for extractor in extractors],
+                             [True, True, False])
+
+            envelopes["b"] = numpy.zeros(10)
+            aligner._waveformExtractedCb(extractors[1])
+            extractors[2].start.assert_called_once_with()
+            for extractor in (extractors[0], extractors[2]):
+                envelopes[extractor.uri] = numpy.zeros(10)
+                aligner._waveformExtractedCb(extractor)
+
+            perform_shifts.assert_called_once_with()
+            callback.assert_called_once_with()
+            self.assertTrue(all(envelope is not None
+                                for envelope in aligner._clips.values()))
+
+    def test_running_previewer(self):
+        clips = [mock.Mock(name="clip%d" % i) for i in range(3)]
+        uris = ["a", "b", "c"]
+        envelopes = {}
+        previewers = {uri: mock.Mock(uri=uri) for uri in ("a", "b")}
+
+        def get_cached_envelope(audiotrack, unused_blockrate):
+            return envelopes.get(audiotrack.props.id)
+
+        def get_audio_track(clip):
+            audiotrack = mock.Mock()
+            audiotrack.props.id = uris[clips.index(clip)]
+            return audiotrack
+
+        def get_running_previewer(unused_track_type, uri):
+            return previewers.get(uri)
+
+        callback = mock.Mock()
+        aligner = AutoAligner(clips, callback)
+        aligner.MAX_JOBS = 2
+        with mock.patch("pitivi.autoaligner.getAudioTrack", get_audio_track),\
+                mock.patch("pitivi.autoaligner.get_cached_envelope", get_cached_envelope),\
+                mock.patch("pitivi.autoaligner.get_proxy_target", lambda track: track),\
+                mock.patch("pitivi.autoaligner.quote_uri", lambda uri: uri),\
+                mock.patch("pitivi.autoaligner.WaveformExtractor") as extractor_class,\
+                mock.patch("pitivi.autoaligner.GLib"),\
+                mock.patch("pitivi.autoaligner.Previewer") as previewer_class,\
+                mock.patch.object(aligner, "_performShifts") as perform_shifts:
+            previewer_class.manager.get_running_previewer.side_effect = get_running_previewer
+            extractors = {}
+
+            def create_extractor(uri, unused_duration, unused_callback):
+                extractor = mock.Mock(uri=uri)
+                extractors[uri] = extractor
+                return extractor
+            extractor_class.side_effect = create_extractor
+
+            aligner.start()
+            aligner._startExtractions()
+            # The assets being previewed are not decoded again.
+            self.assertEqual({uri: extractor.start.called
+                              for uri, extractor in extractors.items()},
+                             {"a": False, "b": False, "c": True})
+
+            # The previewer of "a" saved the waveform.
+            envelopes["a"] = numpy.zeros(10)
+            aligner._previewerDoneCb(previewers.pop("a"), extractors["a"])
+            self.assertFalse(extractors["a"].start.called)
+
+            # The previewer of "b" failed, so the asset is decoded after all.
+            aligner._previewerDoneCb(previewers.pop("b"), extractors["b"])
+            extractors["b"].start.assert_called_once_with()
+
+            for uri in ("b", "c"):
+                envelopes[uri] = numpy.zeros(10)
+                aligner._waveformExtractedCb(extractors[uri])
+
+            perform_shifts.assert_called_once_with()
+            callback.assert_called_once_with()
+
+    def test_compensate_drift(self):
+        random = numpy.random.RandomState(6)
+        reference_envelope = create_envelope(random, 10000)
+        envelope = create_drifting_target(random, reference_envelope, 1000, 0.001, 4000)
+        reference = create_clip(priority=0, start=0)
+        movable = create_clip(priority=1, start=0)
+
+        aligner = AutoAligner([reference, movable], mock.Mock(), compensate_drift=True)
+        aligner._clips = {reference: reference_envelope, movable: envelope}
+        aligner._performShifts()
+        # The error is split between the start and the end of the clip.
+        (start,), unused_kwargs = movable.set_start.call_args
+        self.assertAlmostEqual(start, 1002 * Gst.SECOND / 25,
+                               delta=Gst.SECOND / 50)
+
+    def test_shift_before_zero(self):
+        random = numpy.random.RandomState(7)
+        reference_envelope = create_envelope(random, 1000)
+        # The target starts 100 blocks before the reference.
+        envelope = numpy.concatenate((create_envelope(random, 100), reference_envelope))
+        reference = create_clip(priority=0, start=2 * Gst.SECOND)
+        movable = create_clip(priority=1, start=0, in_point=5 * Gst.SECOND,
+                              duration=10 * Gst.SECOND)
+
+        aligner = AutoAligner([reference, movable], mock.Mock())
+        aligner._clips = {reference: reference_envelope, movable: envelope}
+        aligner._performShifts()
+        reference.set_start.assert_not_called()
+        # Shifted by 100 blocks, 4 seconds before the reference, which
+        # is 2 seconds before zero.
+        movable.set_start.assert_called_once_with(0)
+        (in_point,), unused_kwargs = movable.set_inpoint.call_args
+        self.assertAlmostEqual(in_point, 7 * Gst.SECOND, delta=Gst.SECOND / 50)
+        (duration,), unused_kwargs = movable.set_duration.call_args
+        self.assertAlmostEqual(duration, 8 * Gst.SECOND, delta=Gst.SECOND / 50)
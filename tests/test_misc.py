@@ -19,11 +19,14 @@
 """Tests for the utils.misc module."""
 # pylint: disable=protected-access,no-self-use
 import os
+import tempfile
 import unittest
 
 from gi.repository import Gst
 
 from pitivi.utils.misc import binary_search
+from pitivi.utils.misc import hash_file
+from pitivi.utils.misc import HASH_SAMPLE_SIZE
 from pitivi.utils.misc import PathWalker
 from tests.common import create_main_loop
 from tests.common import get_sample_uri
@@ -86,3 +89,27 @@ class PathWalkerTest(unittest.TestCase):
         self.assertGreater(len(received_uris), 1, received_uris)
         valid_uri = get_sample_uri("tears_of_steel.webm")
         self.assertIn(valid_uri, received_uris)
+
+
+class HashFileTest(unittest.TestCase):
+    """Tests for the `hash_file` method."""
+
+    def test_same_header(self):
+        """Checks files differing only after the first bytes get different hashes."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path1 = os.path.join(temp_dir, "file1")
+            path2 = os.path.join(temp_dir, "file2")
+            header = b"x" * HASH_SAMPLE_SIZE
+            with open(path1, "wb") as file1, open(path2, "wb") as file2:
+                file1.write(header + b"tail1")
+                file2.write(header + b"tail2")
+            os.utime(path2, ns=(0, os.stat(path1).st_mtime_ns))
+            self.assertNotEqual(hash_file(path1), hash_file(path2))
+
+            # The modification time is hashed too.
+            with open(path2, "wb") as file2:
+                file2.write(header + b"tail1")
+            os.utime(path2, ns=(0, os.stat(path1).st_mtime_ns))
+            self.assertEqual(hash_file(path1), hash_file(path2))
+            os.utime(path2, ns=(0, os.stat(path1).st_mtime_ns + 10 ** 9))
+            self.assertNotEqual(hash_file(path1), hash_file(path2))
@@ -17,17 +17,38 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 import os
-import pickle
+import sqlite3
+import sys
 import tempfile
+import time
 from unittest import mock
 from unittest import TestCase
 
+import numpy
+from gi.repository import GdkPixbuf
 from gi.repository import GES
+from gi.repository import GLib
 from gi.repository import Gst
 
+from pitivi.timeline.previewers import AudioPreviewer
+from pitivi.timeline.previewers import get_media_info
+from pitivi.timeline.previewers import get_thumbnail_scaler
 from pitivi.timeline.previewers import get_wavefile_location_for_uri
+from pitivi.timeline.previewers import IdlePipelines
+from pitivi.timeline.previewers import PixbufLRUCache
+from pitivi.timeline.previewers import PreviewGeneratorManager
+from pitivi.timeline.previewers import PreviewsCachePruner
+from pitivi.timeline.previewers import renderer
+from pitivi.timeline.previewers import SAMPLE_DURATION
+from pitivi.timeline.previewers import STREAMING_MAX_THUMBS
 from pitivi.timeline.previewers import THUMB_HEIGHT
 from pitivi.timeline.previewers import ThumbnailCache
+from pitivi.timeline.previewers import ThumbnailsScaling
+from pitivi.timeline.previewers import VideoPreviewer
+from pitivi.utils.waveform import decimate
+from pitivi.utils.waveform import load_waveform
+from pitivi.utils.waveform import PEAK_ROW
+from pitivi.utils.waveform import RMS_ROW
 from tests import common
 from tests.test_media_library import BaseTestMediaLibrary
 
@@ -91,23 +112,684 @@ class TestPreviewers(BaseTestMediaLibrary):
         wavefile = get_wavefile_location_for_uri(sample_uri)
         self.assertTrue(os.path.exists(wavefile), wavefile)
 
-        with open(wavefile, "rb") as fsamples:
-            samples = pickle.load(fsamples)
+        samples = load_waveform(wavefile)[0][RMS_ROW]
+        self.assertEqual(len(samples), len(SIMPSON_WAVFORM_VALUES))
+        for sample, expected in zip(samples, SIMPSON_WAVFORM_VALUES):
+            # The samples are stored as float32.
+            self.assertAlmostEqual(sample, expected, places=5)
 
-        self.assertEqual(samples, SIMPSON_WAVFORM_VALUES)
 
+class TestAudioPreviewer(TestCase):
+    """Tests for the AudioPreviewer class."""
 
-class TestThumbnailCache(TestCase):
+    def test_no_audio_data(self):
+        with mock.patch("pitivi.timeline.previewers.xdg_cache_home") as xdg_cache_home,\
+                tempfile.TemporaryDirectory() as temp_dir:
+            xdg_cache_home.return_value = temp_dir
+            sample_uri = common.get_sample_uri("1sec_simpsons_trailer.mp4")
+            # The accumulator never receives data.
+            wavebin = Gst.ElementFactory.make("waveformbin")
+            wavebin.props.uri = sample_uri
+            self.assertFalse(os.path.exists(wavebin.wavefile))
+
+            previewer = mock.Mock()
+            previewer.uri = sample_uri
+            previewer._wavebin = wavebin
+            previewer.ges_elem.get_parent().get_asset().get_proxy_target.return_value = None
+            previewer._prepareSamples = lambda: AudioPreviewer._prepareSamples(previewer)
+            message = mock.Mock(type=Gst.MessageType.EOS)
+            AudioPreviewer._busMessageCb(previewer, mock.Mock(), message)
+
+            self.assertTrue(previewer.failed)
+            previewer._startRendering.assert_not_called()
+            previewer.stopGeneration.assert_called_once_with()
+
+
+class TestRenderer(TestCase):
+    """Tests for the renderer C module."""
+
+    def _get_pixels(self, peaks, rms, width=20, height=10):
+        surface = renderer.fill_envelope_surface(peaks, rms, width, height)
+        self.assertEqual((surface.get_width(), surface.get_height()), (width, height))
+        return bytes(surface.get_data())
+
+    def _get_alpha(self, pixels, x, y, width=20):
+        # The ARGB32 pixels are stored in native-endian 32-bit words.
+        word = int.from_bytes(pixels[(y * width + x) * 4:(y * width + x + 1) * 4],
+                              sys.byteorder)
+        return word >> 24
+
+    def test_buffer_protocol(self):
+        rms = [0, 2, 4.5, 8, 10, 3, 1, 7] * 10
+        peaks = [value * 2 for value in rms]
+        expected = self._get_pixels(peaks, rms)
+        for dtype in ("=f4", "=f8", "<f4" if sys.byteorder == "little" else ">f4"):
+            level = numpy.array([rms, peaks], dtype=dtype)
+            self.assertEqual(self._get_pixels(level[PEAK_ROW], level[RMS_ROW]),
+                             expected, dtype)
+            # The views of a level of the waveforms pyramid.
+            self.assertEqual(self._get_pixels(memoryview(level[PEAK_ROW]),
+                                              memoryview(level[RMS_ROW])),
+                             expected, dtype)
+
+    def test_envelope(self):
+        rms = numpy.full(80, 2, dtype=numpy.float32)
+        peaks = rms.copy()
+        # A transient, averaged out of the RMS samples of its column.
+        peaks[41] = 8
+        pixels = self._get_pixels(peaks, rms)
+        # The peak is drawn, lighter than the RMS values.
+        self.assertGreater(self._get_alpha(pixels, 10, 6), 0)
+        self.assertLess(self._get_alpha(pixels, 10, 6), 255)
+        self.assertEqual(self._get_alpha(pixels, 3, 6), 0)
+        self.assertEqual(self._get_alpha(pixels, 10, 9), 255)
+
+    def test_unsupported_buffers(self):
+        swapped = "<f4" if sys.byteorder == "big" else ">f4"
+        rms = numpy.zeros(10, dtype=numpy.float32)
+        for peaks in (numpy.zeros(10, dtype=swapped),
+                      numpy.zeros(10, dtype=numpy.int16),
+                      numpy.zeros(20, dtype=numpy.float32)[::2]):
+            with self.assertRaises((TypeError, BufferError, ValueError)):
+                renderer.fill_envelope_surface(peaks, rms, 20, 10)
+            with self.assertRaises((TypeError, BufferError, ValueError)):
+                renderer.fill_surface(peaks, 20, 10)
+
+        with self.assertRaises(ValueError):
+            renderer.fill_envelope_surface(rms, rms[:5], 20, 10)
+
+
+class TestMediaInfo(TestCase):
+    """Tests for the get_media_info function."""
+
+    def test_errors(self):
+        uri = common.get_sample_uri("1sec_simpsons_trailer.mp4")
+        for error in (sqlite3.DatabaseError("malformed"), FileNotFoundError()):
+            with mock.patch("pitivi.timeline.previewers.get_previews_store") as get_store:
+                get_store.return_value.get_media_info.side_effect = error
+                self.assertIsNone(get_media_info(uri))
+
+
+class TestPreviewsCachePruner(TestCase):
+    """Tests for the PreviewsCachePruner class."""
+
+    def test_errors(self):
+        for error in (sqlite3.DatabaseError("malformed"), PermissionError()):
+            pruner = PreviewsCachePruner(0)
+            done = mock.Mock()
+            pruner.connect("done", done)
+            with mock.patch("pitivi.timeline.previewers.xdg_cache_home"),\
+                    mock.patch("pitivi.timeline.previewers.PreviewsStore",
+                               side_effect=error):
+                pruner.run()
+            done.assert_called_once_with(pruner)
+
+
+def run_decoding_pipeline(pipeline, unwanted_klass, message_cb=None):
+    """Plays the specified pipeline until the end of the stream.
+
+    Args:
+        pipeline (Gst.Pipeline): The pipeline, decoding an asset with an
+            `uridecodebin` named "decode".
+        unwanted_klass (str): The klass of the decoders not to be plugged,
+            for example "Video" or "Audio".
+        message_cb (Optional[function]): Called with each message of the bus.
+
+    Returns:
+        float: The seconds it took.
+    """
+    decode = pipeline.get_by_name("decode")
+    decode.connect("autoplug-select",
+                   lambda unused_decode, unused_pad, unused_caps, factory:
+                   unwanted_klass in factory.get_klass())
+    mainloop = common.create_main_loop()
+
+    def bus_message_cb(unused_bus, message):
+        if message_cb:
+            message_cb(message)
+        if message.type in (Gst.MessageType.EOS, Gst.MessageType.ERROR):
+            mainloop.quit()
+    bus = pipeline.get_bus()
+    bus.add_signal_watch()
+    bus.connect("message", bus_message_cb)
+
+    start = time.time()
+    pipeline.set_state(Gst.State.PLAYING)
+    mainloop.run(timeout_seconds=60)
+    elapsed = time.time() - start
+
+    pipeline.set_state(Gst.State.NULL)
+    bus.remove_signal_watch()
+    return elapsed
+
+
+class TestWaveformsEngines(common.TestCase):
+    """Benchmarks the ways of extracting the waveforms."""
+
+    def _extract(self, wavebin_name):
+        sample_uri = common.get_sample_uri("tears_of_steel.webm")
+        asset = GES.UriClipAsset.request_sync(sample_uri)
+        with mock.patch("pitivi.timeline.previewers.xdg_cache_home") as xdg_cache_home,\
+                tempfile.TemporaryDirectory() as temp_dir:
+            xdg_cache_home.return_value = temp_dir
+            pipeline = Gst.parse_launch(
+                "uridecodebin name=decode uri=%s ! %s name=wave ! "
+                "fakesink qos=false sync=false" % (sample_uri, wavebin_name))
+            wavebin = pipeline.get_by_name("wave")
+            wavebin.props.uri = sample_uri
+            wavebin.props.duration = asset.get_duration()
+
+            elapsed = run_decoding_pipeline(pipeline, "Video")
+            wavebin.finalize()
+            self.assertTrue(os.path.exists(wavebin.wavefile))
+
+        return wavebin.samples, asset.get_duration(), elapsed
+
+    def test_engines(self):
+        level_samples, duration, level_time = self._extract("waveformbin")
+        pcm_samples, duration, pcm_time = self._extract("pcmwaveformbin")
+        self.info("Extracted %.1f s of audio with the level engine in %.3f s,"
+                  " with the PCM engine in %.3f s",
+                  duration / Gst.SECOND, level_time, pcm_time)
+
+        # The timings depend on the machine, so only the output is checked.
+        self.assertEqual(len(level_samples), int(duration / SAMPLE_DURATION))
+        self.assertEqual(len(pcm_samples), len(level_samples))
+        # The level engine joins linearly the values posted every 100 ms,
+        # so the waveforms are compared at that resolution.
+        level_samples = decimate(level_samples, 10)
+        pcm_samples = decimate(pcm_samples, 10)
+        self.assertGreater(level_samples.max(), 0)
+        self.assertGreater(pcm_samples.max(), 0)
+        correlation = numpy.corrcoef(level_samples, pcm_samples)[0, 1]
+        self.assertGreater(correlation, 0.9)
+        # Both engines compute the RMS values on the same scale.
+        ratio = pcm_samples.mean() / level_samples.mean()
+        self.assertTrue(0.5 < ratio < 2, ratio)
+
+
+class TestThumbnailsScaling(common.TestCase):
+    """Benchmarks the ways of scaling the frames to thumbnails."""
+
+    def _make_thumbnails(self, scaler):
+        sample_uri = common.get_sample_uri("tears_of_steel.webm")
+        # Each frame is made into a thumbnail.
+        pipeline = Gst.parse_launch(
+            "uridecodebin name=decode uri=%s ! %s ! "
+            "gdkpixbufsink name=sink sync=false" % (sample_uri, scaler))
+        sink = pipeline.get_by_name("sink")
+        sizes = []
+
+        def message_cb(message):
+            if message.type == Gst.MessageType.ELEMENT and message.src == sink \
+                    and message.get_structure().get_name() == "pixbuf":
+                pixbuf = message.get_structure().get_value("pixbuf")
+                sizes.append((pixbuf.get_width(), pixbuf.get_height()))
+
+        elapsed = run_decoding_pipeline(pipeline, "Audio", message_cb)
+        return sizes, elapsed
+
+    def test_methods(self):
+        size = "height=(int)%d" % THUMB_HEIGHT
+        results = {"convert first, lanczos": self._make_thumbnails(
+            "videoconvert ! videoscale method=lanczos ! "
+            "capsfilter caps=video/x-raw,format=(string)RGBA,%s,"
+            "pixel-aspect-ratio=(fraction)1/1" % size)}
+        for method in (ThumbnailsScaling.LANCZOS, ThumbnailsScaling.BILINEAR,
+                       ThumbnailsScaling.NEAREST):
+            results[method] = self._make_thumbnails(get_thumbnail_scaler(size, method))
+
+        for name, (sizes, elapsed) in results.items():
+            self.info("%s: %d thumbnails in %.3f s, %.1f thumbnails per second",
+                      name, len(sizes), elapsed, len(sizes) / elapsed)
+        counts = {len(sizes) for sizes, unused_elapsed in results.values()}
+        self.assertEqual(len(counts), 1, counts)
+        self.assertGreater(counts.pop(), 0)
+        # All the methods make thumbnails of the same size.
+        for name, (sizes, unused_elapsed) in results.items():
+            self.assertEqual(set(sizes), set(results["convert first, lanczos"][0]), name)
+            for width, height in sizes:
+                self.assertEqual(height, THUMB_HEIGHT, name)
+                self.assertGreater(width, 0, name)
+
+
+class TestVideoPreviewer(TestCase):
+    """Tests for the VideoPreviewer class."""
+
+    def test_consecutive_times(self):
+        previewer = mock.Mock()
+        previewer.thumb_period = 5
+        previewer.queue = [0, 5, 10, 20, 25]
+        self.assertEqual(VideoPreviewer._get_consecutive_times(previewer, 0),
+                         [0, 5, 10])
+        self.assertEqual(VideoPreviewer._get_consecutive_times(previewer, 20),
+                         [20, 25])
+
+        previewer.queue = list(range(0, 1000, 5))
+        times = VideoPreviewer._get_consecutive_times(previewer, 100)
+        self.assertEqual(len(times), STREAMING_MAX_THUMBS)
+        self.assertEqual(times[0], 100)
+
+    def test_visible_positions(self):
+        previewer = mock.Mock()
+        previewer.nsToPixel = lambda ns: ns // 10
+        previewer.pixelToNs = lambda pixels: pixels * 10
+        previewer.ges_elem.props.in_point = 100
+        previewer.thumb_width = 5
+        # The thumbnails are drawn at 0, 5, 10 and 15 pixels.
+        previewer._positions = [100, 150, 200, 250]
+        self.assertEqual(VideoPreviewer._get_visible_positions(previewer, 6, 5),
+                         [150, 200])
+        self.assertEqual(VideoPreviewer._get_visible_positions(previewer, 0, 100),
+                         previewer._positions)
+        self.assertEqual(VideoPreviewer._get_visible_positions(previewer, 20, 10), [])
+
+    def test_no_wish_left(self):
+        previewer = mock.Mock()
+        previewer.generated_thumbs = 0
+        previewer.queue = [0, 5, 10]
+        previewer._get_wish.return_value = None
+        VideoPreviewer._create_next_thumb(previewer)
+        previewer.stopGeneration.assert_called_once_with()
+        previewer.pipeline.seek.assert_not_called()
+
+    def test_streaming_pixbufs(self):
+        previewer = mock.Mock()
+        previewer._streaming = True
+        message = mock.Mock()
+        message.type = Gst.MessageType.ELEMENT
+        message.src = previewer.gdkpixbufsink
+        message.get_structure().get_name.return_value = "preroll-pixbuf"
+        VideoPreviewer._VideoPreviewer__bus_message_handler(previewer, None, message)
+        previewer._set_pixbuf.assert_not_called()
+
+        message.get_structure().get_name.return_value = "pixbuf"
+        VideoPreviewer._VideoPreviewer__bus_message_handler(previewer, None, message)
+        previewer._set_pixbuf.assert_called_once()
+        previewer._reset_streaming_timeout.assert_called_once_with()
+
+    def test_streaming_error(self):
+        previewer = mock.Mock()
+        previewer._streaming = True
+        message = mock.Mock()
+        message.type = Gst.MessageType.ERROR
+        message.parse_error.return_value = (None, None)
+        VideoPreviewer._VideoPreviewer__bus_message_handler(previewer, None, message)
+        previewer._stop_streaming.assert_called_once_with()
+        previewer.pipeline.set_state.assert_called_once_with(Gst.State.PAUSED)
+        previewer._checkCPU.assert_called_once_with()
+
+    def test_stop_streaming(self):
+        previewer = mock.Mock()
+        previewer._streaming = True
+        previewer._streaming_timeout_id = None
+        previewer.queue = [0, 5, 10, 15]
+        previewer._streamed_times = [5, 10]
+        VideoPreviewer._stop_streaming(previewer)
+        self.assertFalse(previewer._streaming)
+        self.assertEqual(previewer._streamed_times, [])
+        # The thumbnails not obtained are retried last.
+        self.assertEqual(previewer.queue, [0, 15, 5, 10])
+
+
+class TestPreviewGeneratorManager(TestCase):
+    """Tests for the PreviewGeneratorManager class."""
+
+    def _create_previewer(self, start=0, duration=10,
+                          track_type=GES.TrackType.VIDEO, uri=None):
+        previewer = mock.Mock()
+        previewer.track_type = track_type
+        if uri:
+            previewer.uri = uri
+        previewer.ges_elem.props.start = start
+        previewer.ges_elem.props.duration = duration
+        previewer.timeline.app.settings.previewersMaxJobs = 2
+        return previewer
+
+    def _finish(self, previewer):
+        unused_signal, callback = previewer.connect.call_args[0]
+        callback(previewer)
+
+    def test_max_jobs(self):
+        manager = PreviewGeneratorManager()
+        previewers = [self._create_previewer() for unused_i in range(4)]
+        for previewer in previewers:
+            manager.add_previewer(previewer)
+        self.assertEqual([previewer.startGeneration.called for previewer in previewers],
+                         [True, True, False, False])
+
+        # Another track type has its own jobs.
+        audio_previewer = self._create_previewer(track_type=GES.TrackType.AUDIO)
+        manager.add_previewer(audio_previewer)
+        audio_previewer.startGeneration.assert_called_once_with()
+
+        self._finish(previewers[1])
+        self.assertEqual([previewer.startGeneration.called for previewer in previewers],
+                         [True, True, True, False])
+
+    def test_priority(self):
+        manager = PreviewGeneratorManager()
+        manager.set_viewport(100, 200, 150)
+        running = [self._create_previewer(), self._create_previewer()]
+        for previewer in running:
+            manager.add_previewer(previewer)
+        far = self._create_previewer(start=300)
+        close = self._create_previewer(start=210)
+        visible = self._create_previewer(start=95)
+        at_playhead = self._create_previewer(start=145)
+        for previewer in (far, close, visible, at_playhead):
+            manager.add_previewer(previewer)
+
+        order = []
+        for previewer in (far, close, visible, at_playhead):
+            previewer.startGeneration.side_effect = \
+                lambda previewer=previewer: order.append(previewer)
+        self._finish(running[0])
+        self._finish(running[1])
+        self.assertEqual(order, [at_playhead, visible])
+
+        # Scrolling changes the priorities of the pending previewers.
+        manager.set_viewport(300, 400, 350)
+        self._finish(at_playhead)
+        self._finish(visible)
+        self.assertEqual(order, [at_playhead, visible, far, close])
+
+    def test_remove_previewer(self):
+        manager = PreviewGeneratorManager()
+        previewers = [self._create_previewer() for unused_i in range(3)]
+        for previewer in previewers:
+            manager.add_previewer(previewer)
+        manager.remove_previewer(previewers[2])
+
+        self._finish(previewers[0])
+        previewers[2].startGeneration.assert_not_called()
+
+    def test_busy(self):
+        manager = PreviewGeneratorManager()
+        manager.set_busy(True)
+        previewers = [self._create_previewer() for unused_i in range(3)]
+        for previewer in previewers:
+            manager.add_previewer(previewer)
+        self.assertEqual([previewer.startGeneration.called for previewer in previewers],
+                         [True, False, False])
+
+        manager.set_busy(False)
+        self.assertEqual([previewer.startGeneration.called for previewer in previewers],
+                         [True, True, False])
+
+    def test_same_asset(self):
+        manager = PreviewGeneratorManager()
+        previewers = [self._create_previewer(uri="file:///a"),
+                      self._create_previewer(uri="file:///a"),
+                      self._create_previewer(uri="file:///b")]
+        for previewer in previewers:
+            manager.add_previewer(previewer)
+        # A single previewer runs at a time for an asset.
+        self.assertEqual([previewer.startGeneration.called for previewer in previewers],
+                         [True, False, True])
+
+        self._finish(previewers[0])
+        previewers[1].startGeneration.assert_called_once_with()
+
+    def test_get_running_previewer(self):
+        manager = PreviewGeneratorManager()
+        previewer = self._create_previewer(uri="file:///a")
+        track_type = previewer.track_type
+        self.assertIsNone(manager.get_running_previewer(track_type, "file:///a"))
+        manager.add_previewer(previewer)
+        self.assertIs(manager.get_running_previewer(track_type, "file:///a"), previewer)
+        self.assertIsNone(manager.get_running_previewer(track_type, "file:///b"))
+
+        self._finish(previewer)
+        self.assertIsNone(manager.get_running_previewer(track_type, "file:///a"))
+
+
+class TestIdlePipelines(TestCase):
+    """Tests for the IdlePipelines class."""
+
+    def test_take(self):
+        pipelines = IdlePipelines(2)
+        self.assertIsNone(pipelines.take("a"))
+        first, second, third = mock.Mock(), mock.Mock(), mock.Mock()
+        pipelines.park("a", first, 1)
+        pipelines.park("a", second, 2)
+        # The most recent pipeline of the asset is reused.
+        self.assertEqual(pipelines.take("a"), (second, 2))
+
+        pipelines.park("b", second, 2)
+        pipelines.park("c", third, 3)
+        # The oldest pipeline is stopped when there are too many.
+        first.set_state.assert_called_once_with(Gst.State.NULL)
+        self.assertIsNone(pipelines.take("a"))
+        self.assertEqual(pipelines.take("c"), (third, 3))
+
+        pipelines.clear()
+        second.set_state.assert_called_once_with(Gst.State.NULL)
+        self.assertIsNone(pipelines.take("b"))
+
+
+class TestPixbufLRUCache(TestCase):
+    """Tests for the PixbufLRUCache class."""
+
+    def _create_pixbuf(self, size):
+        pixbuf = mock.Mock()
+        pixbuf.get_byte_length.return_value = size
+        return pixbuf
+
+    def test_budget(self):
+        cache = PixbufLRUCache(100)
+        pixbufs = [self._create_pixbuf(40) for unused_i in range(3)]
+        cache.put(0, pixbufs[0])
+        cache.put(1, pixbufs[1], "data")
+        self.assertEqual(cache.size, 80)
+        self.assertEqual(cache.get(1), (pixbufs[1], "data"))
+
+        # The least recently used is evicted.
+        self.assertEqual(cache.get(0), (pixbufs[0], None))
+        cache.put(2, pixbufs[2])
+        self.assertEqual(cache.size, 80)
+        self.assertNotIn(1, cache)
+        self.assertIn(0, cache)
+        self.assertIn(2, cache)
+
+        # Replacing a pixbuf updates the size.
+        cache.put(2, self._create_pixbuf(10))
+        self.assertEqual(cache.size, 50)
+        cache.remove(2)
+        self.assertEqual(cache.size, 40)
+
+    def test_counters(self):
+        cache = PixbufLRUCache(100)
+        cache.put(0, self._create_pixbuf(10))
+        self.assertIsNotNone(cache.get(0))
+        self.assertIsNone(cache.get(1))
+        self.assertIsNotNone(cache.peek(0))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+class BaseTestThumbnailCache(TestCase):
+    """Base class for the tests using a temporary thumbnails cache."""
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self._patchers = [
+            mock.patch("pitivi.timeline.previewers.xdg_cache_home",
+                       return_value=self._temp_dir.name),
+            mock.patch.object(ThumbnailCache, "pixbufs", PixbufLRUCache(10 ** 6))]
+        for patcher in self._patchers:
+            patcher.start()
+        self.sample_uri = common.get_sample_uri("1sec_simpsons_trailer.mp4")
+
+    def tearDown(self):
+        ThumbnailCache.flush()
+        for patcher in reversed(self._patchers):
+            patcher.stop()
+        self._temp_dir.cleanup()
+
+
+class TestThumbnailCache(BaseTestThumbnailCache):
+    """Tests for the ThumbnailCache class."""
+
+    def _wait_written(self, cache):
+        context = GLib.MainContext.default()
+        start = time.time()
+        while cache._pending and time.time() - start < 5:
+            context.iteration(False)
+        self.assertEqual(cache._pending, {})
 
     def test_get(self):
         with self.assertRaises(ValueError):
             ThumbnailCache.get(1)
-        with mock.patch("pitivi.timeline.previewers.xdg_cache_home") as xdg_config_home,\
-                tempfile.TemporaryDirectory() as temp_dir:
-            xdg_config_home.return_value = temp_dir
-            sample_uri = common.get_sample_uri("1sec_simpsons_trailer.mp4")
-            cache = ThumbnailCache.get(sample_uri)
-            self.assertIsNotNone(cache)
+        cache = ThumbnailCache.get(self.sample_uri)
+        self.assertIsNotNone(cache)
+
+        asset = GES.UriClipAsset.request_sync(self.sample_uri)
+        self.assertEqual(ThumbnailCache.get(asset), cache)
+
+    def test_fast_thumbnails(self):
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, 16, 9)
+        cache = ThumbnailCache(self.sample_uri)
+        self.assertFalse(cache.is_accurate(0))
+
+        cache.set_fast(0, pixbuf, 200)
+        self.assertIn(0, cache)
+        self.assertFalse(cache.is_accurate(0))
+
+        # A keyframe exactly at the requested time.
+        cache.set_fast(100, pixbuf, 100)
+        self.assertTrue(cache.is_accurate(100))
+
+        cache[0] = pixbuf
+        self.assertTrue(cache.is_accurate(0))
+
+    def test_listeners(self):
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, 16, 9)
+        cache = ThumbnailCache(self.sample_uri)
+        callback = mock.Mock()
+        cache.add_listener(callback)
+        cache.set_fast(0, pixbuf, 200)
+        cache[100] = pixbuf
+        self.assertEqual(callback.call_args_list,
+                         [mock.call(0, pixbuf, 200), mock.call(100, pixbuf, None)])
+
+        cache.remove_listener(callback)
+        cache[200] = pixbuf
+        self.assertEqual(callback.call_count, 2)
+
+    def test_library_thumbnail(self):
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, 96, 54)
+        cache = ThumbnailCache(self.sample_uri)
+        self.assertIsNone(cache.get_library_thumbnail())
+
+        cache.set_library_thumbnail(pixbuf)
+        # The thumbnail is available before being written.
+        self.assertIs(cache.get_library_thumbnail(), pixbuf)
+
+        ThumbnailCache.flush()
+        context = GLib.MainContext.default()
+        start = time.time()
+        while cache._pending_library_thumb and time.time() - start < 5:
+            context.iteration(False)
+        thumb = cache.get_library_thumbnail()
+        self.assertIsNot(thumb, pixbuf)
+        self.assertEqual((thumb.props.width, thumb.props.height), (96, 54))
+
+    def test_write_behind(self):
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, 16, 9)
+        cache = ThumbnailCache(self.sample_uri)
+        for position in range(0, 1000, 100):
+            cache.set_fast(position, pixbuf, position + 10)
+        cache[0] = pixbuf
+
+        # The pending thumbnails are available before being written.
+        ThumbnailCache.pixbufs.remove((self.sample_uri, 0))
+        self.assertIn(0, cache)
+        self.assertTrue(cache.is_accurate(0))
+        self.assertEqual(cache.getImagesSize(), (16, 9))
+
+        self._wait_written(cache)
+
+        db = sqlite3.connect(cache.dbfile)
+        rows = db.execute("SELECT Time, ActualTime FROM Thumbs WHERE Hash = ?",
+                          (cache.filehash,)).fetchall()
+        db.close()
+        expected = [(0, None)] + [(position, position + 10)
+                                  for position in range(100, 1000, 100)]
+        self.assertEqual(sorted(rows), expected)
+
+    def test_superseded_thumbnail(self):
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, 16, 9)
+        cache = ThumbnailCache(self.sample_uri)
+        with mock.patch.object(cache, "codecs") as codecs:
+            cache.set_fast(0, pixbuf, 10)
+            cache[0] = pixbuf
+        fast_entry = codecs.submit.call_args_list[0][0][2]
+        accurate_entry = codecs.submit.call_args_list[1][0][2]
+
+        # The accurate thumbnail is encoded first.
+        ThumbnailCache.writer.add(cache, 0, accurate_entry, b"accurate")
+        ThumbnailCache.writer.add(cache, 0, fast_entry, b"fast")
+        ThumbnailCache.writer.flush()
+
+        db = sqlite3.connect(cache.dbfile)
+        rows = db.execute("SELECT Jpeg, ActualTime FROM Thumbs WHERE Hash = ?",
+                          (cache.filehash,)).fetchall()
+        db.close()
+        self.assertEqual(rows, [(b"accurate", None)])
+
+    def test_flush(self):
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, 16, 9)
+        cache = ThumbnailCache(self.sample_uri)
+        for position in range(0, 1000, 100):
+            cache[position] = pixbuf
+
+        # All the thumbnails are written, without running the main loop.
+        ThumbnailCache.flush()
+        db = sqlite3.connect(cache.dbfile)
+        count, = db.execute("SELECT COUNT(*) FROM Thumbs WHERE Hash = ?",
+                            (cache.filehash,)).fetchone()
+        db.close()
+        self.assertEqual(count, 10)
+
+        # The thumbnails can still be stored afterwards.
+        cache[1000] = pixbuf
+        ThumbnailCache.flush()
+
+    def test_get_range(self):
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, 16, 9)
+        cache = ThumbnailCache(self.sample_uri)
+        for position in (0, 50, 100, 125, 150, 200):
+            cache[position] = pixbuf
+        self.assertEqual(sorted(cache.get_range(50, 200, 50)), [50, 100, 150])
+
+        # The thumbnails not in memory are read from the database.
+        self._wait_written(cache)
+        ThumbnailCache.pixbufs.remove((self.sample_uri, 100))
+        thumbs = cache.get_range(0, 300, 100)
+        self.assertEqual(sorted(thumbs), [0, 100, 200])
+        self.assertEqual(thumbs[100].get_width(), 16)
+        self.assertIn((self.sample_uri, 100), ThumbnailCache.pixbufs)
+
+    def test_get_range_decoded_asynchronously(self):
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8, 16, 9)
+        cache = ThumbnailCache(self.sample_uri)
+        cache[0] = pixbuf
+        cache.set_fast(100, pixbuf, 90)
+        self._wait_written(cache)
+        ThumbnailCache.pixbufs.remove((self.sample_uri, 100))
+
+        callback = mock.Mock()
+        thumbs = cache.get_range(0, 200, 100, callback)
+        self.assertIs(thumbs[0], pixbuf)
+        self.assertIsNone(thumbs[100])
+        # The thumbnail being decoded is known.
+        self.assertIn(100, cache)
+        self.assertFalse(cache.is_accurate(100))
 
-            asset = GES.UriClipAsset.request_sync(sample_uri)
-            self.assertEqual(ThumbnailCache.get(asset), cache)
+        context = GLib.MainContext.default()
+        start = time.time()
+        while not callback.called and time.time() - start < 5:
+            context.iteration(False)
+        callback.assert_called_once_with(100, mock.ANY)
+        self.assertEqual(callback.call_args[0][1].get_width(), 16)
+        self.assertIn((self.sample_uri, 100), ThumbnailCache.pixbufs)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+"""Tests for the utils.cache module."""
+# pylint: disable=missing-docstring,protected-access,no-self-use
+import os
+import sqlite3
+import tempfile
+from unittest import mock
+from unittest import TestCase
+
+from pitivi.utils.cache import FILES_MAX_AGE
+from pitivi.utils.cache import main
+from pitivi.utils.cache import PARTIAL_WAVES_MAX_AGE
+from pitivi.utils.cache import PreviewsStore
+
+
+class TestPreviewsStore(TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self._temp_dir.name
+        self.store = PreviewsStore(self.cache_dir)
+
+    def tearDown(self):
+        self.store.close()
+        self._temp_dir.cleanup()
+
+    def _add_thumbs(self, filehash, size):
+        self.store.db.execute("INSERT INTO Thumbs VALUES (?, ?, ?, ?)",
+                              (filehash, 0, sqlite3.Binary(b"x" * size), 0))
+        self.store.db.commit()
+
+    def test_aliases(self):
+        self.assertEqual(self.store.resolve("proxy"), "proxy")
+        self.store.set_alias("proxy", "asset")
+        self.assertEqual(self.store.resolve("proxy"), "asset")
+        self.assertEqual(self.store.get_wavefile("proxy"),
+                         os.path.join(self.cache_dir, "waves", "asset.wave"))
+        # An asset is never an alias of itself.
+        self.store.set_alias("asset", "asset")
+        self.assertEqual(self.store.resolve("asset"), "asset")
+
+    def test_get_hash(self):
+        path = os.path.join(self.cache_dir, "file")
+        with open(path, "wb") as file:
+            file.write(b"content")
+        with mock.patch("pitivi.utils.cache.hash_file", return_value="hash") as hash_file:
+            self.assertEqual(self.store.get_hash(path), "hash")
+            self.assertEqual(self.store.get_hash(path), "hash")
+            self.assertEqual(hash_file.call_count, 1)
+
+            # The hashes are stored in the database.
+            store = PreviewsStore(self.cache_dir)
+            self.assertEqual(store.get_hash(path), "hash")
+            store.close()
+            self.assertEqual(hash_file.call_count, 1)
+
+            # The file is hashed again when it changes.
+            with open(path, "wb") as file:
+                file.write(b"new content")
+            hash_file.return_value = "new hash"
+            self.assertEqual(self.store.get_hash(path), "new hash")
+            self.assertEqual(hash_file.call_count, 2)
+
+    def test_media_info(self):
+        path = os.path.join(self.cache_dir, "file")
+        with open(path, "wb") as file:
+            file.write(b"content")
+        self.assertIsNone(self.store.get_media_info(path))
+        self.store.set_media_info(path, "info")
+        self.assertEqual(self.store.get_media_info(path), "info")
+        filehash = self.store.get_hash(path)
+
+        # The index is still valid after renaming the file.
+        renamed_path = os.path.join(self.cache_dir, "renamed")
+        os.rename(path, renamed_path)
+        with mock.patch("pitivi.utils.cache.hash_file") as hash_file:
+            self.assertEqual(self.store.get_hash(renamed_path), filehash)
+            hash_file.assert_not_called()
+        self.assertEqual(self.store.get_media_info(renamed_path), "info")
+
+        with open(renamed_path, "ab") as file:
+            file.write(b" changed")
+        self.assertIsNone(self.store.get_media_info(renamed_path))
+
+    def test_get_hash_device(self):
+        path = os.path.join(self.cache_dir, "file")
+        with open(path, "wb") as file:
+            file.write(b"content")
+        with mock.patch("pitivi.utils.cache.hash_file", return_value="hash"):
+            self.store.get_hash(path)
+        # The inodes of the files on other devices are unrelated.
+        dev, ino, size, mtime = PreviewsStore._get_file_key(path)
+        self.store._hashes.clear()
+        with mock.patch.object(PreviewsStore, "_get_file_key",
+                               return_value=(dev + 1, ino, size, mtime)),\
+                mock.patch("pitivi.utils.cache.hash_file",
+                           return_value="other hash") as hash_file:
+            self.assertEqual(self.store.get_hash(path), "other hash")
+            hash_file.assert_called_once_with(path)
+
+    def test_usage(self):
+        with mock.patch("pitivi.utils.cache.time.time", return_value=20):
+            self.store.touch("new")
+        with mock.patch("pitivi.utils.cache.time.time", return_value=10):
+            self.store.touch("old")
+            # The access time is updated once per session.
+            self.store.touch("new")
+        self._add_thumbs("new", 90)
+        self.store.db.execute("INSERT INTO LibraryThumbs VALUES (?, ?)",
+                              ("new", sqlite3.Binary(b"x" * 10)))
+        with open(self.store.get_wavefile("old"), "wb") as wavefile:
+            wavefile.write(b"x" * 30)
+
+        self.assertEqual(self.store.get_usage(), [("old", 10, 30), ("new", 20, 100)])
+
+    def test_prune(self):
+        for access_time, filehash in enumerate(("a", "b", "c")):
+            with mock.patch("pitivi.utils.cache.time.time", return_value=access_time):
+                self.store.touch(filehash)
+            self._add_thumbs(filehash, 1000)
+        self.store.set_alias("proxy", "a")
+
+        self.assertEqual(self.store.prune(2500), ["a"])
+        self.assertEqual([filehash for filehash, unused_time, unused_size
+                          in self.store.get_usage()], ["b", "c"])
+        self.assertEqual(self.store.resolve("proxy"), "proxy")
+
+        self.assertEqual(self.store.prune(0), ["b", "c"])
+        self.assertEqual(self.store.get_usage(), [])
+
+    def test_prune_files(self):
+        paths = []
+        for name in ("unused", "used", "previewed", "proxy"):
+            path = os.path.join(self.cache_dir, name)
+            with open(path, "wb") as file:
+                file.write(name.encode())
+            with mock.patch("pitivi.utils.cache.hash_file", return_value=name),\
+                    mock.patch("pitivi.utils.cache.time.time", return_value=0):
+                self.store.get_hash(path)
+            paths.append(path)
+        self._add_thumbs("previewed", 10)
+        self.store.set_alias("proxy", "previewed")
+        # The access time is updated when the file is used again.
+        self.store._hashes.clear()
+        with mock.patch("pitivi.utils.cache.time.time",
+                        return_value=FILES_MAX_AGE + 1):
+            self.store.get_hash(paths[1])
+            self.store.prune(2 ** 20)
+
+        self.assertEqual(
+            sorted(row[0] for row in self.store.db.execute("SELECT Hash FROM Files")),
+            ["previewed", "proxy", "used"])
+
+    def test_prune_partial_waves(self):
+        waves_dir = os.path.dirname(self.store.get_wavefile("a"))
+        for name, age in (("stale.part", PARTIAL_WAVES_MAX_AGE + 1),
+                          ("written.part", 0), ("a.wave", PARTIAL_WAVES_MAX_AGE + 1)):
+            path = os.path.join(waves_dir, name)
+            with open(path, "wb") as file:
+                file.write(b"x")
+            mtime = os.stat(path).st_mtime - age
+            os.utime(path, (mtime, mtime))
+
+        self.store.prune(2 ** 20)
+        # The file possibly still being written is kept.
+        self.assertEqual(sorted(os.listdir(waves_dir)), ["a.wave", "written.part"])
+
+    def _create_legacy_files(self):
+        legacy_dir = os.path.join(self.cache_dir, "thumbs")
+        os.makedirs(legacy_dir)
+        with open(os.path.join(legacy_dir, "a"), "wb") as legacy_file:
+            legacy_file.write(b"x" * 10)
+        wavefile = self.store.get_wavefile("a")
+        with open(wavefile, "wb") as file:
+            file.write(b"x" * 10)
+        proxy_wavefile = os.path.join(os.path.dirname(wavefile), "proxy.wave")
+        os.symlink(wavefile, proxy_wavefile)
+        return legacy_dir, proxy_wavefile
+
+    def test_migration(self):
+        self.store.db.execute("PRAGMA user_version = 0")
+        self.store.db.commit()
+        legacy_dir, proxy_wavefile = self._create_legacy_files()
+
+        store = PreviewsStore(self.cache_dir)
+        store.close()
+        self.assertFalse(os.path.exists(legacy_dir))
+        self.assertFalse(os.path.lexists(proxy_wavefile))
+        self.assertTrue(os.path.exists(self.store.get_wavefile("a")))
+
+        # The files used to be indexed without their device.
+        self.assertEqual(
+            [row[1] for row in self.store.db.execute("PRAGMA table_info(Files)")][0],
+            "Dev")
+
+        # The cache is migrated once.
+        legacy_dir, proxy_wavefile = self._create_legacy_files()
+        store = PreviewsStore(self.cache_dir)
+        store.close()
+        self.assertTrue(os.path.exists(legacy_dir))
+        self.assertTrue(os.path.lexists(proxy_wavefile))
+
+    def test_migration_auto_vacuum(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            db = sqlite3.connect(os.path.join(cache_dir, "previews.db"))
+            db.execute("CREATE TABLE Assets (Hash TEXT, AccessTime REAL)")
+            db.execute("PRAGMA user_version = 1")
+            db.close()
+
+            store = PreviewsStore(cache_dir)
+            # INCREMENTAL
+            self.assertEqual(store.db.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+            store.close()
+
+    def test_main(self):
+        self._add_thumbs("a", 2 * 2 ** 20)
+        self.store.touch("a")
+        with mock.patch("builtins.print") as print_mock:
+            self.assertEqual(main(["--cache-dir", self.cache_dir, "report"]), 0)
+        self.assertIn("1 assets, 2.0 MiB", print_mock.call_args[0][0])
+
+        with mock.patch("builtins.print"):
+            self.assertEqual(main(["--cache-dir", self.cache_dir,
+                                   "prune", "--max-size", "1"]), 0)
+        self.assertEqual(self.store.get_usage(), [])
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+"""Tests for the utils.waveform module."""
+# pylint: disable=missing-docstring,protected-access,no-self-use
+import os
+import tempfile
+from unittest import mock
+from unittest import TestCase
+
+import numpy
+
+from pitivi.utils.waveform import build_pyramid
+from pitivi.utils.waveform import choose_level
+from pitivi.utils.waveform import decimate
+from pitivi.utils.waveform import LevelsAccumulator
+from pitivi.utils.waveform import load_waveform
+from pitivi.utils.waveform import PcmAccumulator
+from pitivi.utils.waveform import PEAK_ROW
+from pitivi.utils.waveform import RMS_ROW
+from pitivi.utils.waveform import save_waveform
+
+
+class TestPyramid(TestCase):
+
+    def test_decimate(self):
+        samples = numpy.arange(10, dtype=numpy.float32)
+        self.assertEqual(decimate(samples, 1).tolist(), samples.tolist())
+        self.assertEqual(decimate(samples, 5).tolist(), [2, 7])
+        # The remaining samples are averaged into the last value.
+        self.assertEqual(decimate(samples, 4).tolist(), [1.5, 5.5, 8.5])
+
+    def test_decimate_max(self):
+        samples = numpy.array([1, 5, 2, 0, 3, 9, 4], dtype=numpy.float32)
+        self.assertEqual(decimate(samples, 3, numpy.max).tolist(), [5, 9, 4])
+
+    def test_build_pyramid(self):
+        samples = numpy.random.rand(1000)
+        peaks = samples + numpy.random.rand(1000)
+        levels = build_pyramid(samples, peaks, (1, 4, 16))
+        self.assertEqual([level.shape for level in levels],
+                         [(2, 1000), (2, 250), (2, 63)])
+        self.assertAlmostEqual(levels[1][RMS_ROW][0], samples[:4].mean(), places=5)
+        self.assertAlmostEqual(levels[2][RMS_ROW][1], samples[16:32].mean(), places=5)
+        # The transients are kept in the coarse levels.
+        self.assertAlmostEqual(levels[1][PEAK_ROW][0], peaks[:4].max(), places=5)
+        self.assertAlmostEqual(levels[2][PEAK_ROW][62], peaks[992:].max(), places=5)
+
+        levels = build_pyramid(samples, decimations=(1, 4))
+        self.assertEqual(levels[1][PEAK_ROW][0], samples[:4].max().astype(numpy.float32))
+
+    def test_choose_level(self):
+        decimations = (1, 4, 16, 64)
+        levels = build_pyramid(numpy.random.rand(1000), decimations=decimations)
+        for samples_per_pixel, index in ((0.1, 0), (1, 0), (3.9, 0), (4, 1),
+                                         (63, 2), (10000, 3)):
+            factor, rms, peaks = choose_level(levels, samples_per_pixel, decimations)
+            self.assertEqual(factor, decimations[index])
+            self.assertEqual(rms.tolist(), levels[index][RMS_ROW].tolist())
+            self.assertEqual(peaks.tolist(), levels[index][PEAK_ROW].tolist())
+
+
+class TestLevelsAccumulator(TestCase):
+
+    def test_linear_join(self):
+        accumulator = LevelsAccumulator(10, 1)
+        # -20 dB is 10, -40 dB is 1.
+        accumulator.add(1, [-20])
+        accumulator.add(5, [-40])
+        accumulator.add(6, [0.0])
+        accumulator.flush()
+        peaks = accumulator.values[0].tolist()
+        self.assertAlmostEqual(peaks[1], 10, places=5)
+        # The samples before the next known sample join linearly to it.
+        for pos, expected in ((2, 7), (3, 4), (4, 1), (5, 1)):
+            self.assertAlmostEqual(peaks[pos], expected, places=5)
+        # Non-negative values are replaced with the previous value.
+        self.assertAlmostEqual(peaks[6], 1, places=5)
+        self.assertEqual(peaks[7:], [0, 0, 0])
+
+    def test_batches(self):
+        positions = sorted(set(numpy.random.randint(0, 1000, 300).tolist()))
+        values = numpy.random.uniform(-60, -1, (len(positions), 2)).tolist()
+
+        accumulator = LevelsAccumulator(1000, 2)
+        for pos, rms_values in zip(positions, values):
+            accumulator.add(pos, rms_values)
+        expected = accumulator.get_samples()
+
+        accumulator = LevelsAccumulator(1000, 2)
+        accumulator.BATCH_SIZE = 7
+        for pos, rms_values in zip(positions, values):
+            accumulator.add(pos, rms_values)
+        self.assertTrue(numpy.allclose(accumulator.get_samples(), expected))
+
+    def test_peaks(self):
+        accumulator = LevelsAccumulator(10, 2)
+        accumulator.add(0, [-40, -60], [-20, -6])
+        accumulator.add(5, [-40, -60])
+        peaks = accumulator.get_peaks()
+        # The maximum of the channels.
+        self.assertAlmostEqual(peaks[0], 10 ** (-6 / 20) * 100, places=4)
+        # The RMS values are used when the peaks are missing.
+        self.assertAlmostEqual(peaks[5], 1, places=5)
+        self.assertAlmostEqual(accumulator.get_samples()[0], (1 + 0.1) / 2, places=5)
+
+    def test_seek_back(self):
+        accumulator = LevelsAccumulator(10, 1)
+        accumulator.add(4, [-20])
+        accumulator.add(2, [-20])
+        accumulator.add(3, [-40])
+        peaks = accumulator.get_samples().tolist()
+        self.assertAlmostEqual(peaks[2], 10, places=5)
+        self.assertAlmostEqual(peaks[3], 1, places=5)
+        self.assertAlmostEqual(peaks[4], 10, places=5)
+
+
+    def test_seek_back_to_start(self):
+        accumulator = LevelsAccumulator(10, 1)
+        accumulator.add(0, [-20])
+        accumulator.add(9, [-40])
+        accumulator.flush()
+        self.assertAlmostEqual(accumulator.values[0, 9], 1, places=5)
+
+        # The start has no previous value, the end of the clip is not used.
+        accumulator.add(0, [0.0])
+        self.assertEqual(accumulator.get_samples()[0], 0)
+        accumulator.add(0, [-20])
+        self.assertAlmostEqual(accumulator.get_samples()[0], 10, places=5)
+
+    def test_first_sample(self):
+        accumulator = LevelsAccumulator(10, 1)
+        accumulator.add(0, [0.0])
+        accumulator.add(2, [-20])
+        samples = accumulator.get_samples().tolist()
+        self.assertEqual(samples[0], 0)
+        self.assertAlmostEqual(samples[2], 10, places=5)
+
+
+class TestPcmAccumulator(TestCase):
+
+    def test_rms(self):
+        rate = 1000
+        frames = numpy.zeros((rate, 2), dtype=numpy.float32)
+        # A square wave with an amplitude of 0.5 on the first channel.
+        frames[::2, 0] = 0.5
+        frames[1::2, 0] = -0.5
+        frames[:, 1] = 0.1
+        # The last 10 samples are silent on both channels.
+        frames[900:] = 0
+
+        accumulator = PcmAccumulator(100, 2, rate)
+        for offset in range(0, rate, 64):
+            accumulator.add(frames[offset:offset + 64], offset)
+        samples = accumulator.get_samples()
+        self.assertEqual(len(samples), 100)
+        self.assertTrue(numpy.allclose(samples[:90], (50 + 10) / 2))
+        self.assertTrue(numpy.allclose(samples[90:], 0))
+        # The peaks are the maximum of the channels.
+        peaks = accumulator.get_peaks()
+        self.assertEqual(len(peaks), 100)
+        self.assertTrue(numpy.allclose(peaks[:90], 50))
+        self.assertTrue(numpy.allclose(peaks[90:], 0))
+
+    def test_transient(self):
+        frames = numpy.zeros((1000, 1), dtype=numpy.float32)
+        frames[505] = -0.8
+        accumulator = PcmAccumulator(100, 1, 1000)
+        accumulator.add(frames[:503], 0)
+        accumulator.add(frames[503:], 503)
+        peaks = accumulator.get_peaks()
+        # The transient is kept, while it's averaged out of the RMS value.
+        self.assertAlmostEqual(peaks[50], 80, places=5)
+        self.assertEqual(numpy.count_nonzero(peaks), 1)
+        self.assertLess(accumulator.get_samples()[50], 30)
+
+    def test_missing_offsets(self):
+        frames = numpy.random.uniform(-1, 1, (48000, 1)).astype(numpy.float32)
+        expected = PcmAccumulator(100, 1, 48000)
+        expected.add(frames, 0)
+
+        accumulator = PcmAccumulator(100, 1, 48000)
+        for offset in range(0, len(frames), 1000):
+            accumulator.add(frames[offset:offset + 1000])
+        self.assertTrue(numpy.allclose(accumulator.get_samples(),
+                                       expected.get_samples()))
+
+    def test_past_the_end(self):
+        accumulator = PcmAccumulator(10, 1, 1000)
+        # The frames after the 10th sample are ignored.
+        accumulator.add(numpy.ones((200, 1), dtype=numpy.float32), 50)
+        samples = accumulator.get_samples()
+        self.assertEqual(samples[:5].tolist(), [0] * 5)
+        self.assertTrue(numpy.allclose(samples[5:], 100))
+        peaks = accumulator.get_peaks()
+        self.assertEqual(peaks[:5].tolist(), [0] * 5)
+        self.assertTrue(numpy.allclose(peaks[5:], 100))
+
+
+class TestWaveformFile(TestCase):
+
+    def test_save_load(self):
+        samples = numpy.random.rand(1000) * 100
+        levels = build_pyramid(samples, samples * 2)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "file.wave")
+            save_waveform(path, levels)
+            loaded = load_waveform(path)
+            self.assertEqual(len(loaded), len(levels))
+            for level, loaded_level in zip(levels, loaded):
+                self.assertIsInstance(loaded_level, numpy.memmap)
+                self.assertEqual(loaded_level.shape, level.shape)
+                self.assertEqual(loaded_level.tolist(), level.tolist())
+
+    def test_load_invalid(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "file.wave")
+            self.assertIsNone(load_waveform(path))
+
+            # Waveforms used to be pickled.
+            with open(path, "wb") as wavefile:
+                wavefile.write(b"\x80\x03]q\x00(G?\xbc\x81")
+            self.assertIsNone(load_waveform(path))
+
+            levels = build_pyramid(numpy.random.rand(100))
+            save_waveform(path, levels)
+            with open(path, "ab") as wavefile:
+                wavefile.write(b"garbage")
+            self.assertIsNone(load_waveform(path))
+
+            save_waveform(path, levels[:2], (1, 4))
+            self.assertIsNone(load_waveform(path))
+            self.assertIsNotNone(load_waveform(path, (1, 4)))
+
+    def test_save_concurrently(self):
+        levels = build_pyramid(numpy.random.rand(100))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "file.wave")
+            tmp_paths = []
+            replace = os.replace
+
+            def record_replace(src, dst):
+                tmp_paths.append(src)
+                replace(src, dst)
+
+            with mock.patch("pitivi.utils.waveform.os.replace", record_replace):
+                save_waveform(path, levels)
+                save_waveform(path, levels)
+            # Each writer uses its own temporary file.
+            self.assertEqual(len(set(tmp_paths)), 2)
+            self.assertEqual(os.listdir(temp_dir), ["file.wave"])
+            self.assertIsNotNone(load_waveform(path))
+
+    def test_permissions(self):
+        levels = build_pyramid(numpy.random.rand(100))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "file.wave")
+            save_waveform(path, levels)
+            umask = os.umask(0)
+            os.umask(umask)
+            # Not only readable by the user, like the temporary files.
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o666 & ~umask)